@@ -0,0 +1,29 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import argparse
+
+from acd_annotator_python import batch
+from acd_annotator_python import server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m acd_annotator_python')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='serve an annotator app with multiple worker processes')
+    server.add_arguments(serve_parser)
+    serve_parser.set_defaults(func=server.serve)
+    batch_parser = subparsers.add_parser('batch', help='run an annotator app over a file of ContainerGroups')
+    batch.add_arguments(batch_parser)
+    batch_parser.set_defaults(func=batch.run)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,13 +8,46 @@
 
 from abc import ABC, abstractmethod
 import inspect
+from typing import Callable, Collection, List, Optional, Sequence
 from fastapi import Request
 
 from acd_annotator_python.container_model.main import UnstructuredContainer
 from acd_annotator_python.container_model.main import StructuredContainer
 
 
+class ExecutionMode:
+    """
+    Where the framework runs an annotator's annotate()/annotate_structured() methods
+    """
+    # directly on the server's event loop. Best for annotators that are quick or await async io.
+    event_loop = 'event_loop'
+    # in a pool of worker processes (see process_pool.AnnotatorProcessPool). Best for CPU-bound annotators.
+    # Each worker calls on_startup() once (the server process does not), with a stand-in app object.
+    # The annotator must be picklable, and annotate() gets a stand-in request with only `app` and `headers`.
+    # Each process serving the app (e.g., each server worker) has a pool of its own; by default they split the cpus.
+    process_pool = 'process_pool'
+
+
 class ACDAnnotator(ABC):
+    # The names of the UnstructuredContainerData / StructuredContainerData fields (e.g., 'attributeValues')
+    # that this annotator reads or writes. Everything else in container.data is hidden from the annotator
+    # and passed through to the response untouched, without being parsed, validated or span-converted.
+    # None (the default) means the annotator sees every field.
+    unstructured_data_fields: Optional[Collection[str]] = None
+    structured_data_fields: Optional[Collection[str]] = None
+    # Cheap checks run against each raw container dict before any container model objects are built,
+    # e.g., (preconditions.requires('data.attributeValues'),). See preconditions.py.
+    # Containers that fail any of them are passed through untouched.
+    unstructured_preconditions: Sequence[Callable[[dict], bool]] = ()
+    structured_preconditions: Sequence[Callable[[dict], bool]] = ()
+    # see ExecutionMode
+    execution_mode: str = ExecutionMode.event_loop
+    # Unstructured containers with more than chunk_size characters of text are split into chunks (at paragraph
+    # or sentence boundaries, overlapping by chunk_overlap characters) that are annotated concurrently and merged
+    # back together. Only for annotators that only need local context. See chunking.py. None (the default) is off.
+    chunk_size: Optional[int] = None
+    chunk_overlap: int = 200
+
     def __init_subclass__(cls, **kwargs):
         """
         Make sure that any subclass that inherits ACDAnnotator
@@ -50,6 +83,34 @@ class ACDAnnotator(ABC):
         """
         pass
 
+    async def annotate_batch(self, unstructured_containers: List[UnstructuredContainer], app):
+        """
+        Optional. Apply annotator logic to a batch of unstructured containers, altering them in-place.
+        If a subclass overrides this, the framework gathers unstructured containers from concurrent
+        requests into batches (see batching.MicroBatcher) and calls this instead of annotate().
+        Useful for libraries that process many documents at once much faster than one at a time
+        (e.g., spacy's nlp.pipe()). An error fails every request with a container in the batch.
+        The default does nothing (and isn't used; see supports_batching()).
+        :param unstructured_containers:
+        :param app: the fastapi app (the containers may come from different requests)
+        :return:
+        """
+        pass
+
+    def supports_batching(self):
+        """Does this annotator implement annotate_batch()?"""
+        return type(self).annotate_batch is not ACDAnnotator.annotate_batch
+
+    def get_cache_identity(self) -> Optional[str]:
+        """
+        Optional. A string identifying this annotator's version and configuration (e.g., model names and versions),
+        which lets the framework cache its results (see result_cache.py): a container it has seen before,
+        with the same text and data, gets the stored result instead of being annotated again.
+        Only return one if the annotator's output depends on nothing but the container (e.g., not on headers
+        or time). None (the default) opts out of caching.
+        """
+        return None
+
     async def annotate_structured(self, structured_container: StructuredContainer, request: Request):
         """
         Apply logic to a structured container altering it in-place.
@@ -0,0 +1,203 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+An offline runner that pushes a file of ContainerGroups through an annotator app, without any http:
+
+    python -m acd_annotator_python.batch --app example_apps.regex_annotator:app \
+        --in corpus.ndjson --out results.ndjson --workers 4
+
+The input has one ContainerGroup (json) per line, and the output gets one result per line, in the same order.
+Each document gets the same treatment as a /process request: offset translation, validation, the annotator,
+and the result cache if configured. A document that fails gets its error body, {"detail": {...}}, as its
+result line. Use '-' for stdin/stdout.
+
+Like the multi-worker server (see server.py), the app is loaded once and its resources are shared by worker
+processes forked from this one. Files are read and written as streams, so they can be of any size.
+"""
+
+import argparse
+import asyncio
+import collections
+import gc
+import itertools
+import json
+import logging
+import logging.config
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.requests import Request
+
+from acd_annotator_python import ndjson
+from acd_annotator_python import server
+from acd_annotator_python import service_utils
+
+logger = logging.getLogger(__name__)
+
+# the app being run (loaded in the parent process and inherited by the workers), and each process' event loop
+_app = None
+_loop = None
+
+
+def make_request(app):
+    """A stand-in for the http request that annotators get passed (with no headers)"""
+    return Request({'type': 'http', 'method': 'POST', 'path': '/process', 'query_string': b'',
+                    'headers': [(b'content-type', b'application/json')], 'app': app})
+
+
+def _init_worker():
+    """Run the app's startup hooks in this process (the annotator's resources are already loaded)"""
+    global _loop
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    _loop.run_until_complete(_app.router.startup())
+
+
+def _process_chunk(lines):
+    """Process a chunk of lines concurrently (entry point of the worker processes)"""
+    return _loop.run_until_complete(asyncio.gather(*(ndjson.process_line(_app, make_request(_app), line)
+                                                     for line in lines)))
+
+
+class Progress:
+    """Counts processed documents and logs the progress every interval seconds"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.documents = 0
+        self.errors = 0
+        self.start_time = time.monotonic()
+        self.last_report_time = self.start_time
+
+    def add(self, results):
+        self.documents += len(results)
+        self.errors += sum(1 for _, ok in results if not ok)
+        now = time.monotonic()
+        if now - self.last_report_time >= self.interval:
+            self.last_report_time = now
+            self.report()
+
+    def get_stats(self):
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "documents": self.documents,
+            "errors": self.errors,
+            "elapsedSeconds": round(elapsed, 3),
+            "documentsPerSecond": round(self.documents / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+    def report(self):
+        stats = self.get_stats()
+        logger.info(f'Processed {stats["documents"]} documents ({stats["errors"]} errors) '
+                    f'in {stats["elapsedSeconds"]:.1f}s: {stats["documentsPerSecond"]} documents/s')
+
+
+def _read_chunks(in_file, chunk_size):
+    """The non-blank lines of in_file, in chunks"""
+    lines = (line for line in in_file if line.strip())
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_batch(app, in_file, out_file, workers: int, chunk_size: int = 16, progress_interval: float = 10):
+    """
+    Process every ContainerGroup line of in_file with the app and write the results to out_file, in order.
+    :param app: an annotator app (see fastapi_app_factory.build())
+    :param workers: the number of worker processes. 0 processes everything in this process.
+    :param chunk_size: lines sent to a worker at a time (and processed concurrently by it)
+    :param progress_interval: seconds between progress reports
+    :return: the final stats (documents, errors, elapsedSeconds, documentsPerSecond)
+    """
+    global _app
+    _app = app
+    # each worker process runs its own copy of the app, and an even share of the cpus for its process pool, if any
+    app.acd_worker_processes = max(workers, 1)
+    # load the annotator's resources here, before forking, so all of the workers share them
+    app.acd_preload()
+    progress = Progress(progress_interval)
+
+    def write(results):
+        for result_line, _ in results:
+            out_file.write(result_line)
+            out_file.write('\n')
+        progress.add(results)
+
+    if workers <= 0:
+        _init_worker()
+        for chunk in _read_chunks(in_file, chunk_size):
+            write(_process_chunk(chunk))
+    else:
+        # keep the shared resources out of the garbage collector's way (see server.py)
+        gc.freeze()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_worker) as executor:
+            # a few chunks per worker in flight keeps the workers busy without reading far ahead
+            pending = collections.deque()
+            for chunk in _read_chunks(in_file, chunk_size):
+                pending.append(executor.submit(_process_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+        gc.unfreeze()
+    out_file.flush()
+    progress.report()
+    return progress.get_stats()
+
+
+def add_arguments(parser):
+    parser.add_argument('--app', required=True,
+                        help='the app, as "module:attribute" (a FastAPI app or a function returning one)')
+    parser.add_argument('--in', dest='in_path', default='-',
+                        help='input file with one ContainerGroup (json) per line ("-" for stdin, the default)')
+    parser.add_argument('--out', dest='out_path', default='-',
+                        help='output file, with one result per line ("-" for stdout, the default)')
+    parser.add_argument('--workers', type=int, default=service_utils.get_usable_cpu_count(),
+                        help='number of worker processes (default: the number of cpus this process may use). '
+                             '0 runs in this process.')
+    parser.add_argument('--chunk-size', type=int, default=16,
+                        help='documents sent to a worker at a time and processed concurrently (default 16)')
+    parser.add_argument('--progress-interval', type=float, default=10,
+                        help='seconds between progress reports (default 10)')
+    parser.add_argument('--log-config', help='a json logging configuration (default: the service\'s)')
+
+
+def run(args):
+    """Run a batch given the command line arguments"""
+    log_config = service_utils.DEFAULT_LOG_SETTINGS
+    if args.log_config is not None:
+        with open(args.log_config) as f:
+            log_config = json.load(f)
+    logging.config.dictConfig(log_config)
+
+    app = server.load_app(args.app)
+    in_file = sys.stdin if args.in_path == '-' else open(args.in_path, encoding='utf-8')
+    out_file = sys.stdout if args.out_path == '-' else open(args.out_path, 'w', encoding='utf-8')
+    try:
+        run_batch(app, in_file, out_file, args.workers, args.chunk_size, args.progress_interval)
+    finally:
+        for f in (in_file, out_file):
+            if f not in (sys.stdin, sys.stdout):
+                f.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m acd_annotator_python.batch',
+                                     description='Run an annotator app over a file of ContainerGroups')
+    add_arguments(parser)
+    run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Gathers items submitted by concurrent requests into batches and runs each batch with a single call,
+    e.g., so an annotator can push containers from several requests through nlp.pipe() at once.
+    A batch is sent off as soon as it reaches max_batch_size items, or max_wait_time seconds after
+    its first item arrived, whichever comes first.
+    """
+
+    def __init__(self, batch_function, max_batch_size: int, max_wait_time: float):
+        """
+        :param batch_function: an async function that takes a list of items and processes them in-place
+        :param max_batch_size:
+        :param max_wait_time: in seconds
+        """
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        # (item, future) pairs waiting for the next batch
+        self._pending = []
+        self._timer = None
+        self._running_batches = set()
+
+    async def submit(self, item):
+        """Add an item to the next batch and wait until that batch has been processed"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_time, self._flush)
+        await future
+
+    def _flush(self):
+        """Send off whatever is pending as one batch"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            # hold on to running batches so they don't get garbage collected
+            self._running_batches.add(task)
+            task.add_done_callback(self._running_batches.discard)
+
+    async def _run_batch(self, batch):
+        # skip items whose requests gave up waiting
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        logger.debug("Running a batch of %s items", len(batch))
+        try:
+            await self.batch_function([item for item, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            # every request in the batch sees the error
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
@@ -0,0 +1,7 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
@@ -0,0 +1,12 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+from acd_annotator_python.benchmarks.runner import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+Generates realistic (but synthetic) ContainerGroup request bodies for benchmarks. Everything is drawn
+from a seeded random number generator, so the same parameters always give the same request.
+"""
+
+import random
+import re
+
+from acd_annotator_python import container_utils
+
+WORDS = ('the', 'patient', 'reports', 'severe', 'pain', 'in', 'left', 'lung', 'with', 'history', 'of',
+         'carcinoma', 'and', 'denies', 'smoking', 'subject', 'was', 'given', 'mg', 'daily', 'for', 'chest',
+         'mass', 'biopsy', 'showed', 'non-small', 'cell', 'diagnosis', 'follow-up', 'in', 'weeks', 'blood',
+         'pressure', 'stable', 'no', 'fever', 'outpatient', 'oncology', 'referral', 'a', 'to')
+# characters outside the basic multilingual plane, which java counts as two characters
+SURROGATE_PAIR_CHARACTERS = ('😀', '🩺', '💊', '🫁', '📋', '🧬')
+CUIS = ('C0242379', 'C0007131', 'C0024109', 'C0030193', 'C0037369', 'C0015967')
+SNOMED_CODES = ('363346000', '93880001', '254637007', '187875007', '22298006')
+
+
+def _scores(rng, *names):
+    return {name: round(rng.random(), 3) for name in names}
+
+
+class ContainerGroupGenerator:
+    """
+    Builds ContainerGroup dicts. See generate_container_group() for the parameters.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.rng = random.Random(seed)
+
+    def generate_text(self, size: int, surrogate_pair_density: float):
+        """
+        Text of about size characters, in sentences and paragraphs. surrogate_pair_density is the fraction
+        of words followed by a character outside the basic multilingual plane (e.g., an emoji).
+        """
+        rng = self.rng
+        parts = []
+        length = 0
+        sentence_length = 0
+        sentences = 0
+        while length < size:
+            word = rng.choice(WORDS)
+            if sentence_length == 0:
+                word = word.capitalize()
+            if rng.random() < surrogate_pair_density:
+                word += ' ' + rng.choice(SURROGATE_PAIR_CHARACTERS)
+            sentence_length += 1
+            if sentence_length >= rng.randint(8, 20):
+                sentence_length = 0
+                sentences += 1
+                word += '.\n\n' if sentences % 5 == 0 else '. '
+            else:
+                word += ' '
+            parts.append(word)
+            length += len(word)
+        return ''.join(parts)[:size]
+
+    def _word_spans(self, text, count):
+        """count (begin, end) spans of words in text, in order"""
+        words = [match.span() for match in re.finditer(r'\w[\w-]*', text)]
+        if not words:
+            return []
+        return sorted(self.rng.choice(words) for _ in range(count))
+
+    def _span_annotation(self, text, span):
+        begin, end = span
+        return {"begin": begin, "end": end, "coveredText": text[begin:end]}
+
+    def generate_insight_model_data(self, text, depth: int):
+        """Clinical insight model data nested about depth levels deep (0 for none)"""
+        if depth <= 0:
+            return None
+        rng = self.rng
+        data = {"diagnosis": {"usage": _scores(rng, 'explicitScore', 'implicitScore', 'patientReportedScore',
+                                               'discussedScore')}}
+        if depth >= 2:
+            data["diagnosis"].update(_scores(rng, 'suspectedScore', 'symptomScore', 'traumaScore',
+                                             'familyHistoryScore'))
+            data["procedure"] = {
+                "usage": _scores(rng, 'explicitScore', 'pendingScore', 'discussedScore'),
+                "task": _scores(rng, 'therapeuticScore', 'diagnosticScore', 'labTestScore', 'surgicalTaskScore',
+                                'clinicalAssessmentScore'),
+                "type": _scores(rng, 'deviceScore', 'materialScore', 'medicationScore', 'procedureScore',
+                                'conditionManagementScore'),
+            }
+            data["medication"] = {
+                "usage": _scores(rng, 'explicitScore', 'consideringScore', 'discussedScore'),
+                "startedEvent": {"score": round(rng.random(), 3),
+                                 "usage": _scores(rng, 'explicitScore', 'consideringScore', 'discussedScore')},
+            }
+        if depth >= 3:
+            # spans nested inside the insight model data
+            for name in ("diagnosis", "procedure"):
+                data[name]["modifiers"] = {
+                    "sites": [self._span_annotation(text, span) for span in self._word_spans(text, 2)],
+                    "associatedDiagnoses": [self._span_annotation(text, span)
+                                            for span in self._word_spans(text, 1)],
+                }
+            data["normality"] = {
+                "usage": _scores(rng, 'normalScore', 'abnormalScore', 'unknownScore', 'quantitativeScore',
+                                 'nonFindingScore'),
+                "evidence": [self._span_annotation(text, span) for span in self._word_spans(text, 2)],
+            }
+        if depth >= 4:
+            data["medication"]["adverseEvent"] = {
+                "score": round(rng.random(), 3), "allergyScore": round(rng.random(), 3),
+                "usage": _scores(rng, 'explicitScore', 'consideringScore', 'discussedScore'),
+                "modifiers": {"sites": [self._span_annotation(text, span) for span in self._word_spans(text, 2)]},
+            }
+        return data
+
+    def generate_unstructured_container(self, text_size, surrogate_pair_density, concepts, attribute_values,
+                                        insight_model_data_depth):
+        """An unstructured container dict (with python offsets)"""
+        rng = self.rng
+        text = self.generate_text(text_size, surrogate_pair_density)
+        data = {}
+        if concepts:
+            data["concepts"] = []
+            for uid, span in enumerate(self._word_spans(text, concepts)):
+                concept = self._span_annotation(text, span)
+                concept.update({
+                    "uid": uid, "type": "umls.DiseaseOrSyndrome", "cui": rng.choice(CUIS),
+                    "preferredName": concept["coveredText"].lower(), "semanticType": "dsyn",
+                    "source": "umls", "sourceVersion": "2020AA", "negated": rng.random() < 0.1,
+                })
+                insight_model_data = self.generate_insight_model_data(text, insight_model_data_depth)
+                if insight_model_data is not None:
+                    concept["insightModelData"] = insight_model_data
+                data["concepts"].append(concept)
+        if attribute_values:
+            data["attributeValues"] = []
+            for span in self._word_spans(text, attribute_values):
+                attribute_value = self._span_annotation(text, span)
+                attribute_value.update({
+                    "name": "Diagnosis", "preferredName": attribute_value["coveredText"].lower(),
+                    "source": "General Medical", "sourceVersion": "v2.0",
+                    "values": [{"value": attribute_value["coveredText"]}],
+                    "snomedConceptId": ','.join(rng.sample(SNOMED_CODES, rng.randint(1, 2))),
+                    "concept": {"uid": rng.randrange(max(concepts, 1))},
+                })
+                insight_model_data = self.generate_insight_model_data(text, insight_model_data_depth)
+                if insight_model_data is not None:
+                    attribute_value["insightModelData"] = insight_model_data
+                data["attributeValues"].append(attribute_value)
+        return {"text": text, "data": data}
+
+    def generate_structured_container(self):
+        rng = self.rng
+        return {"data": {"heightInches": rng.randint(55, 80), "weightPounds": rng.randint(90, 300)}}
+
+    def generate_container_group(self, unstructured=1, structured=0, text_size=10000, surrogate_pair_density=0.01,
+                                 concepts=50, attribute_values=20, insight_model_data_depth=2):
+        """
+        A ContainerGroup dict as ACD would send it (with java offsets)
+        :param unstructured: the number of unstructured containers
+        :param structured: the number of structured containers (with a heightInches and weightPounds)
+        :param text_size: the number of characters of text in each unstructured container
+        :param surrogate_pair_density: the fraction of words followed by a character outside the basic
+            multilingual plane, which makes java and python offsets differ
+        :param concepts: the number of concepts in each unstructured container
+        :param attribute_values: the number of attributeValues in each unstructured container
+        :param insight_model_data_depth: how deeply nested the insightModelData of each annotation is (0 for none)
+        """
+        container_group = {}
+        if unstructured:
+            container_group["unstructured"] = [
+                self.generate_unstructured_container(text_size, surrogate_pair_density, concepts, attribute_values,
+                                                     insight_model_data_depth)
+                for _ in range(unstructured)]
+        if structured:
+            container_group["structured"] = [self.generate_structured_container() for _ in range(structured)]
+        return container_utils.python2java(container_group)
+
+
+def generate_container_group(seed: int = 0, **parameters):
+    """A ContainerGroup dict (see ContainerGroupGenerator.generate_container_group() for the parameters)"""
+    return ContainerGroupGenerator(seed).generate_container_group(**parameters)
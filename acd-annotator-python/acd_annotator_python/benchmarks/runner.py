@@ -0,0 +1,262 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+Times each stage of handling a /process request on generated ContainerGroups (see generator.py):
+
+    - java2python / python2java: offset translation of the request and the response
+    - validate: ContainerGroup(**body)
+    - from_dict.<level>: parsing at each validation level (see container_utils.ValidationLevel)
+    - dict: ContainerGroup.dict(exclude_none=True), i.e., serializing the response
+    - <app>.annotate: the app's annotator(s) alone, on an already parsed ContainerGroup
+    - <app>.process: everything a /process request does, short of http
+
+Every measurement gets a fresh copy of its input, made outside of the timed region, and runs with the
+garbage collector disabled (like timeit), after a collection. The same seed and parameters give the same
+input, so results of different runs (e.g., before and after a change) can be compared:
+
+    python -m acd_annotator_python.benchmarks --out baseline.json
+    python -m acd_annotator_python.benchmarks --baseline baseline.json --max-regression 0.2
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+
+import fastapi
+import pydantic
+
+from acd_annotator_python import batch
+from acd_annotator_python import container_utils
+from acd_annotator_python import server
+from acd_annotator_python.benchmarks.generator import generate_container_group
+from acd_annotator_python.container_model.main import ContainerGroup
+
+DEFAULT_APPS = ('example_apps.regex_annotator:app',
+                'example_apps.code_resolution_annotator:app',
+                'example_apps.bmi_annotator:app')
+# need spacy/stanza and their models (see example_apps/extras)
+EXTRA_APPS = ('example_apps.extras.spacy_sentence_annotator:app',
+              'example_apps.extras.stanza_sentence_annotator:app')
+DEFAULT_PARAMETERS = {
+    "unstructured": 1,
+    "structured": 1,
+    "text_size": 10000,
+    "surrogate_pair_density": 0.01,
+    "concepts": 50,
+    "attribute_values": 20,
+    "insight_model_data_depth": 2,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def time_stage(func, make_input, repeat: int, warmup: int = 1):
+    """
+    Time func(make_input()) repeat times (after warmup untimed runs). Only the call to func is timed.
+    :return: the timings in milliseconds (min, median, mean, max)
+    """
+    times = []
+    for i in range(warmup + repeat):
+        arg = make_input()
+        gc.collect()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(arg)
+            elapsed = time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if i >= warmup:
+            times.append(elapsed * 1000)
+    return {
+        "repeat": repeat,
+        "minMs": round(min(times), 4),
+        "medianMs": round(statistics.median(times), 4),
+        "meanMs": round(statistics.mean(times), 4),
+        "maxMs": round(max(times), 4),
+    }
+
+
+def get_app_name(app_path):
+    """e.g., "regex_annotator" for "example_apps.regex_annotator:app\""""
+    return app_path.split(':')[0].rsplit('.', 1)[-1]
+
+
+def benchmark_framework(body_json: str, repeat: int, warmup: int):
+    """Time the framework's stages on a ContainerGroup (json, with java offsets)"""
+    python_body = container_utils.java2python(json.loads(body_json))
+    python_body_json = json.dumps(python_body)
+    container_group = ContainerGroup(**python_body)
+    results = {
+        "java2python": time_stage(container_utils.java2python, lambda: json.loads(body_json), repeat, warmup),
+        "validate": time_stage(lambda body: ContainerGroup(**body), lambda: json.loads(python_body_json),
+                               repeat, warmup),
+    }
+    for level in container_utils.ValidationLevel.all:
+        results[f"from_dict.{level}"] = time_stage(lambda body: container_utils.from_dict(body, level),
+                                                   lambda: json.loads(python_body_json), repeat, warmup)
+    results["dict"] = time_stage(lambda group: group.dict(exclude_none=True), lambda: container_group,
+                                 repeat, warmup)
+    results["python2java"] = time_stage(container_utils.python2java, lambda: json.loads(python_body_json),
+                                        repeat, warmup)
+    return results
+
+
+def benchmark_app(app, name: str, body_json: str, repeat: int, warmup: int):
+    """Time an annotator app on a ContainerGroup (json, with java offsets)"""
+    python_body_json = json.dumps(container_utils.java2python(json.loads(body_json)))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(app.router.startup())
+    try:
+        request = batch.make_request(app)
+        return {
+            f"{name}.annotate": time_stage(
+                lambda group: loop.run_until_complete(app.acd_annotate_container_group(group, request)),
+                lambda: container_utils.from_dict(json.loads(python_body_json)), repeat, warmup),
+            f"{name}.process": time_stage(
+                lambda body: loop.run_until_complete(app.acd_process_container_group(request, body)),
+                lambda: json.loads(body_json), repeat, warmup),
+        }
+    finally:
+        loop.run_until_complete(app.router.shutdown())
+        loop.close()
+
+
+def get_environment():
+    """What the results were measured on (results are only comparable on the same environment)"""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "pydantic": pydantic.VERSION,
+        "fastapi": fastapi.__version__,
+    }
+
+
+def run_benchmarks(apps=DEFAULT_APPS, repeat: int = 20, warmup: int = 2, seed: int = 0, **parameters):
+    """
+    Run the benchmarks on a ContainerGroup generated from the seed and parameters (see DEFAULT_PARAMETERS).
+    Apps that can't be imported (e.g., missing optional dependencies) are skipped.
+    :param apps: annotator apps, as "module:attribute" (see server.load_app())
+    :return: the environment, seed, parameters, and the timings of each stage
+    """
+    parameters = {**DEFAULT_PARAMETERS, **parameters}
+    body_json = json.dumps(generate_container_group(seed, **parameters))
+    results = benchmark_framework(body_json, repeat, warmup)
+    for app_path in apps:
+        try:
+            app = server.load_app(app_path)
+        except ImportError as e:
+            logger.warning(f'Skipping {app_path}: {e}')
+            continue
+        results.update(benchmark_app(app, get_app_name(app_path), body_json, repeat, warmup))
+    return {
+        "environment": get_environment(),
+        "seed": seed,
+        "parameters": parameters,
+        "requestSizeBytes": len(body_json.encode('utf-8')),
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float):
+    """
+    Compare the median timings of the stages in both report and baseline.
+    :param max_regression: how much slower than the baseline a stage may get, e.g., 0.2 for 20%
+    :return: {stage: {"baselineMedianMs", "medianMs", "ratio", "regression"}}
+    """
+    comparison = {}
+    for stage, result in report["results"].items():
+        baseline_result = baseline.get("results", {}).get(stage)
+        if baseline_result is None:
+            continue
+        ratio = result["medianMs"] / baseline_result["medianMs"] if baseline_result["medianMs"] > 0 else 1.0
+        comparison[stage] = {
+            "baselineMedianMs": baseline_result["medianMs"],
+            "medianMs": result["medianMs"],
+            "ratio": round(ratio, 3),
+            "regression": ratio > 1 + max_regression,
+        }
+    if report.get("parameters") != baseline.get("parameters") or report.get("seed") != baseline.get("seed"):
+        logger.warning('The baseline was measured on a different input')
+    if report.get("environment") != baseline.get("environment"):
+        logger.warning('The baseline was measured on a different environment')
+    return comparison
+
+
+def format_report(report: dict):
+    """A table of the results (and the comparison with the baseline, if any)"""
+    comparison = report.get("comparison", {})
+    lines = [f'{"stage":<40}{"median ms":>12}{"min ms":>12}{"baseline":>12}{"ratio":>8}']
+    for stage, result in report["results"].items():
+        line = f'{stage:<40}{result["medianMs"]:>12.3f}{result["minMs"]:>12.3f}'
+        if stage in comparison:
+            line += f'{comparison[stage]["baselineMedianMs"]:>12.3f}{comparison[stage]["ratio"]:>8.2f}'
+            if comparison[stage]["regression"]:
+                line += '  REGRESSION'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def add_arguments(parser):
+    parser.add_argument('--app', dest='apps', action='append',
+                        help='an app to benchmark, as "module:attribute" (repeatable; default: the example apps)')
+    parser.add_argument('--extras', action='store_true',
+                        help='also benchmark the spacy and stanza example apps (see example_apps/extras)')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs of each stage (default 20)')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed runs of each stage first (default 2)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated ContainerGroup (default 0)')
+    for name, default in DEFAULT_PARAMETERS.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', dest=name, type=type(default), default=default,
+                            help=f'see generator.py (default {default})')
+    parser.add_argument('--out', help='write the results (json) to this file')
+    parser.add_argument('--baseline', help='compare the results with those of an earlier run (json)')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='exit with status 1 if a stage\'s median is this much slower than the baseline\'s '
+                             '(default 0.2, i.e., 20%%)')
+
+
+def run(args):
+    """Run the benchmarks given the command line arguments. :return: the exit status"""
+    apps = list(args.apps or DEFAULT_APPS)
+    if args.extras:
+        apps.extend(EXTRA_APPS)
+    report = run_benchmarks(apps, args.repeat, args.warmup, args.seed,
+                            **{name: getattr(args, name) for name in DEFAULT_PARAMETERS})
+    status = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f), args.max_regression)
+        if any(stage["regression"] for stage in report["comparison"].values()):
+            status = 1
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(format_report(report))
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m acd_annotator_python.benchmarks',
+                                     description='Time each stage of processing generated ContainerGroups')
+    add_arguments(parser)
+    logging.basicConfig(level=logging.WARNING)
+    # not the defaults of every setting each time an app is built
+    logging.getLogger('acd_annotator_python.service_utils').setLevel(logging.ERROR)
+    sys.exit(run(parser.parse_args(argv)))
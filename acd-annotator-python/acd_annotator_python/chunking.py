@@ -0,0 +1,226 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+Framework-managed chunking of long unstructured containers, for annotators that opt in by setting
+ACDAnnotator.chunk_size. The text is split into chunks of at most chunk_size characters, preferably
+at paragraph or sentence boundaries, with chunk_overlap characters of overlap between neighbours.
+Each chunk gets the input annotations that lie within it (with offsets relative to the chunk),
+the chunks are annotated concurrently, and the results are merged back into the original container:
+
+    - annotations (items of data lists that have begin/end spans) get their offsets rebased. An annotation
+      found in the overlap of two chunks is kept from just one of them: the chunk that owns its begin offset
+      (each owns up to the middle of its overlaps), or the first chunk that contains it whole, if that one
+      doesn't. Input annotations that don't fit in any chunk are passed through.
+    - data list items without spans are deduplicated.
+    - other data fields are taken from the first chunk.
+"""
+
+import asyncio
+import copy
+import json
+import re
+
+from acd_annotator_python import container_utils
+from acd_annotator_python.container_model.common import LazyModelACD
+from acd_annotator_python.container_model.main import UnstructuredContainer, UnstructuredContainerData
+from acd_annotator_python.container_utils import ValidationLevel
+
+# break points to end chunks at, best first: paragraphs, sentences, then any whitespace
+_BREAK_PATTERNS = (re.compile(r'\n\s*\n'), re.compile(r'[.!?]\s+|\n'), re.compile(r'\s+'))
+
+
+def _last_break(text, lo, hi):
+    """The position after the last (best) break in text[lo:hi], or hi if there is none"""
+    for pattern in _BREAK_PATTERNS:
+        last = None
+        for match in pattern.finditer(text, lo, hi):
+            last = match
+        if last is not None:
+            return last.end()
+    return hi
+
+
+def _first_break(text, lo, hi):
+    """The position after the first (best) break in text[lo:hi] that comes before hi, or lo if there is none"""
+    for pattern in _BREAK_PATTERNS[1:]:
+        match = pattern.search(text, lo, hi)
+        if match is not None and match.end() < hi:
+            return match.end()
+    return lo
+
+
+def find_chunk_spans(text: str, chunk_size: int, chunk_overlap: int = 0):
+    """
+    Split text into overlapping chunks of at most chunk_size characters.
+    :return: a list of (begin, end) python offsets
+    """
+    # keep the overlap small enough that every chunk makes progress
+    chunk_overlap = max(0, min(chunk_overlap, chunk_size // 4))
+    spans = []
+    begin = 0
+    while len(text) - begin > chunk_size:
+        # end at the best break in the second half of the chunk
+        end = _last_break(text, begin + chunk_size // 2, begin + chunk_size)
+        spans.append((begin, end))
+        # start the next chunk at a break about chunk_overlap characters back
+        begin = _first_break(text, end - chunk_overlap, end) if chunk_overlap else end
+    spans.append((begin, len(text)))
+    return spans
+
+
+def _get_extent(field, item):
+    """The (begin, end) covered by the spans within a data list item, or None if it has no spans"""
+    begins = []
+    ends = []
+    for span in container_utils.iter_span_dicts({field: [item]}, UnstructuredContainerData):
+        if isinstance(span.get('begin'), int):
+            begins.append(span['begin'])
+        if isinstance(span.get('end'), int):
+            ends.append(span['end'])
+    if not begins or not ends:
+        return None
+    return min(begins), max(ends)
+
+
+def _shift(field, item, delta):
+    for span in container_utils.iter_span_dicts({field: [item]}, UnstructuredContainerData):
+        for key in ('begin', 'end'):
+            if isinstance(span.get(key), int):
+                span[key] += delta
+
+
+class ChunkPlan:
+    """How a container's text is split into chunks, and which chunk each span is taken from"""
+
+    def __init__(self, spans):
+        self.spans = spans
+        self.text_length = spans[-1][1]
+        # each chunk owns the text up to the middle of its overlaps with its neighbours
+        self.owned_begins = [0] + [(previous_end + begin) // 2
+                                   for (_, previous_end), (begin, _) in zip(spans, spans[1:])]
+
+    def get_containing_chunks(self, begin, end):
+        return [i for i, (chunk_begin, chunk_end) in enumerate(self.spans) if chunk_begin <= begin and end <= chunk_end]
+
+    def holds_whole(self, i, begin, end):
+        """
+        Does chunk i hold an annotation covering begin-end whole? One that ends right at the chunk's cut
+        (other than at the end of the text) may have been cut off by it.
+        """
+        chunk_begin, chunk_end = self.spans[i]
+        return chunk_begin <= begin and (end < chunk_end or end == chunk_end == self.text_length)
+
+    def get_preferred_chunk(self, begin, end):
+        """The chunk an annotation covering begin-end is taken from (None if no chunk contains it)"""
+        owner = max(i for i, owned_begin in enumerate(self.owned_begins) if owned_begin <= begin)
+        if self.holds_whole(owner, begin, end):
+            return owner
+        # e.g., the owner only saw a fragment of it. The next chunk saw the whole thing.
+        for i in range(len(self.spans)):
+            if self.holds_whole(i, begin, end):
+                return i
+        containing_chunks = self.get_containing_chunks(begin, end)
+        return containing_chunks[0] if containing_chunks else None
+
+
+def split_container(container_dict: dict, plan: ChunkPlan):
+    """
+    Split an unstructured container dict (python offsets) into one container dict per chunk.
+    :return: (the chunk dicts, the input annotations that fit in no chunk, by data field)
+    """
+    text = container_dict['text']
+    data = container_dict.get('data') or {}
+    chunk_datas = [{} for _ in plan.spans]
+    leftovers = {}
+    for field, value in data.items():
+        if not isinstance(value, list):
+            for chunk_data in chunk_datas:
+                chunk_data[field] = copy.deepcopy(value)
+            continue
+        for chunk_data in chunk_datas:
+            chunk_data[field] = []
+        for item in value:
+            extent = _get_extent(field, item)
+            if extent is None:
+                chunk_indexes = range(len(plan.spans))
+            else:
+                chunk_indexes = plan.get_containing_chunks(*extent)
+                if not chunk_indexes:
+                    leftovers.setdefault(field, []).append(item)
+            for i in chunk_indexes:
+                chunk_item = copy.deepcopy(item)
+                _shift(field, chunk_item, -plan.spans[i][0])
+                chunk_datas[i][field].append(chunk_item)
+    return [{'text': text[begin:end], 'data': chunk_data}
+            for (begin, end), chunk_data in zip(plan.spans, chunk_datas)], leftovers
+
+
+def merge_chunks(container_dict: dict, plan: ChunkPlan, chunk_dicts: list, leftovers: dict):
+    """Merge the annotated chunk dicts (see split_container) back into a copy of the original container dict"""
+    data = {}
+    seen_items = {}
+    for i, chunk_dict in enumerate(chunk_dicts):
+        for field, value in (chunk_dict.get('data') or {}).items():
+            if not isinstance(value, list):
+                data.setdefault(field, value)
+                continue
+            merged = data.setdefault(field, [])
+            if not isinstance(merged, list):
+                continue
+            for item in value:
+                extent = _get_extent(field, item)
+                if extent is None:
+                    key = json.dumps(item, sort_keys=True)
+                    if key not in seen_items.setdefault(field, set()):
+                        seen_items[field].add(key)
+                        merged.append(item)
+                    continue
+                _shift(field, item, plan.spans[i][0])
+                begin, end = extent[0] + plan.spans[i][0], extent[1] + plan.spans[i][0]
+                if plan.get_preferred_chunk(begin, end) == i:
+                    merged.append(item)
+    for field, items in leftovers.items():
+        if isinstance(data.get(field), list):
+            data[field].extend(items)
+        else:
+            data[field] = items
+    merged_dict = dict(container_dict)
+    merged_dict['data'] = data
+    return merged_dict
+
+
+def needs_chunking(annotator, unstructured_container: UnstructuredContainer):
+    """Does the annotator want this container to be annotated in chunks?"""
+    chunk_size = getattr(annotator, 'chunk_size', None)
+    return bool(chunk_size) and isinstance(unstructured_container.text, str) and \
+        len(unstructured_container.text) > chunk_size
+
+
+async def annotate_in_chunks(unstructured_container: UnstructuredContainer, chunk_size: int, chunk_overlap: int,
+                             annotate, validation_level: str = ValidationLevel.full):
+    """
+    Annotate an unstructured container in chunks, altering it in-place.
+    :param annotate: an async function that annotates an UnstructuredContainer in-place
+    :param validation_level: how the chunks get validated (see ValidationLevel), like the whole container would be
+    """
+    container_dict = unstructured_container.dict(exclude_none=True)
+    plan = ChunkPlan(find_chunk_spans(container_dict['text'], chunk_size, chunk_overlap))
+    chunk_dicts, leftovers = split_container(container_dict, plan)
+    # chunk data is validated when the annotator accesses it, unless the input is trusted
+    chunks = [container_utils.container_from_dict(UnstructuredContainer, chunk_dict,
+                                                  validate=validation_level != ValidationLevel.trusted)
+              for chunk_dict in chunk_dicts]
+    await asyncio.gather(*(annotate(chunk) for chunk in chunks))
+    # check whatever was built without validation and touched by the annotator (see validate_output()),
+    # before it is merged into a container that is no longer checked on output
+    for chunk in chunks:
+        if isinstance(chunk.data, LazyModelACD):
+            chunk.data.validate_unchecked_fields()
+    merged_dict = merge_chunks(container_dict, plan, [chunk.dict(exclude_none=True) for chunk in chunks], leftovers)
+    container_utils.replace_container_contents(unstructured_container, merged_dict)
@@ -6,17 +6,25 @@
 #                                                                   #
 # ***************************************************************** #
 
-from pydantic import BaseModel, validator, root_validator, Extra, Field
+import contextlib
+import contextvars
+
+from pydantic import BaseModel, validator, root_validator, Extra, Field, PrivateAttr, ValidationError
 # StrictInt, etc does not attempt to do automatic type casting, e.g., "1" -> 1
 from pydantic import StrictInt, StrictStr
-from pydantic.fields import ModelField
-from typing import Optional, Any, Dict
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.fields import ModelField, SHAPE_LIST, SHAPE_SINGLETON
+from typing import Optional, Any, Dict, Set
 import logging
 
 from acd_annotator_python import container_model
 
 logger = logging.getLogger(__name__)
 
+# bumped whenever add_fields() changes the container model, so anything derived from the
+# model's field definitions (e.g., container_utils.SpanWalkPlan) knows to rebuild itself
+field_definitions_version = 0
+
 
 def normalize_field_names(fields):
     """
@@ -25,6 +33,121 @@ def normalize_field_names(fields):
     return set(s.replace('_','').lower() for s in fields)
 
 
+class FieldNameIndex:
+    """
+    Precomputed field name lookups for one model class, used by BaseModelACD.check_for_misspellings.
+    The same few key shapes show up over and over (every concept in a container tends to have the same keys),
+    so key sets that have already passed the check are remembered and cost a single set lookup afterwards.
+    """
+    # forget remembered key sets past this size so unusual input can't grow this without bound
+    MAX_CHECKED_KEY_SETS = 1024
+
+    def __init__(self, field_names):
+        self.field_names = frozenset(field_names)
+        self.normalized_field_names = normalize_field_names(field_names)
+        self.checked_key_sets = set()
+
+    def find_misspellings(self, keys):
+        """Return the keys that aren't fields but collide with a field after normalization"""
+        key_set = frozenset(keys)
+        if key_set in self.checked_key_sets:
+            return set()
+        # these are all the provided values that don't exactly match a known field
+        non_matches = key_set.difference(self.field_names)
+        # if any non-matches collide with a known field after normalization, they are likely misspellings
+        if non_matches and not normalize_field_names(non_matches).isdisjoint(self.normalized_field_names):
+            return non_matches
+        if len(self.checked_key_sets) >= self.MAX_CHECKED_KEY_SETS:
+            self.checked_key_sets.clear()
+        self.checked_key_sets.add(key_set)
+        return set()
+
+
+class BulkEdit:
+    """
+    Keeps track of the objects edited inside a BaseModelACD.bulk_edit() block,
+    so that each of them can be validated once when the block ends, or restored if that fails.
+    """
+
+    def __init__(self):
+        # id(obj) -> (obj, name of each assigned field -> its snapshot from before the block)
+        self.edits = {}
+
+    def record(self, obj, name):
+        """Record that a field is about to be assigned, remembering its value the first time"""
+        edit = self.edits.get(id(obj))
+        if edit is None:
+            edit = self.edits[id(obj)] = (obj, {})
+        if name not in edit[1]:
+            edit[1][name] = obj._snapshot_field(name)
+
+    def validate(self):
+        """
+        Validate every edited object, raising a pydantic ValidationError on the first invalid one.
+        If any object is invalid, every edit is undone first (see restore()).
+        """
+        validated = []
+        for obj, snapshots in self.edits.values():
+            try:
+                validated.append((obj, self.validate_fields(obj, snapshots)))
+            except ValidationError:
+                self.restore()
+                raise
+        # keep any conversions validation made (as validate_assignment would)
+        for obj, values in validated:
+            obj.__dict__.update(values)
+
+    @staticmethod
+    def validate_fields(obj, names):
+        """
+        Validate the named (edited) fields of obj the way validate_assignment validates an assignment:
+        only those fields, plus the root validators, so an object with thousands of annotations in
+        some other field doesn't get all of them revalidated. Returns the validated values of obj.
+        """
+        cls = type(obj)
+        values = dict(obj.__dict__)
+        for validator in cls.__pre_root_validators__:
+            try:
+                values = validator(cls, values)
+            except (ValueError, TypeError, AssertionError) as exc:
+                raise ValidationError([ErrorWrapper(exc, loc='__root__')], cls)
+        errors = []
+        for name in names:
+            field = cls.__fields__.get(name)
+            if field is None or name not in values:
+                continue
+            values_without_field = {k: v for k, v in values.items() if k != name}
+            value, error = field.validate(values[name], values_without_field, loc=name, cls=cls)
+            if error:
+                errors.append(error)
+            else:
+                values[name] = value
+        for skip_on_failure, validator in cls.__post_root_validators__:
+            if skip_on_failure and errors:
+                continue
+            try:
+                values = validator(cls, values)
+            except (ValueError, TypeError, AssertionError) as exc:
+                errors.append(ErrorWrapper(exc, loc='__root__'))
+        if errors:
+            raise ValidationError(errors, cls)
+        return values
+
+    def restore(self):
+        """Put every edited field back the way it was before the block"""
+        for obj, snapshots in self.edits.values():
+            for name, snapshot in snapshots.items():
+                obj._restore_field(name, snapshot)
+
+
+# stands in for a field that had no value before a bulk edit
+_MISSING = object()
+
+
+# the bulk edit in progress in the current context, if any (acts like a thread local variable)
+bulk_edit_var = contextvars.ContextVar("bulk_edit", default=None)
+
+
 class BaseModelACD(BaseModel):
     """
     Every new object should extend this one directly or indirectly, treating it
@@ -74,7 +197,80 @@ class BaseModelACD(BaseModel):
                                                   class_validators=None, config=cls.__config__)
 
         cls.__fields__.update(new_fields)
-        cls.__annotations__.update(new_annotations)
+        # a class without annotations of its own has no __annotations__ before python 3.10
+        # (or, through inheritance, finds its parent's)
+        annotations = cls.__dict__.get('__annotations__')
+        if annotations is None:
+            annotations = {}
+            setattr(cls, '__annotations__', annotations)
+        annotations.update(new_annotations)
+        # the field names changed, so any precomputed lookups are stale
+        cls._field_name_index = None
+        global field_definitions_version
+        field_definitions_version += 1
+
+    @staticmethod
+    @contextlib.contextmanager
+    def bulk_edit():
+        """
+        Suspend per-assignment validation for every container model object edited inside the block,
+        and validate each edited object once when the block ends instead. This is much faster when
+        making many edits, e.g.:
+
+            with data.bulk_edit():
+                for concept in data.concepts:
+                    concept.begin += 1
+                    concept.end += 1
+
+        Raises pydantic.ValidationError on exit if any edited object is invalid, after undoing every edit
+        made in the block, so no invalid values are left behind. Edits are also undone if the block raises.
+        Nested blocks are validated when the outermost block ends.
+        """
+        if bulk_edit_var.get() is not None:
+            yield
+            return
+        bulk_edit = BulkEdit()
+        token = bulk_edit_var.set(bulk_edit)
+        try:
+            yield
+        except BaseException:
+            bulk_edit.restore()
+            raise
+        finally:
+            bulk_edit_var.reset(token)
+        bulk_edit.validate()
+
+    def __setattr__(self, name, value):
+        bulk_edit = bulk_edit_var.get()
+        if bulk_edit is None or name.startswith('_'):
+            return super().__setattr__(name, value)
+        # inside a bulk edit: assign now, validate later
+        bulk_edit.record(self, name)
+        self.__dict__[name] = value
+        self.__fields_set__.add(name)
+
+    def _snapshot_field(self, name):
+        """Capture a field before a bulk edit assigns it, so _restore_field() can undo the edit"""
+        return self.__dict__.get(name, _MISSING), name in self.__fields_set__
+
+    def _restore_field(self, name, snapshot):
+        value, was_set = snapshot
+        if value is _MISSING:
+            self.__dict__.pop(name, None)
+        else:
+            self.__dict__[name] = value
+        if not was_set:
+            self.__fields_set__.discard(name)
+
+    @classmethod
+    def get_field_name_index(cls) -> FieldNameIndex:
+        """Get the FieldNameIndex for this class, building it the first time it is needed"""
+        # look in this class's own __dict__ so that subclasses (which have their own fields) don't pick up a parent's
+        index = cls.__dict__.get('_field_name_index')
+        if index is None:
+            index = FieldNameIndex(cls.__fields__.keys())
+            cls._field_name_index = index
+        return index
 
     @root_validator(pre=True, skip_on_failure=True)
     def check_for_misspellings(cls, values):
@@ -82,17 +278,9 @@ class BaseModelACD(BaseModel):
         Make sure that we don't allow input that is likely to be a misspelling by
         normalizing text and then checking for collisions (like coveredText vs covered_text).
         """
-        normalized_values = normalize_field_names(values.keys())
-        # these are all the provided values that don't exactly match a known field
-        non_matches = set(values.keys()).difference(cls.__fields__.keys())
-        # if any non-matches collide with a known field after normalization, complain
-        normalized_non_matches = normalize_field_names(non_matches)
-        # normalize the built-in fields (cache these per class so we don't have to re-normalize a bunch of times)
-        if not hasattr(cls, '_normalized_pydantic_fields)'):
-            cls._normalized_pydantic_fields = normalize_field_names(cls.__fields__.keys())
-        collisions = normalized_non_matches.intersection(cls._normalized_pydantic_fields)
-        assert len(collisions) == 0, \
-            f'Misspelling detected: {non_matches} collides with expected field in {list(cls.__fields__.keys())}'
+        misspellings = cls.get_field_name_index().find_misspellings(values.keys())
+        assert len(misspellings) == 0, \
+            f'Misspelling detected: {misspellings} collides with expected field in {list(cls.__fields__.keys())}'
         return values
 
 
@@ -139,3 +327,155 @@ class BaseAnnotation(Entity):
                 else:
                     raise ValueError(error_msg)
         return values
+
+
+class DeferredValidationError(ValidationError):
+    """
+    Raised when a field that was kept raw on input (see LazyModelACD) turns out to be invalid
+    once it is finally materialized. This is still an input problem rather than an annotator
+    problem, so the service reports it the same way it reports up-front input validation failures.
+    """
+    pass
+
+
+def construct_model(model_cls, values: dict):
+    """
+    Build a model object graph from trusted input without running any validation.
+    pydantic's construct() only handles the top level, so nested models are built here field by field.
+    """
+    model = model_cls.construct(**values)
+    for name, field in model_cls.__fields__.items():
+        if name in values:
+            model.__dict__[name] = construct_field_value(field, values[name])
+    return model
+
+
+def construct_field_value(field: ModelField, value):
+    """Convert a raw (json) value into the objects expected by the given field without validating it."""
+    type_ = field.type_
+    if value is None or not (isinstance(type_, type) and issubclass(type_, BaseModel)):
+        return value
+    if field.shape == SHAPE_LIST and isinstance(value, list):
+        return [construct_model(type_, item) if isinstance(item, dict) else item for item in value]
+    if field.shape == SHAPE_SINGLETON and isinstance(value, dict):
+        return construct_model(type_, value)
+    return value
+
+
+class LazyModelACD(BaseModelACD):
+    """
+    A BaseModelACD that can hold some of its fields as raw (json) values and only turn them into
+    pydantic objects the first time they are accessed. Fields that are never touched are passed through
+    to the output unchanged, which saves parsing and validating large annotation lists that an annotator
+    never looks at.
+
+    Objects created normally behave exactly like any other BaseModelACD. Use lazy() to create
+    an object with raw fields.
+    """
+    # field name -> raw value for fields that haven't been materialized yet
+    _raw_fields: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    # whether raw fields are validated when they get materialized
+    _validate_raw_fields: bool = PrivateAttr(default=True)
+    # fields that were materialized without validation
+    _unchecked_fields: Set[str] = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def lazy(cls, values: dict, validate: bool = True):
+        """
+        Create an object whose fields are all kept raw until they are accessed.
+        :param values: the raw values for this object, e.g., unstructured.data from a parsed request
+        :param validate: if True, validate each field when it is materialized. Otherwise build the
+        objects from trusted input without validation.
+        """
+        if validate:
+            # check the keys up front (e.g., for misspellings); the values are checked on access
+            for pre_root_validator in cls.__pre_root_validators__:
+                try:
+                    values = pre_root_validator(cls, values)
+                except (ValueError, TypeError, AssertionError) as exc:
+                    raise ValidationError([ErrorWrapper(exc, loc='__root__')], cls)
+        model = cls.construct()
+        for name in values:
+            model.__dict__.pop(name, None)
+        model._raw_fields = dict(values)
+        model._validate_raw_fields = validate
+        return model
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup fails, so materialized fields never come through here
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            raw_fields = object.__getattribute__(self, '_raw_fields')
+        except AttributeError:
+            raise AttributeError(name)
+        if name not in raw_fields:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        return self._materialize(name, raw_fields.pop(name))
+
+    def _materialize(self, name, value):
+        field = self.__fields__.get(name)
+        if field is not None:
+            if self._validate_raw_fields:
+                value, error = field.validate(value, self.__dict__, loc=name, cls=type(self))
+                if error:
+                    raise DeferredValidationError([error], type(self))
+            else:
+                value = construct_field_value(field, value)
+                self._unchecked_fields.add(name)
+        self.__dict__[name] = value
+        self.__fields_set__.add(name)
+        return value
+
+    def __setattr__(self, name, value):
+        # assign first, so a raw value is only dropped once it has been replaced (and a bulk edit can snapshot it)
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            self._raw_fields.pop(name, None)
+
+    def _snapshot_field(self, name):
+        return super()._snapshot_field(name), self._raw_fields.get(name, _MISSING)
+
+    def _restore_field(self, name, snapshot):
+        snapshot, raw_value = snapshot
+        super()._restore_field(name, snapshot)
+        if raw_value is not _MISSING:
+            self._raw_fields[name] = raw_value
+
+    def __delattr__(self, name):
+        if name in self._raw_fields:
+            del self._raw_fields[name]
+        else:
+            super().__delattr__(name)
+
+    def materialize(self):
+        """Turn any remaining raw fields into pydantic objects."""
+        for name in list(self._raw_fields):
+            getattr(self, name)
+
+    def validate_unchecked_fields(self):
+        """
+        Validate any fields that were materialized without validation (see lazy(validate=False)).
+        Only the fields that were actually touched are checked. Raises ValidationError.
+        """
+        errors = []
+        for name in sorted(self._unchecked_fields):
+            if name in self.__dict__:
+                plain_value = self.dict(include={name}).get(name)
+                _, error = self.__fields__[name].validate(plain_value, {}, loc=name, cls=type(self))
+                if error:
+                    errors.append(error)
+        if errors:
+            raise ValidationError(errors, type(self))
+        self._unchecked_fields.clear()
+
+    def dict(self, **kwargs):
+        """Same as BaseModel.dict(), with any untouched raw fields spliced back in as-is."""
+        result = super().dict(**kwargs)
+        if self._raw_fields and kwargs.get('include') is None:
+            exclude = kwargs.get('exclude') or ()
+            for name, value in self._raw_fields.items():
+                if name in exclude or (value is None and kwargs.get('exclude_none')):
+                    continue
+                result[name] = value
+        return result
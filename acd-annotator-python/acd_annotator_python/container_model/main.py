@@ -6,13 +6,13 @@
 #                                                                   #
 # ***************************************************************** #
 
-from pydantic import BaseModel, validator, root_validator, Extra
+from pydantic import BaseModel, validator, root_validator, Extra, PrivateAttr
 # StrictInt, etc does not attempt to do automatic type casting, e.g., "1" -> 1
 from pydantic import StrictInt, StrictStr, StrictBool, StrictFloat
 from pydantic.fields import ModelField
 from typing import List, Optional, Any, Dict
 
-from acd_annotator_python.container_model.common import BaseModelACD, BaseAnnotation, Entity
+from acd_annotator_python.container_model.common import BaseModelACD, BaseAnnotation, Entity, LazyModelACD
 from acd_annotator_python.container_model.clinical_insights import InsightModelData, TemporalData
 from acd_annotator_python.container_model.annotations import Annotation
 from acd_annotator_python.container_model.annotations import Concept
@@ -31,7 +31,7 @@ from acd_annotator_python.container_model.annotations import SpellingCorrection
 from acd_annotator_python.container_model.annotations import SpellCorrectedText
 
 
-class UnstructuredContainerData(BaseModelACD):
+class UnstructuredContainerData(LazyModelACD):
 
     # mature annotators
     attributeValues: Optional[List[AttributeValue]]
@@ -70,7 +70,7 @@ class UnstructuredContainerData(BaseModelACD):
     ToiletingAssistanceInd: Optional[List[Annotation]]
     WalkingAssistanceInd: Optional[List[Annotation]]
 
-class StructuredContainerData(BaseModelACD):
+class StructuredContainerData(LazyModelACD):
     attributeMetadata: Optional[List[BaseModelACD]]
 
 class Container(BaseModelACD):
@@ -84,6 +84,21 @@ class UnstructuredContainer(Container):
     data: Optional[UnstructuredContainerData]
     text: StrictStr
 
+    # the container_utils.OffsetMap computed for this container's text when the request was parsed
+    _offset_map: Any = PrivateAttr(default=None)
+
+    @property
+    def offset_map(self):
+        """
+        A container_utils.OffsetMap that converts between java and python character offsets into this
+        container's text. The map built while parsing the request is reused when possible.
+        """
+        # imported here since container_utils depends on this module
+        from acd_annotator_python.container_utils import OffsetMap
+        if self._offset_map is None or not self._offset_map.matches(self.text):
+            self._offset_map = OffsetMap(self.text)
+        return self._offset_map
+
 class StructuredContainer(Container):
     data: Optional[StructuredContainerData]
 
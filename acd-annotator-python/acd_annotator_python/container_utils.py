@@ -6,13 +6,36 @@
 #                                                                   #
 # ***************************************************************** #
 
+import bisect
+import functools
 import re
 import json
 
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+
 import acd_annotator_python.container_model.main as acd_datamodel
+import acd_annotator_python.container_model.common as container_model_common
+from acd_annotator_python import preconditions
+
+
+class ValidationLevel:
+    """
+    How much of an incoming ContainerGroup is validated when it is parsed
+    """
+    # validate the whole container group up front
+    full = 'full'
+    # validate the container group and containers up front, but keep everything in container.data
+    # as raw json until an annotator accesses it (at which point it gets validated)
+    shallow = 'shallow'
+    # no input validation. Objects are built on access without validation, and only the
+    # parts of container.data that an annotator accessed are validated on output.
+    trusted = 'trusted'
+
+    all = (full, shallow, trusted)
 
 
-def java2python(container_group_dict: dict):
+def java2python(container_group_dict: dict, offset_maps: list = None):
     """
     Java reports offsets slightly differently from Python in cases where
     there are high code point unicode characters.
@@ -30,12 +53,14 @@ def java2python(container_group_dict: dict):
     to python-centric spans.
 
     :param container_group_dict:
+    :param offset_maps: optional OffsetMaps for the unstructured containers (see compute_offset_maps).
+    If not given, they are computed from the container text.
     :return:
     """
-    return span_conversion_helper(container_group_dict, additive_adjustments=False)
+    return span_conversion_helper(container_group_dict, additive_adjustments=False, offset_maps=offset_maps)
 
 
-def python2java(container_group_dict: dict):
+def python2java(container_group_dict: dict, offset_maps: list = None):
     """
     Java reports offsets slightly differently from Python in cases where
     there are high code point unicode characters.
@@ -53,9 +78,11 @@ def python2java(container_group_dict: dict):
     to java-centric spans (returned by most ACD annotators).
 
     :param container_group_dict:
+    :param offset_maps: optional OffsetMaps for the unstructured containers, e.g., the ones computed when the
+    input was converted. Any map whose text no longer matches its container is recomputed.
     :return:
     """
-    return span_conversion_helper(container_group_dict, additive_adjustments=True)
+    return span_conversion_helper(container_group_dict, additive_adjustments=True, offset_maps=offset_maps)
 
 
 # this regex finds any characters between \u10000 - \u10ffff, which java will encode as len()==2
@@ -63,9 +90,84 @@ def python2java(container_group_dict: dict):
 unicode_surrogate_pair_regex = re.compile('[{}-{}]'.format(chr(0x10000), chr(0x10ffff)))
 
 
+class OffsetMap:
+    """
+    Converts character offsets into a document's text between java offsets (where characters between
+    \u10000 - \u10ffff count as two characters) and python offsets (where they count as one).
+
+    Given text that looks like this:
+            the_cow_?_jumped_
+    Java       3   7 11     17
+    python     3   7 10     16
+
+    java_to_python(11) == 10 and python_to_java(10) == 11.
+
+    Only the positions of surrogate pairs are stored, so memory is O(#surrogate pairs) and each
+    conversion is a binary search. An OffsetMap is built once per document and can be reused for
+    both directions.
+    """
+
+    def __init__(self, text: str):
+        # keep a reference to the text so we can tell whether this map still applies to a container
+        self.text = text
+        # python offset of each surrogate pair character
+        self.surrogate_pair_python_offsets = [match.start() for match in unicode_surrogate_pair_regex.finditer(text)]
+        # java offset of the second half of each surrogate pair. Every pair before the i-th one adds
+        # an extra java character, so the i-th pair at python offset p starts at java offset p + i.
+        self.second_half_java_offsets = [offset + i + 1 for i, offset in enumerate(self.surrogate_pair_python_offsets)]
+
+    @property
+    def has_surrogate_pairs(self):
+        """If there are no surrogate pairs, java and python offsets are the same"""
+        return len(self.surrogate_pair_python_offsets) > 0
+
+    @property
+    def java_length(self):
+        """The length of the text as java would report it"""
+        return len(self.text) + len(self.surrogate_pair_python_offsets)
+
+    def matches(self, text: str):
+        """Does this map apply to the given text?"""
+        return text is self.text or text == self.text
+
+    def java_to_python(self, java_offset: int):
+        """Convert a java offset into the text to a python offset"""
+        return java_offset - bisect.bisect_right(self.second_half_java_offsets, java_offset)
+
+    def python_to_java(self, python_offset: int):
+        """Convert a python offset into the text to a java offset"""
+        return python_offset + bisect.bisect_left(self.surrogate_pair_python_offsets, python_offset)
+
+
+class SparseAlignment:
+    """
+    A read-only, list-like view of the java -> python character alignment described in
+    compute_java_to_python_character_alignment(). alignment[i] is the number of surrogate pairs
+    that precede java character i (counting the second half of a pair as preceded by it).
+    """
+
+    def __init__(self, offset_map: OffsetMap):
+        self.offset_map = offset_map
+        self.length = offset_map.java_length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, java_offset: int):
+        if java_offset < 0:
+            java_offset += self.length
+        if not 0 <= java_offset < self.length:
+            raise IndexError('alignment index out of range')
+        return java_offset - self.offset_map.java_to_python(java_offset)
+
+    def __iter__(self):
+        return (self[i] for i in range(self.length))
+
+
 def compute_java_to_python_character_alignment(text: str):
     """
-    Constructs a list that adjusts alignment between the Java character count and the python character count.
+    Constructs a list-like SparseAlignment that adjusts alignment between the Java character count
+    and the python character count.
 
     Given text that looks like this:
             the_cow_?_jumped_
@@ -90,65 +192,151 @@ def compute_java_to_python_character_alignment(text: str):
     """
     if text is None:
         return None
-    java2python_alignment = []
-    previous_start = 0
-    num_preceding_surrogate_pairs = 0
-    for match in unicode_surrogate_pair_regex.finditer(text):
-        # add the chunk from the previous position up to but not including ourselves
-        chars_since_previous_match = match.start() - previous_start
-        java2python_alignment.extend([num_preceding_surrogate_pairs] * chars_since_previous_match)
-        # now add one additional character because this is where java double-count surrogate pairs
-        # this corresponds to the first character of the surrogate pair.
-        java2python_alignment.append(num_preceding_surrogate_pairs)
-        # now increment the number of surrogate pairs we've seen and update our start position
-        # so we'll be ready to add the next chunk
-        num_preceding_surrogate_pairs += 1
-        previous_start = match.start()
-    # finish off the last chunk
-    chars_since_previous_match = len(text) - previous_start
-    java2python_alignment.extend([num_preceding_surrogate_pairs] * chars_since_previous_match)
-    return java2python_alignment
-
-
-def update_spans(adict: dict, java2py_alignment: list, additive_adjustments: bool):
-    """adjust begin/end spans either upwards (if additive_adjustments is True)
-      of downwards (if additive_adjustments is False) according to how many
-      surrogate pairs preceded it in the text."""
-    # recurse (this isn't protected against backlinks, etc, but if we just call this on
-    # container groups parsed from json that's fine)
-    for k, v in adict.items():
-        if isinstance(v, dict):
-            update_spans(v, java2py_alignment, additive_adjustments)
-        elif isinstance(v, list):
-            for item in v:
-                update_spans(item, java2py_alignment, additive_adjustments)
-    # update any begin/end in current dictionary
-    if 'begin' in adict:
-        # compute span adjustments, default to the last if the index is off the back edge of the container.
-        try:
-            begin = int(adict['begin'])
-            begin_adjustment = java2py_alignment[begin] if begin < len(java2py_alignment) else java2py_alignment[-1]
-            # apply the adjustments
-            if additive_adjustments:
-                adict['begin'] = begin + begin_adjustment
-            else:
-                adict['begin'] = begin - begin_adjustment
-        except ValueError:
-            pass  # there's a begin that isn't an int value. That seems weird, but we'll wait and let validation explode
-    if 'end' in adict:
-        try:
-            end = int(adict['end'])
-            end_adjustment = java2py_alignment[end] if end < len(java2py_alignment) else java2py_alignment[-1]
-            # apply the adjustments
-            if additive_adjustments:
-                adict['end'] = end + end_adjustment
-            else:
-                adict['end'] = end - end_adjustment
-        except ValueError:
-            pass  # there's a begin that isn't an int value. That seems weird, but we'll wait and let validation explode
+    return SparseAlignment(OffsetMap(text))
+
+
+def compute_offset_maps(container_group_dict: dict):
+    """
+    Build an OffsetMap for each unstructured container in a container group dict
+    (None for containers without text).
+    """
+    offset_maps = []
+    if isinstance(container_group_dict, dict):
+        for unstructured_container in container_group_dict.get('unstructured') or []:
+            text = unstructured_container.get('text') if isinstance(unstructured_container, dict) else None
+            offset_maps.append(OffsetMap(text) if isinstance(text, str) else None)
+    return offset_maps
 
 
-def span_conversion_helper(container_group_dict, additive_adjustments: bool, mutate_inplace=True):
+def attach_offset_maps(container_group, offset_maps: list):
+    """
+    Attach the OffsetMaps computed for the input to the parsed UnstructuredContainers,
+    so annotators can use them (see UnstructuredContainer.offset_map).
+    """
+    for unstructured_container, offset_map in zip(container_group.unstructured or [], offset_maps):
+        if offset_map is not None and isinstance(unstructured_container, acd_datamodel.UnstructuredContainer):
+            unstructured_container._offset_map = offset_map
+
+
+class SpanWalkPlan:
+    """
+    Which parts of a container model object can hold begin/end spans, precompiled from the
+    pydantic model definition. Known fields that can never hold spans (e.g., insightModelData
+    score trees) are skipped entirely, along with anything below them. Unknown fields (extras that
+    aren't part of the model) of objects that are visited could hold anything, so they are searched exhaustively.
+    """
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        # does this object itself have begin/end?
+        self.has_span = 'begin' in model_cls.__fields__ or 'end' in model_cls.__fields__
+        self.field_names = frozenset(model_cls.__fields__)
+        # field name -> SpanWalkPlan (None means search exhaustively) for fields that might hold spans
+        self.children = {}
+
+
+# field types that can't hold spans
+_SCALAR_TYPES = (str, bytes, int, float, bool)
+
+# model class -> SpanWalkPlan, valid for the given common.field_definitions_version
+_span_walk_plans = {}
+_span_walk_plans_version = None
+
+
+def get_span_walk_plan(model_cls):
+    """Get the (cached) SpanWalkPlan for a container model class"""
+    global _span_walk_plans_version
+    if _span_walk_plans_version != container_model_common.field_definitions_version:
+        _span_walk_plans.clear()
+        _span_walk_plans_version = container_model_common.field_definitions_version
+    if model_cls not in _span_walk_plans:
+        _span_walk_plans[model_cls] = _compile_span_walk_plan(model_cls, {})
+    return _span_walk_plans[model_cls]
+
+
+def _compile_span_walk_plan(model_cls, plans: dict):
+    """Build the plan for model_cls. Returns None if model_cls can never hold spans."""
+    if model_cls in plans:
+        # already being compiled further up (a recursive model). Assume it can hold spans.
+        return plans[model_cls]
+    plan = SpanWalkPlan(model_cls)
+    plans[model_cls] = plan
+    for name, field in model_cls.__fields__.items():
+        type_ = field.type_
+        if isinstance(type_, type) and issubclass(type_, _SCALAR_TYPES):
+            # no spans in here, whatever the shape (e.g., List[str] or Dict[str, float])
+            continue
+        if field.shape in (SHAPE_SINGLETON, SHAPE_LIST) and isinstance(type_, type) and issubclass(type_, BaseModel):
+            child_plan = _compile_span_walk_plan(type_, plans)
+            if child_plan is not None:
+                plan.children[name] = child_plan
+        else:
+            # anything else (Any, dict, List[dict], Union[A, B], Dict[str, Model], ...) could hold spans anywhere
+            plan.children[name] = None
+    if not plan.has_span and not plan.children:
+        del plans[model_cls]
+        return None
+    return plan
+
+
+def iter_span_dicts(adict, model_cls=None):
+    """
+    Yield the dicts within adict (a dict or list) that hold begin/end spans.
+
+    If model_cls is given, only the parts of adict that can hold spans according to
+    that model are visited (see SpanWalkPlan). Otherwise everything is searched."""
+    # walk iteratively rather than recursively so deeply nested input can't hit the recursion limit.
+    # (this isn't protected against backlinks, etc, but if we just call this on
+    # container groups parsed from json that's fine)
+    plan = None
+    if model_cls is not None:
+        plan = get_span_walk_plan(model_cls)
+        if plan is None:
+            return  # nothing in this model can hold spans
+    stack = [(adict, plan)]
+    while stack:
+        value, plan = stack.pop()
+        if isinstance(value, list):
+            stack.extend((item, plan) for item in value if isinstance(item, (dict, list)))
+            continue
+        if not isinstance(value, dict):
+            continue
+        if plan is None:
+            # no plan: search everything
+            stack.extend((v, None) for v in value.values() if isinstance(v, (dict, list)))
+        else:
+            for k, v in value.items():
+                if k in plan.children:
+                    if isinstance(v, (dict, list)):
+                        stack.append((v, plan.children[k]))
+                elif k not in plan.field_names and isinstance(v, (dict, list)):
+                    # an unknown field could hold anything
+                    stack.append((v, None))
+            if not plan.has_span:
+                continue
+        if 'begin' in value or 'end' in value:
+            yield value
+
+
+def update_spans(adict: dict, offset_map: OffsetMap, additive_adjustments: bool, model_cls=None):
+    """adjust begin/end spans either upwards (if additive_adjustments is True)
+      of downwards (if additive_adjustments is False) according to how many
+      surrogate pairs preceded it in the text.
+
+      If model_cls is given, only the parts of adict that can hold spans according to
+      that model are visited (see SpanWalkPlan). Otherwise everything is searched."""
+    convert = offset_map.python_to_java if additive_adjustments else offset_map.java_to_python
+    for value in iter_span_dicts(adict, model_cls):
+        # update any begin/end in current dictionary
+        for key in ('begin', 'end'):
+            if key in value:
+                try:
+                    value[key] = convert(int(value[key]))
+                except (ValueError, TypeError):
+                    pass  # a begin/end that isn't an int value. That seems weird, but we'll wait and let validation explode
+
+
+def span_conversion_helper(container_group_dict, additive_adjustments: bool, mutate_inplace=True, offset_maps=None):
     """adjust begin/end spans either upwards (if additive_adjustments is True)
       of downwards (if additive_adjustments is False) according to how many
       surrogate pairs preceded it in the text."""
@@ -158,26 +346,184 @@ def span_conversion_helper(container_group_dict, additive_adjustments: bool, mut
     if not mutate_inplace:
         container_group_dict = json.loads(json.dumps(container_group_dict))
     if 'unstructured' in container_group_dict:
-        for unstructured_container in container_group_dict['unstructured']:
+        for i, unstructured_container in enumerate(container_group_dict['unstructured']):
             # each unstructured container has text, data
             if unstructured_container is not None:
                 if 'data' in unstructured_container and 'text' in unstructured_container:
                     data = unstructured_container['data']
                     text = unstructured_container['text']
+                    if not isinstance(text, str):
+                        continue  # let validation complain about this
+                    # reuse an existing map if it still applies to this text
+                    offset_map = offset_maps[i] if offset_maps is not None and i < len(offset_maps) else None
+                    if offset_map is None or not offset_map.matches(text):
+                        offset_map = OffsetMap(text)
                     # only proceed if there are surrogate pairs in the doc. Otherwise, nothing to do.
-                    if bool(unicode_surrogate_pair_regex.search(text)):
-                        # yes, computing the alignment runs the regex a second time, but the search above is
-                        # significantly faster (.4 secs for 1M iters over a word vs .6 secs), so it's worth doing
-                        # it up front and then following up with this given that most docs won't have these kinds
-                        # of characters.
-                        java2python_alignment = compute_java_to_python_character_alignment(text)
-                        update_spans(data, java2python_alignment, additive_adjustments)
+                    if offset_map.has_surrogate_pairs:
+                        update_spans(data, offset_map, additive_adjustments,
+                                     model_cls=acd_datamodel.UnstructuredContainerData)
     return container_group_dict
 
 
-def from_dict(container_group_dict):
-    """Create an object from from a dictionary"""
-    return acd_datamodel.ContainerGroup(**container_group_dict)
+def split_passthrough_fields(container_group_dict: dict, unstructured_fields=None, structured_fields=None):
+    """
+    Remove the container.data entries that are not in unstructured_fields/structured_fields
+    from a container group dict (in-place), so they can be passed through untouched and spliced back
+    into the response with merge_passthrough_fields().
+
+    :param container_group_dict:
+    :param unstructured_fields: names of the unstructured container data fields to keep. None keeps all of them.
+    :param structured_fields: names of the structured container data fields to keep. None keeps all of them.
+    :return: the removed entries, e.g., {'unstructured': [{'concepts': [...]}, ...], 'structured': [...]}
+    """
+    passthrough = {}
+    if not isinstance(container_group_dict, dict):
+        return passthrough
+    for key, keep_fields in (('unstructured', unstructured_fields), ('structured', structured_fields)):
+        containers = container_group_dict.get(key)
+        if keep_fields is None or not isinstance(containers, list):
+            continue
+        keep_fields = set(keep_fields)
+        removed_per_container = []
+        for container in containers:
+            removed = {}
+            data = container.get('data') if isinstance(container, dict) else None
+            if isinstance(data, dict):
+                for name in [name for name in data if name not in keep_fields]:
+                    removed[name] = data.pop(name)
+            removed_per_container.append(removed)
+        passthrough[key] = removed_per_container
+    return passthrough
+
+
+def split_gated_containers(container_group_dict: dict, unstructured_preconditions=(), structured_preconditions=()):
+    """
+    Remove the containers that fail the given preconditions (see preconditions.py) from a container group dict
+    (in-place), so they can be passed through untouched and put back into the response with merge_gated_containers().
+
+    :param container_group_dict:
+    :param unstructured_preconditions: functions taking an unstructured container dict and returning a bool
+    :param structured_preconditions: functions taking a structured container dict and returning a bool
+    :return: the removed containers and their positions, e.g., {'unstructured': [(2, {...}), ...]}
+    """
+    gated = {}
+    if not isinstance(container_group_dict, dict):
+        return gated
+    for key, container_preconditions in (('unstructured', unstructured_preconditions),
+                                         ('structured', structured_preconditions)):
+        containers = container_group_dict.get(key)
+        if not container_preconditions or not isinstance(containers, list):
+            continue
+        kept = []
+        removed = []
+        for i, container in enumerate(containers):
+            # leave anything that isn't a container for validation to complain about
+            if isinstance(container, dict) and not preconditions.check_all(container_preconditions, container):
+                removed.append((i, container))
+            else:
+                kept.append(container)
+        if removed:
+            container_group_dict[key] = kept
+            gated[key] = removed
+    return gated
+
+
+def merge_gated_containers(container_group_dict: dict, gated: dict):
+    """Put the containers removed by split_gated_containers() back into a container group dict, in-place."""
+    for key, removed in gated.items():
+        containers = container_group_dict.get(key) or []
+        for i, container in removed:
+            containers.insert(i, container)
+        container_group_dict[key] = containers
+    return container_group_dict
+
+
+def merge_passthrough_fields(container_group_dict: dict, passthrough: dict):
+    """
+    Splice the entries removed by split_passthrough_fields() back into a container group dict (in-place).
+    Containers are matched up by position.
+    """
+    for key, removed_per_container in passthrough.items():
+        containers = container_group_dict.get(key) or []
+        for container, removed in zip(containers, removed_per_container):
+            if removed and isinstance(container, dict):
+                data = container.setdefault('data', {})
+                for name, value in removed.items():
+                    data.setdefault(name, value)
+    return container_group_dict
+
+
+def from_dict(container_group_dict, validation_level: str = ValidationLevel.full):
+    """
+    Create an object from from a dictionary
+    :param container_group_dict:
+    :param validation_level: one of the ValidationLevel values
+    :return:
+    """
+    if validation_level == ValidationLevel.full:
+        return acd_datamodel.ContainerGroup(**container_group_dict)
+    if validation_level not in ValidationLevel.all:
+        raise ValueError(f'Unknown validation level "{validation_level}". Expected one of {ValidationLevel.all}')
+    validate = validation_level == ValidationLevel.shallow
+    container_group_dict = dict(container_group_dict)
+    for key, container_cls in (('unstructured', acd_datamodel.UnstructuredContainer),
+                               ('structured', acd_datamodel.StructuredContainer)):
+        containers = container_group_dict.get(key)
+        # anything that isn't a list is left alone so that validation (if any) can complain about it
+        if isinstance(containers, list):
+            container_group_dict[key] = [container_from_dict(container_cls, container, validate)
+                                         if isinstance(container, dict) else container
+                                         for container in containers]
+    if validate:
+        return acd_datamodel.ContainerGroup(**container_group_dict)
+    return acd_datamodel.ContainerGroup.construct(**container_group_dict)
+
+
+def container_from_dict(container_cls, container_dict: dict, validate: bool):
+    """
+    Create an UnstructuredContainer/StructuredContainer whose data is kept raw until it is accessed
+    (see LazyModelACD). If validate is False, nothing is validated until output (see ValidationLevel.trusted).
+    """
+    container_dict = dict(container_dict)
+    data = container_dict.get('data')
+    if isinstance(data, dict):
+        data_cls = container_cls.__fields__['data'].type_
+        container_dict['data'] = data_cls.lazy(data, validate=validate)
+    if validate:
+        return container_cls(**container_dict)
+    return container_cls.construct(**container_dict)
+
+
+def replace_container_contents(container, container_dict: dict):
+    """
+    Replace everything in a container with the contents of container_dict (e.g., a copy of the container
+    that was annotated elsewhere) without validating it, keeping the container object itself
+    so that any references to it stay valid.
+    """
+    new_container = container_from_dict(type(container), container_dict, validate=False)
+    object.__setattr__(container, '__dict__', new_container.__dict__)
+    object.__setattr__(container, '__fields_set__', new_container.__fields_set__)
+
+
+def validate_output(container_group):
+    """
+    Validate the parts of a container group that were built without validation
+    (see ValidationLevel.trusted). Raises a pydantic ValidationError.
+    """
+    for containers in (container_group.unstructured, container_group.structured):
+        for container in containers or []:
+            data = getattr(container, 'data', None)
+            if isinstance(data, acd_datamodel.LazyModelACD):
+                data.validate_unchecked_fields()
+
+
+@functools.lru_cache(maxsize=None)
+def get_container_group_schema_json():
+    """
+    The json schema for ContainerGroup. The container model is large, so the schema is only
+    generated once. Any add_fields() calls should happen before this is first called.
+    """
+    return acd_datamodel.ContainerGroup.schema_json()
 
 
 def create_unstructured_container():
@@ -6,17 +6,33 @@
 #                                                                   #
 # ***************************************************************** #
 
+import asyncio
+import contextlib
+import functools
 import json
 import logging
 import logging.config
 import time
-from fastapi import FastAPI, Body, Request, Response, status
+from fastapi import FastAPI, Body, Query, Request, Response, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
+from starlette.background import BackgroundTask
 from pydantic import ValidationError
 
-from acd_annotator_python.container_model.main import ContainerGroup
+from acd_annotator_python.container_model.common import DeferredValidationError
 from acd_annotator_python import container_utils
+from acd_annotator_python.acd_annotator import ExecutionMode
+from acd_annotator_python.batching import MicroBatcher
+from acd_annotator_python.health import CachedHealthCheck, HealthCheckServer
+from acd_annotator_python.pipeline import AnnotatorPipeline
+from acd_annotator_python.process_pool import AnnotatorProcessPool, get_default_max_workers
+from acd_annotator_python import result_cache
+from acd_annotator_python import single_flight
+from acd_annotator_python import ndjson
+from acd_annotator_python import chunking
+from acd_annotator_python.shared_stats import SharedStats
+from acd_annotator_python.thread_pool import InstrumentedThreadPoolExecutor
+from acd_annotator_python.container_utils import ValidationLevel
 from acd_annotator_python import service_utils
 from acd_annotator_python.service_utils import ACDException
 
@@ -76,6 +92,23 @@ DEFAULT_ANNOTATOR_DESCRIPTION: str = 'Example ACD microservice annotator'
 DEFAULT_BASE_URL: str = '/services/example_acd_service/api/v1'
 DEFAULT_VERSION: str = '2021-04-06T15:37:31Z'
 DEFAULT_MAX_THREADS: int = 10
+DEFAULT_ANNOTATOR_THREADS: int = DEFAULT_MAX_THREADS
+DEFAULT_VALIDATION_LEVEL: str = ValidationLevel.full
+DEFAULT_CONTAINER_CONCURRENCY: int = 1
+DEFAULT_PROCESS_POOL_WORKERS: int = 0
+DEFAULT_BATCH_MAX_SIZE: int = 32
+DEFAULT_BATCH_MAX_WAIT_MS: float = 5
+DEFAULT_MAX_CONCURRENT_REQUESTS: int = 0
+DEFAULT_MAX_QUEUED_REQUESTS: int = 0
+DEFAULT_RETRY_AFTER_SECONDS: int = 1
+DEFAULT_REQUEST_TIMEOUT_SECONDS: float = 0
+DEFAULT_HEALTH_CHECK_TTL_SECONDS: float = 5
+DEFAULT_HEALTH_CHECK_PORT: int = 0
+DEFAULT_RESULT_CACHE_SIZE_MB: float = 0
+DEFAULT_RESULT_CACHE_PATH: str = ''
+DEFAULT_RESULT_CACHE_DISK_SIZE_MB: float = 1024
+DEFAULT_DEDUPLICATE_REQUESTS: bool = False
+DEFAULT_STREAM_CONCURRENCY: int = 8
 
 # example service properties. These are set to defaults and are overridden by environment properties at app build time.
 ANNOTATOR_NAME: str = DEFAULT_ANNOTATOR_NAME
@@ -83,6 +116,23 @@ ANNOTATOR_DESCRIPTION: str = DEFAULT_ANNOTATOR_DESCRIPTION
 BASE_URL: str = DEFAULT_BASE_URL
 VERSION: str = DEFAULT_VERSION
 MAX_THREADS: int = DEFAULT_MAX_THREADS
+ANNOTATOR_THREADS: int = DEFAULT_ANNOTATOR_THREADS
+VALIDATION_LEVEL: str = DEFAULT_VALIDATION_LEVEL
+CONTAINER_CONCURRENCY: int = DEFAULT_CONTAINER_CONCURRENCY
+PROCESS_POOL_WORKERS: int = DEFAULT_PROCESS_POOL_WORKERS
+BATCH_MAX_SIZE: int = DEFAULT_BATCH_MAX_SIZE
+BATCH_MAX_WAIT_MS: float = DEFAULT_BATCH_MAX_WAIT_MS
+MAX_CONCURRENT_REQUESTS: int = DEFAULT_MAX_CONCURRENT_REQUESTS
+MAX_QUEUED_REQUESTS: int = DEFAULT_MAX_QUEUED_REQUESTS
+RETRY_AFTER_SECONDS: int = DEFAULT_RETRY_AFTER_SECONDS
+REQUEST_TIMEOUT_SECONDS: float = DEFAULT_REQUEST_TIMEOUT_SECONDS
+HEALTH_CHECK_TTL_SECONDS: float = DEFAULT_HEALTH_CHECK_TTL_SECONDS
+HEALTH_CHECK_PORT: int = DEFAULT_HEALTH_CHECK_PORT
+RESULT_CACHE_SIZE_MB: float = DEFAULT_RESULT_CACHE_SIZE_MB
+RESULT_CACHE_PATH: str = DEFAULT_RESULT_CACHE_PATH
+RESULT_CACHE_DISK_SIZE_MB: float = DEFAULT_RESULT_CACHE_DISK_SIZE_MB
+DEDUPLICATE_REQUESTS: bool = DEFAULT_DEDUPLICATE_REQUESTS
+STREAM_CONCURRENCY: int = DEFAULT_STREAM_CONCURRENCY
 
 
 def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
@@ -108,13 +158,90 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         # a container setting where a process does not have access to all the cpus.
         com_ibm_watson_health_common_fastapi_max_threads
 
-    :param custom_annotator: an ACDAnnotator subclass that performs the business logic of the service.
+        # number of threads in the annotator's own thread pool, used by thread_pool.run_in_annotator_executor().
+        # Defaults to 10.
+        com_ibm_watson_health_common_python_annotator_threads
+
+        # how much of each incoming container group to validate: full, shallow, or trusted. Defaults to full.
+        # See container_utils.ValidationLevel.
+        com_ibm_watson_health_common_python_validation_level
+
+        # max number of containers within one request that the annotator processes concurrently. Defaults to 1,
+        # i.e., containers are processed one after another. Raise this for annotators that await async io.
+        com_ibm_watson_health_common_python_container_concurrency
+
+        # number of worker processes for annotators with execution_mode = ExecutionMode.process_pool, in the pool of
+        # each process serving the app (e.g., each of the server's --workers). Defaults to 0, i.e., the number of
+        # cpus divided by the number of processes serving the app, so together they use each cpu once.
+        com_ibm_watson_health_common_python_process_pool_workers
+
+        # for annotators that implement annotate_batch(): the max number of unstructured containers
+        # (from any number of concurrent requests) per batch, and the max time in milliseconds
+        # to wait for a batch to fill up. Default to 32 and 5.
+        com_ibm_watson_health_common_python_batch_max_size
+        com_ibm_watson_health_common_python_batch_max_wait_ms
+
+        # admission control for /process: the max number of requests processed at once (defaults to 0,
+        # i.e., no limit), the max number of requests waiting for a turn (defaults to 0) and the
+        # Retry-After value in seconds (defaults to 1) of the 503s sent once the wait queue is full.
+        com_ibm_watson_health_common_python_max_concurrent_requests
+        com_ibm_watson_health_common_python_max_queued_requests
+        com_ibm_watson_health_common_python_retry_after_seconds
+
+        # default number of seconds a /process request may take before it is cancelled with a 504.
+        # Callers can set their own with an x-request-timeout header. Defaults to 0, i.e., no deadline.
+        com_ibm_watson_health_common_python_request_timeout_seconds
+
+        # how long (in seconds) the result of the annotator's is_healthy() check is reused. It is refreshed
+        # in the background, so health checks never wait for it. Defaults to 5. 0 runs it on every check.
+        com_ibm_watson_health_common_python_health_check_ttl_seconds
+
+        # a separate port on which a lightweight thread answers .../status/health_check with the cached result,
+        # even while the annotator keeps the event loop busy. Point liveness probes here. Defaults to 0 (off).
+        # Needs a health check ttl > 0. Answers 503 once the result hasn't been refreshed for 3 ttls.
+        com_ibm_watson_health_common_python_health_check_port
+
+        # size (in megabytes) of an in-memory cache of annotation results, for annotators that opt in with
+        # get_cache_identity(). See result_cache.py. Defaults to 0 (off).
+        com_ibm_watson_health_common_python_result_cache_size_mb
+
+        # path of a sqlite file that persists cached annotation results, shared by the workers on a node and
+        # kept across restarts and deploys (put it on a persistent volume). Defaults to '' (off).
+        com_ibm_watson_health_common_python_result_cache_path
+
+        # size (in megabytes) the persistent result cache is compacted to, evicting the least recently used
+        # results. Defaults to 1024.
+        com_ibm_watson_health_common_python_result_cache_disk_size_mb
+
+        # if true, /process requests with byte-identical bodies that are in flight at the same time (e.g., retries
+        # after a client-side timeout) run the annotator once and share its response. Each request still times out
+        # at its own deadline. Requests are matched on their bodies alone, so this is only for annotators whose
+        # output doesn't depend on request headers.
+        # Defaults to false.
+        com_ibm_watson_health_common_python_deduplicate_requests
+
+        # max number of ContainerGroups of one /process/stream request that are processed concurrently
+        # (or are done and waiting for their turn to be sent back). Defaults to 8.
+        com_ibm_watson_health_common_python_stream_concurrency
+
+    :param custom_annotator: an ACDAnnotator subclass that performs the business logic of the service,
+        or a list of them to run one after another (see pipeline.AnnotatorPipeline, which also allows
+        annotators to run concurrently).
     :param example_request: The text of an example request
     :return: FastAPI app implementing an ACD microservice.
     """
 
+    # several annotators get run as one
+    if isinstance(custom_annotator, (list, tuple)):
+        custom_annotator = AnnotatorPipeline(custom_annotator)
+
     # read environment variables
-    global ANNOTATOR_NAME, ANNOTATOR_DESCRIPTION, BASE_URL, VERSION, MAX_THREADS
+    global ANNOTATOR_NAME, ANNOTATOR_DESCRIPTION, BASE_URL, VERSION, MAX_THREADS, ANNOTATOR_THREADS, \
+        VALIDATION_LEVEL, CONTAINER_CONCURRENCY, PROCESS_POOL_WORKERS, \
+        BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, RETRY_AFTER_SECONDS, \
+        REQUEST_TIMEOUT_SECONDS, HEALTH_CHECK_TTL_SECONDS, HEALTH_CHECK_PORT, \
+        RESULT_CACHE_SIZE_MB, RESULT_CACHE_PATH, RESULT_CACHE_DISK_SIZE_MB, DEDUPLICATE_REQUESTS, \
+        STREAM_CONCURRENCY
     ANNOTATOR_NAME = service_utils.getenv('com_ibm_watson_health_common_annotator_name', DEFAULT_ANNOTATOR_NAME)
     ANNOTATOR_DESCRIPTION = service_utils.getenv('com_ibm_watson_health_common_annotator_description',
                                                  DEFAULT_ANNOTATOR_DESCRIPTION)
@@ -124,6 +251,42 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
     VERSION = service_utils.getenv('com_ibm_watson_health_common_version', DEFAULT_VERSION)
     MAX_THREADS = int(service_utils.getenv('com_ibm_watson_health_common_python_max_threads',
                                            DEFAULT_MAX_THREADS))
+    ANNOTATOR_THREADS = int(service_utils.getenv('com_ibm_watson_health_common_python_annotator_threads',
+                                                 DEFAULT_ANNOTATOR_THREADS))
+    VALIDATION_LEVEL = service_utils.getenv('com_ibm_watson_health_common_python_validation_level',
+                                            DEFAULT_VALIDATION_LEVEL).lower()
+    if VALIDATION_LEVEL not in ValidationLevel.all:
+        raise ValueError(f'Unknown validation level "{VALIDATION_LEVEL}". Expected one of {ValidationLevel.all}')
+    CONTAINER_CONCURRENCY = int(service_utils.getenv('com_ibm_watson_health_common_python_container_concurrency',
+                                                     DEFAULT_CONTAINER_CONCURRENCY))
+    PROCESS_POOL_WORKERS = int(service_utils.getenv('com_ibm_watson_health_common_python_process_pool_workers',
+                                                    DEFAULT_PROCESS_POOL_WORKERS))
+    BATCH_MAX_SIZE = int(service_utils.getenv('com_ibm_watson_health_common_python_batch_max_size',
+                                              DEFAULT_BATCH_MAX_SIZE))
+    BATCH_MAX_WAIT_MS = float(service_utils.getenv('com_ibm_watson_health_common_python_batch_max_wait_ms',
+                                                   DEFAULT_BATCH_MAX_WAIT_MS))
+    MAX_CONCURRENT_REQUESTS = int(service_utils.getenv('com_ibm_watson_health_common_python_max_concurrent_requests',
+                                                       DEFAULT_MAX_CONCURRENT_REQUESTS))
+    MAX_QUEUED_REQUESTS = int(service_utils.getenv('com_ibm_watson_health_common_python_max_queued_requests',
+                                                   DEFAULT_MAX_QUEUED_REQUESTS))
+    RETRY_AFTER_SECONDS = int(service_utils.getenv('com_ibm_watson_health_common_python_retry_after_seconds',
+                                                   DEFAULT_RETRY_AFTER_SECONDS))
+    REQUEST_TIMEOUT_SECONDS = float(service_utils.getenv('com_ibm_watson_health_common_python_request_timeout_seconds',
+                                                         DEFAULT_REQUEST_TIMEOUT_SECONDS))
+    HEALTH_CHECK_TTL_SECONDS = float(service_utils.getenv(
+        'com_ibm_watson_health_common_python_health_check_ttl_seconds', DEFAULT_HEALTH_CHECK_TTL_SECONDS))
+    HEALTH_CHECK_PORT = int(service_utils.getenv('com_ibm_watson_health_common_python_health_check_port',
+                                                 DEFAULT_HEALTH_CHECK_PORT))
+    RESULT_CACHE_SIZE_MB = float(service_utils.getenv('com_ibm_watson_health_common_python_result_cache_size_mb',
+                                                      DEFAULT_RESULT_CACHE_SIZE_MB))
+    RESULT_CACHE_PATH = service_utils.getenv('com_ibm_watson_health_common_python_result_cache_path',
+                                             DEFAULT_RESULT_CACHE_PATH)
+    RESULT_CACHE_DISK_SIZE_MB = float(service_utils.getenv(
+        'com_ibm_watson_health_common_python_result_cache_disk_size_mb', DEFAULT_RESULT_CACHE_DISK_SIZE_MB))
+    DEDUPLICATE_REQUESTS = str(service_utils.getenv('com_ibm_watson_health_common_python_deduplicate_requests',
+                                                    DEFAULT_DEDUPLICATE_REQUESTS)).lower() == 'true'
+    STREAM_CONCURRENCY = int(service_utils.getenv('com_ibm_watson_health_common_python_stream_concurrency',
+                                                  DEFAULT_STREAM_CONCURRENCY))
     PROCESS_URL = "/process"
 
     app = FastAPI(
@@ -134,6 +297,60 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         openapi_url=OPENAPI_URL
     )
 
+    async def run_cache_io(func, *args):
+        """Call func, which uses the result cache, off the event loop if the cache does disk I/O"""
+        if app.acd_result_cache.blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        return func(*args)
+
+    async def annotate_unstructured(unstructured_container, request: Request):
+        """Run the annotator over a single UnstructuredContainer, in chunks if it is long (see chunking.py)"""
+        if unstructured_container.data is None:
+            unstructured_container.data = container_utils.create_unstructured_container()
+        if chunking.needs_chunking(custom_annotator, unstructured_container):
+            await chunking.annotate_in_chunks(unstructured_container, custom_annotator.chunk_size,
+                                              custom_annotator.chunk_overlap,
+                                              functools.partial(annotate_unstructured_whole, request=request),
+                                              VALIDATION_LEVEL)
+        else:
+            await annotate_unstructured_whole(unstructured_container, request)
+
+    async def annotate_unstructured_whole(unstructured_container, request: Request):
+        """Run the annotator over a single UnstructuredContainer (or chunk of one)"""
+        if request.app.acd_process_pool is not None:
+            await request.app.acd_process_pool.annotate(unstructured_container, request)
+        elif request.app.acd_batcher is not None:
+            await request.app.acd_batcher.submit(unstructured_container)
+        else:
+            await custom_annotator.annotate(unstructured_container, request)
+
+    async def annotate_structured(structured_container, request: Request):
+        """Run the annotator over a single StructuredContainer"""
+        if structured_container.data is None:
+            structured_container.data = container_utils.create_structured_container()
+        if request.app.acd_process_pool is not None:
+            await request.app.acd_process_pool.annotate(structured_container, request, structured=True)
+        else:
+            await custom_annotator.annotate_structured(structured_container, request)
+
+    async def annotate_container_group(container_group, request: Request):
+        """Run the annotator over all of the containers in a ContainerGroup"""
+        # Process all of the unstructured containers
+        if container_group is not None and container_group.unstructured is not None:
+            # when batching, hand all of the containers to the batcher at once
+            concurrency = CONTAINER_CONCURRENCY if request.app.acd_batcher is None \
+                else len(container_group.unstructured)
+            await service_utils.gather_bounded(concurrency, [
+                functools.partial(annotate_unstructured, unstructured_container, request)
+                for unstructured_container in container_group.unstructured
+                if unstructured_container is not None])
+        # Process all of the structured containers
+        if container_group is not None and container_group.structured is not None:
+            await service_utils.gather_bounded(CONTAINER_CONCURRENCY, [
+                functools.partial(annotate_structured, structured_container, request)
+                for structured_container in container_group.structured
+                if structured_container is not None])
+
     @app.post(BASE_URL + PROCESS_URL)
     async def process_endpoint(request: Request, body=Body(..., example=example_request)):
         """Run this microservice annotator over a request consisting of a ContainerGroup."""
@@ -147,13 +364,49 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
             raise ACDException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
                                description="Unsupported Media Type")
 
+        if request.app.acd_single_flight is None:
+            return await process_container_group(request, body)
+
+        # identical requests in flight at the same time (e.g., retries) are processed once, and all of them
+        # get the same serialized response (or error)
+        async def process_and_render():
+            # the shared work isn't bound by the deadline of whichever request started it. Each request
+            # waits until its own deadline instead, and the work stops once none of them is waiting anymore.
+            service_utils.deadline_var.set(None)
+            return JSONResponse(await process_container_group(request, body)).body
+
+        try:
+            content = await request.app.acd_single_flight.run(
+                single_flight.compute_request_key(await request.body()), process_and_render,
+                service_utils.get_time_remaining())
+        except asyncio.TimeoutError:
+            logging.error('Request did not finish before its deadline')
+            raise ACDException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                               description="The request did not finish before its deadline.")
+        return Response(content=content, media_type='application/json')
+
+    async def process_container_group(request: Request, body):
+        """Run the annotator over a (raw) ContainerGroup dict and return the resulting dict"""
+        # set aside any containers the annotator has nothing to do for. They go back into the response as-is.
+        gated = container_utils.split_gated_containers(body, custom_annotator.unstructured_preconditions,
+                                                       custom_annotator.structured_preconditions)
+        # set aside any container data the annotator doesn't use. It is spliced back into the response as-is.
+        passthrough = container_utils.split_passthrough_fields(body, custom_annotator.unstructured_data_fields,
+                                                               custom_annotator.structured_data_fields)
+        # containers the annotator has seen before get their stored results instead of being annotated again
+        cached, cache_keys = {}, {}
+        if request.app.acd_result_cache is not None:
+            cached, cache_keys = await run_cache_io(result_cache.split_cached_containers, body,
+                                                    request.app.acd_result_cache, request.app.acd_cache_identity)
         # body has already been parsed into a dict. Translate java offsets to python offsets.
-        body = container_utils.java2python(body)
-        # Input validation: you can enable/disable this input validation check depending on how much
-        # you trust your input
+        # The offset maps built here are reused to translate the response back.
+        offset_maps = container_utils.compute_offset_maps(body)
+        body = container_utils.java2python(body, offset_maps)
+        # Input validation: how much of the input gets validated up front depends on VALIDATION_LEVEL,
+        # i.e., on how much you trust your input
         try:
-            container_group = ContainerGroup(**body)
-            container_group.schema_json()
+            container_group = container_utils.from_dict(body, VALIDATION_LEVEL)
+            container_utils.attach_offset_maps(container_group, offset_maps)
         except Exception:
             # note: exception messages get sanitized in the exception handler to avoid logging doc bodies
             logging.exception('Input container failed validation')
@@ -162,26 +415,27 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
 
         # each container group consists of a list of UnstructuredContainer
         try:
-            # Process all of the unstructured containers
-            if container_group is not None and container_group.unstructured is not None:
-                for unstructured_container in container_group.unstructured:
-                    if unstructured_container is not None:
-                        if unstructured_container.data is None:
-                            unstructured_container.data = container_utils.create_unstructured_container()
-                        # run the annotator over each UnstructuredContainer
-                        await custom_annotator.annotate(unstructured_container, request)
-            # Process all of the structured containers
-            if container_group is not None and container_group.structured is not None:
-                for structured_container in container_group.structured:
-                    if structured_container is not None:
-                        if structured_container.data is None:
-                            structured_container.data = container_utils.create_structured_container()
-                        await custom_annotator.annotate_structured(structured_container, request)
+            # past the request's deadline, the annotator's work gets cancelled (pending thread/process pool
+            # work is dropped; work already running in a thread/worker process is abandoned)
+            await asyncio.wait_for(annotate_container_group(container_group, request),
+                                   service_utils.get_time_remaining())
+            # anything built from trusted input without validation gets checked on the way out
+            if VALIDATION_LEVEL == ValidationLevel.trusted:
+                container_utils.validate_output(container_group)
+        except asyncio.TimeoutError:
+            logging.error('Request did not finish before its deadline')
+            raise ACDException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                               description="The request did not finish before its deadline.")
         # allow the annotator to raise custom acd errors without catching them--pass them on
         except ACDException:
             # note: "raise e" would create a new stack trace,
             # but a bare "raise" passes the error on with no changes.
             raise
+        # input that was only validated once the annotator accessed it -> 400
+        except DeferredValidationError:
+            logging.exception('Input container failed validation')
+            raise ACDException(status_code=status.HTTP_400_BAD_REQUEST,
+                               description="Input container failed validation")
         # validation exception -> 500
         except ValidationError:
             error_msg = 'This service produced an invalid container.'
@@ -203,7 +457,12 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         # so this really should never fail.
         try:
             result_body = container_group.dict(exclude_none=True)
-            result_body = container_utils.python2java(result_body)
+            result_body = container_utils.python2java(result_body, offset_maps)
+            if request.app.acd_result_cache is not None:
+                await run_cache_io(result_cache.store_results, result_body, cache_keys, request.app.acd_result_cache)
+                result_body = container_utils.merge_gated_containers(result_body, cached)
+            result_body = container_utils.merge_passthrough_fields(result_body, passthrough)
+            result_body = container_utils.merge_gated_containers(result_body, gated)
         except Exception as e:
             error_msg = f"Encountered an unexpected error while serializing container: {type(e).__name__}={e}"
             logging.exception(error_msg)
@@ -211,28 +470,144 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
                                description=error_msg)
         return result_body
 
+    # lets the batch runner (see batch.py) process ContainerGroups without http, and the benchmarks
+    # (see benchmarks/) time the annotator on its own
+    app.acd_process_container_group = process_container_group
+    app.acd_annotate_container_group = annotate_container_group
+
+    @app.post(BASE_URL + PROCESS_URL + "/stream")
+    async def process_stream_endpoint(request: Request, ordered: bool = Query(True)):
+        """
+        Run this microservice annotator over a stream of ContainerGroups, one json object per line (ndjson).
+        The results are streamed back, one per line, as they are done: in the order of the input,
+        or with ?ordered=false, as soon as each is done, as {"index": <input line number>, "result": ...}.
+        A ContainerGroup that fails gets its error body ({"detail": ...}) as its result.
+        Each ContainerGroup gets its own request timeout (x-request-timeout header), and is counted in the
+        latency stats like a /process request. The stream as a whole holds one /process admission slot.
+        """
+        # this path bypasses request_middleware (see below), so do its bookkeeping here
+        start_ts = time.time()
+        service_utils.correlation_id_var.set(request.headers.get("x-correlation-id", "null"))
+        kv_log_builder = service_utils.KVLogBuilder()
+        kv_log_builder.add_item('api_verb', request.method)
+        logger.info(f'>{request.method} {request.url} {kv_log_builder}')
+        logger.info(f'Req Headers={service_utils.get_header_log(request)}')
+        await request.app.acd_service_info.increment_request_count()
+
+        def log_exit(status_code):
+            kv_log_builder.add_item('api_time', f'{time.time() - start_ts:0.03f}')
+            kv_log_builder.add_item('api_rc', status_code)
+            logger.info(f'<{request.method} {request.url} {kv_log_builder}')
+
+        # hold an admission slot until the stream is done (see finish())
+        admission = contextlib.AsyncExitStack()
+        try:
+            if not ndjson.has_ndjson_content_type(request):
+                raise ACDException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                                   description="Unsupported Media Type")
+            # the timeout of each ContainerGroup (None for no deadline)
+            timeout = service_utils.get_request_deadline(request, REQUEST_TIMEOUT_SECONDS, start_time=0)
+            await admission.enter_async_context(request.app.acd_admission_controller.admit())
+        except ACDException as e:
+            logger.warning(f'Rejected request: {e.detail["description"]}')
+            log_exit(e.status_code)
+            raise
+
+        async def finish():
+            await admission.aclose()
+            log_exit(status.HTTP_200_OK)
+
+        # read no further ahead than STREAM_CONCURRENCY results waiting to be sent back
+        slots = asyncio.Semaphore(STREAM_CONCURRENCY)
+        # ordered: the tasks, in input order. Unordered: the result lines, as they are done. None ends the stream.
+        outbox = asyncio.Queue()
+        running = set()
+
+        async def process(index, line):
+            line_start_ts = time.time()
+            if timeout is not None:
+                # (each task has its own copy of the context)
+                service_utils.deadline_var.set(line_start_ts + timeout)
+            result_line, _ = await ndjson.process_line(request.app, request, line)
+            request.app.acd_service_info.shared_stats.record_latency(time.time() - line_start_ts)
+            if not ordered:
+                await outbox.put(f'{{"index":{index},"result":{result_line}}}')
+            return result_line
+
+        async def read():
+            try:
+                index = 0
+                async for line in ndjson.aiter_lines(request.stream()):
+                    await slots.acquire()
+                    task = asyncio.ensure_future(process(index, line))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    if ordered:
+                        await outbox.put(task)
+                    index += 1
+                if running:
+                    await asyncio.wait(set(running))
+            finally:
+                await outbox.put(None)
+
+        async def write():
+            reader = asyncio.ensure_future(read())
+            try:
+                while True:
+                    item = await outbox.get()
+                    if item is None:
+                        break
+                    result_line = await item if ordered else item
+                    slots.release()
+                    yield result_line + '\n'
+                # pass on any error reading the request
+                await reader
+            finally:
+                # e.g., the client went away
+                reader.cancel()
+                for task in list(running):
+                    task.cancel()
+
+        return ndjson.StreamingRequestResponse(write(), background=BackgroundTask(finish))
+
     @app.get(BASE_URL + "/status")
-    async def status_endpoint(request: Request):
+    async def status_endpoint(request: Request, per_worker: bool = Query(False, alias='perWorker')):
         """
         This method returns information describing the state of the server.
+        Request counts and latencies cover all of the server's worker processes.
+        Add ?perWorker=true for a breakdown by worker.
         """
-        if await service_utils.is_annotator_healthy(custom_annotator, app):
+        if await request.app.acd_health_check.get():
             acd_service_info: service_utils.ServiceInfo = request.app.acd_service_info
-            return {
+            admission_controller: service_utils.AdmissionController = request.app.acd_admission_controller
+            shared_stats = acd_service_info.shared_stats.get_stats()
+            status_body = {
                 "version": VERSION,
                 "upTime": acd_service_info.get_uptime(),
                 "serviceState": service_utils.ServerState.ok,
                 "hostName": acd_service_info.hostname,
-                "requestCount": await acd_service_info.get_request_count(),
+                "requestCount": shared_stats["requestCount"],
                 "maxMemoryMb": await service_utils.get_max_rss_mb(),
                 "inUseMemoryMb": await service_utils.get_rss_mb(),
                 "commitedMemoryMb": await service_utils.get_vms_mb(),
                 "availableProcessors": await service_utils.get_num_processors(),
-                # "concurrentRequests": 0,
-                # "maxConcurrentRequests": 3,
-                # "totalRejectedRequests": 0,
-                # "totalBlockedRequests": 0
+                "workers": shared_stats["workers"],
+                "concurrentRequests": shared_stats["concurrentRequests"],
+                "maxConcurrentRequests": admission_controller.max_concurrent_requests * shared_stats["workers"],
+                "queuedRequests": shared_stats["queuedRequests"],
+                "totalRejectedRequests": shared_stats["totalRejectedRequests"],
+                "totalBlockedRequests": shared_stats["totalBlockedRequests"],
+                "totalLatencyMs": shared_stats["totalLatencyMs"],
+                "latencyHistogramMs": shared_stats["latencyHistogramMs"],
+                "annotatorExecutor": request.app.acd_annotator_executor.get_stats(),
             }
+            if request.app.acd_single_flight is not None:
+                status_body["deduplicatedRequests"] = request.app.acd_single_flight.get_stats()
+            if request.app.acd_result_cache is not None:
+                status_body["resultCache"] = request.app.acd_result_cache.get_stats()
+            if per_worker:
+                status_body["workerStats"] = acd_service_info.shared_stats.get_worker_stats()
+            return status_body
         else:
             raise ACDException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                                description="Status check failed. See log for details.")
@@ -240,7 +615,7 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
     @app.get(BASE_URL + "/status/health_check")
     async def health_check_endpoint(request: Request):
         """Does this microservice appear healthy?"""
-        if await service_utils.is_annotator_healthy(custom_annotator, request.app):
+        if await request.app.acd_health_check.get():
             return {
                 "serviceState": service_utils.ServerState.ok
             }
@@ -248,6 +623,32 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
             raise ACDException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                                description="Health check failed. See log for details.")
 
+    def preload():
+        """
+        Load the annotator's resources ahead of server startup, e.g., in a parent process before it forks
+        its workers (see server.py), so the workers share them copy-on-write instead of each loading their own.
+        Otherwise they get loaded on startup.
+        """
+        if app.acd_preloaded:
+            return
+        # build the (large) container model schema once up front. This also makes sure
+        # any fields added via add_fields() produce a valid model.
+        container_utils.get_container_group_schema_json()
+        # notify the annotator that we're starting up and let it load any resources it needs.
+        # Annotators that run in a process pool load their resources in each worker instead.
+        if custom_annotator.execution_mode != ExecutionMode.process_pool:
+            custom_annotator.on_startup(app)
+        app.acd_preloaded = True
+
+    app.acd_preloaded = False
+    app.acd_preload = preload
+    # stats reported by /status. A multi-worker server (see server.py) replaces this with a block
+    # shared by all of its workers before it forks them.
+    app.acd_shared_stats = SharedStats()
+    # number of processes serving the app side by side, which share the cpus between their process pools.
+    # A multi-worker server or the batch runner sets this before it forks them.
+    app.acd_worker_processes = 1
+
     # we aren't going to assume that startup logic is threaded (it will often involve IO
     # like 'open()' which doesn't know about async and await, so we will just define
     # this as 'def' and not 'async def'
@@ -260,9 +661,64 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         # up to 80 threads, which seems excessive.
         service_utils.set_max_threads(MAX_THREADS)
         # create a ServiceInfo object to track server status
-        app.acd_service_info = service_utils.ServiceInfo()
-        # notify the annotator that we're starting up and let it load any resources it needs
-        custom_annotator.on_startup(app)
+        app.acd_service_info = service_utils.ServiceInfo(app.acd_shared_stats)
+        # limit how many /process requests are handled at once
+        app.acd_admission_controller = service_utils.AdmissionController(MAX_CONCURRENT_REQUESTS,
+                                                                         MAX_QUEUED_REQUESTS,
+                                                                         RETRY_AFTER_SECONDS,
+                                                                         app.acd_shared_stats)
+        # a dedicated thread pool for blocking annotator work (see thread_pool.run_in_annotator_executor)
+        app.acd_annotator_executor = InstrumentedThreadPoolExecutor(ANNOTATOR_THREADS,
+                                                                    type(custom_annotator).__name__)
+        # load the annotator's resources (unless that already happened before the server started)
+        preload()
+        if custom_annotator.execution_mode == ExecutionMode.process_pool:
+            app.acd_process_pool = AnnotatorProcessPool(
+                custom_annotator, PROCESS_POOL_WORKERS or get_default_max_workers(app.acd_worker_processes))
+        else:
+            app.acd_process_pool = None
+        # keep the annotator's health check result cached (and, optionally, served from a separate thread)
+        app.acd_health_check = CachedHealthCheck(custom_annotator, app, HEALTH_CHECK_TTL_SECONDS)
+        app.acd_health_check.start()
+        app.acd_health_check_server = None
+        if HEALTH_CHECK_PORT > 0:
+            app.acd_health_check_server = HealthCheckServer(app.acd_health_check, HEALTH_CHECK_PORT)
+            app.acd_health_check_server.start()
+        # cache the results of annotators that allow it
+        app.acd_result_cache = None
+        app.acd_cache_identity = custom_annotator.get_cache_identity()
+        if app.acd_cache_identity is not None:
+            # results also depend on the service version
+            app.acd_cache_identity = f'{VERSION}|{app.acd_cache_identity}'
+            memory_cache = persistent_cache = None
+            if RESULT_CACHE_SIZE_MB > 0:
+                memory_cache = result_cache.LRUResultCache(int(RESULT_CACHE_SIZE_MB * 1000000))
+            if RESULT_CACHE_PATH:
+                persistent_cache = result_cache.SqliteResultCache(RESULT_CACHE_PATH,
+                                                                  int(RESULT_CACHE_DISK_SIZE_MB * 1000000))
+            if memory_cache is not None and persistent_cache is not None:
+                app.acd_result_cache = result_cache.TieredResultCache(memory_cache, persistent_cache)
+            else:
+                app.acd_result_cache = memory_cache or persistent_cache
+        # share the work of identical requests that are in flight at the same time
+        app.acd_single_flight = single_flight.SingleFlight() if DEDUPLICATE_REQUESTS else None
+        # gather unstructured containers from concurrent requests into batches for annotate_batch()
+        app.acd_batcher = None
+        if custom_annotator.supports_batching() and app.acd_process_pool is None:
+            app.acd_batcher = MicroBatcher(functools.partial(custom_annotator.annotate_batch, app=app),
+                                           BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000)
+
+    @app.on_event('shutdown')
+    def on_shutdown():
+        """A hook that gets called on server shutdown"""
+        app.acd_annotator_executor.shutdown()
+        app.acd_health_check.stop()
+        if app.acd_health_check_server is not None:
+            app.acd_health_check_server.stop()
+        if app.acd_process_pool is not None:
+            app.acd_process_pool.shutdown()
+        if app.acd_result_cache is not None:
+            app.acd_result_cache.close()
 
     @app.middleware("http")
     async def request_middleware(request: Request, call_next):
@@ -282,11 +738,25 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         # track how many requests have been serviced
         await request.app.acd_service_info.increment_request_count()
 
-        # execute the call as normal
-        response: Response = await call_next(request)
+        # execute the call as normal. /process calls first have to be admitted.
+        if request.url.path == BASE_URL + PROCESS_URL:
+            try:
+                # the deadline is visible to the annotator via service_utils.get_time_remaining()
+                service_utils.deadline_var.set(service_utils.get_request_deadline(request, REQUEST_TIMEOUT_SECONDS,
+                                                                                   start_ts))
+                async with request.app.acd_admission_controller.admit():
+                    response: Response = await call_next(request)
+            except ACDException as e:
+                logger.warning(f'Rejected request: {e.detail["description"]}')
+                response = e.to_response()
+        else:
+            response: Response = await call_next(request)
 
         # exit logging
-        kv_log_builder.add_item('api_time', f'{time.time() - start_ts:0.03f}')
+        api_time = time.time() - start_ts
+        if request.url.path == BASE_URL + PROCESS_URL:
+            request.app.acd_service_info.shared_stats.record_latency(api_time)
+        kv_log_builder.add_item('api_time', f'{api_time:0.03f}')
         kv_log_builder.add_item('api_rc', response.status_code)
         kv_log_builder.add_item('api_size_i', request.headers.get("content-length"))
         logger.info(f'<{request.method} {request.url} {kv_log_builder}')
@@ -304,6 +774,9 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         if request.url.path.endswith(PROCESS_URL):
             if not service_utils.has_json_content_type(request):
                 return JSONResponse("Unsupported Media Type", status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        elif request.url.path.endswith(PROCESS_URL + "/stream"):
+            if not ndjson.has_ndjson_content_type(request):
+                return JSONResponse("Unsupported Media Type", status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
         # Note: we don't want to log the full str(exc). In handling validation errors
         # pydantic is super aggressive and reports the whole document body.
@@ -314,4 +787,9 @@ def build(custom_annotator, example_request=json.dumps(EXAMPLE_REQUEST)):
         acd_exception = service_utils.ACDException(status_code=400, description=error_msg)
         return JSONResponse(acd_exception.detail, status_code=acd_exception.status_code)
 
+    # the stream endpoint reads the request while it streams the response, which request_middleware can't do.
+    # (added last, so it runs first)
+    app.add_middleware(ndjson.StreamingRequestMiddleware, router=app.router,
+                       paths=[BASE_URL + PROCESS_URL + "/stream"], exception_handlers=app.exception_handlers)
+
     return app
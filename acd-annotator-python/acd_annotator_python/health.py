@@ -0,0 +1,146 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from acd_annotator_python import service_utils
+
+logger = logging.getLogger(__name__)
+
+# how many ttls a result may go without being refreshed before it is no longer trusted (see CachedHealthCheck.is_stale)
+STALE_AFTER_TTLS = 3
+
+
+class CachedHealthCheck:
+    """
+    Remembers the result of the annotator's is_healthy() check for ttl seconds, so health probes
+    don't have to run it (and wait for the event loop) every time. A background task keeps
+    the result fresh, so it can also be read from other threads (see HealthCheckServer).
+    """
+
+    def __init__(self, custom_annotator, app, ttl: float):
+        self.custom_annotator = custom_annotator
+        self.app = app
+        self.ttl = ttl
+        self.is_healthy = None
+        self.checked_at = None
+        self._refresh_task = None
+
+    async def check(self):
+        """Run the annotator's health check now and remember the result"""
+        self.is_healthy = await service_utils.is_annotator_healthy(self.custom_annotator, self.app)
+        self.checked_at = time.monotonic()
+        return self.is_healthy
+
+    async def get(self):
+        """The cached result, if it isn't older than the ttl, or else a fresh one"""
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.ttl:
+            return await self.check()
+        return self.is_healthy
+
+    def is_stale(self):
+        """
+        Whether there is no result yet, or it hasn't been refreshed for a few ttls (e.g., the event loop is stuck
+        or the refresher stopped), so it can't be trusted anymore. Safe to call from any thread.
+        """
+        checked_at = self.checked_at
+        return checked_at is None or time.monotonic() - checked_at > STALE_AFTER_TTLS * self.ttl
+
+    async def _refresh_forever(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.ttl)
+
+    def start(self):
+        """Start refreshing the result in the background (call from the event loop). Needs a ttl > 0."""
+        if self.ttl > 0:
+            self._refresh_task = asyncio.ensure_future(self._refresh_forever())
+
+    def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+
+class HealthCheckServer:
+    """
+    A tiny http server, running in its own thread on its own port, that answers health checks from
+    a CachedHealthCheck. It never touches the event loop, so it keeps answering (with the last known
+    result) while the annotator keeps the event loop busy, and busy pods don't get restarted. Once that result
+    is too old to trust (see STALE_AFTER_TTLS), it answers 503, so stuck pods still do.
+    Answers GET requests for any path ending in /status/health_check (e.g., a kubernetes liveness probe).
+    """
+
+    def __init__(self, health_check: CachedHealthCheck, port: int, host: str = '0.0.0.0'):
+        self.health_check = health_check
+        self.httpd = _ReusePortHTTPServer((host, port), self._make_handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='HealthCheckServer', daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _make_handler(self):
+        health_check = self.health_check
+
+        class HealthCheckHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self.path.split('?')[0].rstrip('/').endswith('/status/health_check'):
+                    self.send_error(404)
+                    return
+                # a check that hasn't run yet (the server is still starting up) or went stale can't vouch for it
+                if health_check.is_stale():
+                    exception = service_utils.ACDException(status_code=503,
+                                                           description="Health check result is out of date.")
+                elif health_check.is_healthy:
+                    exception = None
+                else:
+                    exception = service_utils.ACDException(status_code=500,
+                                                           description="Health check failed. See log for details.")
+                if exception is None:
+                    status_code = 200
+                    body = {"serviceState": service_utils.ServerState.ok}
+                else:
+                    status_code = exception.status_code
+                    body = {"detail": exception.detail}
+                content = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                # probes are frequent; keep them out of the logs
+                pass
+
+        return HealthCheckHandler
+
+    def start(self):
+        self.thread.start()
+        logger.info(f'Serving health checks on port {self.port}')
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _ReusePortHTTPServer(ThreadingHTTPServer):
+    """Lets each worker of a multi-worker server (see server.py) listen on the same health check port"""
+    daemon_threads = True
+
+    def server_bind(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
@@ -0,0 +1,104 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+Helpers for newline-delimited json (one ContainerGroup per line), shared by the batch runner (see batch.py)
+and the /process/stream endpoint.
+"""
+
+import json
+import logging
+
+from fastapi import Request, status
+from fastapi.responses import StreamingResponse
+from starlette.exceptions import ExceptionMiddleware
+
+from acd_annotator_python import service_utils
+from acd_annotator_python.service_utils import ACDException
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE = 'application/x-ndjson'
+
+
+def has_ndjson_content_type(request: Request):
+    """Does this request have an application/x-ndjson (or application/json) media type?"""
+    return MEDIA_TYPE in request.headers.get('content-type', '') or service_utils.has_json_content_type(request)
+
+
+async def aiter_lines(chunks):
+    """The non-blank lines (bytes) of a stream of byte chunks, e.g., Request.stream(), as they arrive"""
+    remainder = b''
+    async for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if remainder.strip():
+        yield remainder
+
+
+class StreamingRequestResponse(StreamingResponse):
+    """
+    A StreamingResponse for endpoints that keep reading the request body while they respond.
+    (StreamingResponse itself waits for the client to disconnect by reading from the request, and would
+    swallow the rest of its body.) A disconnected client shows up as an error reading the request instead.
+    The background task runs even if the response couldn't be sent, so it can be used to release resources.
+    """
+    media_type = MEDIA_TYPE
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        finally:
+            if self.background is not None:
+                await self.background()
+
+
+class StreamingRequestMiddleware:
+    """
+    Sends requests for the given paths past the app's other middleware, straight to its router (by way of its
+    exception handlers). Middleware built on BaseHTTPMiddleware (e.g., @app.middleware("http")) wraps responses
+    in a StreamingResponse, which would swallow the body of requests that are still being read while the
+    response is streamed. The endpoints at these paths do that middleware's work themselves.
+    """
+
+    def __init__(self, app, router, paths, exception_handlers):
+        self.app = app
+        # (like starlette's own exception middleware. 500s are left to its server error middleware.)
+        self.router = ExceptionMiddleware(router, handlers={key: handler for key, handler in exception_handlers.items()
+                                                            if key not in (500, Exception)})
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] in self.paths:
+            await self.router(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+async def process_line(app, request: Request, line):
+    """
+    Process one ContainerGroup json line like a /process request.
+    :return: the result line (or its {"detail": ...} error body) and whether it succeeded
+    """
+    try:
+        try:
+            body = json.loads(line)
+        except ValueError:
+            raise ACDException(status_code=status.HTTP_400_BAD_REQUEST, description="Input is not valid json")
+        result_body = await app.acd_process_container_group(request, body)
+        return json.dumps(result_body, ensure_ascii=False, separators=(',', ':')), True
+    except ACDException as e:
+        return json.dumps({"detail": e.detail}, ensure_ascii=False), False
+    except Exception as e:
+        logger.exception('Unexpected error while processing a document')
+        error = ACDException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                             description=f"Encountered an unexpected error: {type(e).__name__}={e}")
+        return json.dumps({"detail": error.detail}, ensure_ascii=False), False
@@ -0,0 +1,154 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+from typing import Dict, List, Optional, Sequence
+
+from fastapi import Request
+
+from acd_annotator_python import preconditions
+from acd_annotator_python.acd_annotator import ACDAnnotator, ExecutionMode
+from acd_annotator_python.container_model.main import UnstructuredContainer, StructuredContainer
+
+
+class AnnotatorPipeline(ACDAnnotator):
+    """
+    Runs several annotators in one service, e.g., regex concepts, then code resolution, then sentences.
+    The request is parsed, validated, span-converted and serialized once for all of them, instead of once
+    per microservice in the ACD flow.
+
+    By default the annotators run one after another, in order. Pass `dependencies` to describe a DAG instead:
+    each annotator then runs as soon as the annotators it depends on are done, so independent branches run
+    concurrently. (Annotators running concurrently over the same container shouldn't touch the same fields.)
+
+    Note: annotate_batch() hooks of the annotators aren't used in a pipeline; their annotate() is.
+    Preconditions only skip the containers that none of the annotators want; the others see them all.
+    """
+
+    def __init__(self, annotators: Sequence[ACDAnnotator],
+                 dependencies: Optional[Dict[ACDAnnotator, Sequence[ACDAnnotator]]] = None):
+        """
+        :param annotators: the annotators, in the order they run in (when there are no dependencies)
+        :param dependencies: maps an annotator to the annotators that must finish before it starts.
+            None (the default) chains the annotators in order. Annotators missing from the dict
+            don't depend on anything.
+        """
+        super().__init__()
+        self.annotators = list(annotators)
+        if not self.annotators:
+            raise ValueError('An AnnotatorPipeline needs at least one annotator')
+        if dependencies is None:
+            dependencies = {annotator: [previous] for previous, annotator in zip(self.annotators, self.annotators[1:])}
+        indexes = {id(annotator): i for i, annotator in enumerate(self.annotators)}
+        # dependencies by annotator index
+        self.dependencies: List[List[int]] = [[] for _ in self.annotators]
+        for annotator, annotator_dependencies in dependencies.items():
+            if id(annotator) not in indexes or any(id(dep) not in indexes for dep in annotator_dependencies):
+                raise ValueError('Pipeline dependencies must only refer to annotators in the pipeline')
+            self.dependencies[indexes[id(annotator)]] = [indexes[id(dep)] for dep in annotator_dependencies]
+        self.order = self._topological_order()
+
+        # the pipeline sees the union of the fields its annotators use
+        self.unstructured_data_fields = self._union_fields('unstructured_data_fields')
+        self.structured_data_fields = self._union_fields('structured_data_fields')
+        # the pipeline skips the containers that every one of its annotators would skip
+        self.unstructured_preconditions = self._any_preconditions('unstructured_preconditions')
+        self.structured_preconditions = self._any_preconditions('structured_preconditions')
+        execution_modes = {annotator.execution_mode for annotator in self.annotators}
+        if len(execution_modes) > 1:
+            raise ValueError('All of the annotators in a pipeline must use the same execution mode')
+        self.execution_mode = execution_modes.pop()
+        # chunk only if every annotator allows it, in the smallest chunks any of them wants
+        chunk_sizes = [annotator.chunk_size for annotator in self.annotators]
+        if all(chunk_sizes):
+            self.chunk_size = min(chunk_sizes)
+            self.chunk_overlap = max(annotator.chunk_overlap for annotator in self.annotators)
+
+    def _topological_order(self):
+        """The annotator indexes, ordered so each comes after its dependencies. Raises ValueError for cycles."""
+        order = []
+        state = {}  # index -> 'visiting' or 'done'
+
+        def visit(i):
+            if state.get(i) == 'done':
+                return
+            if state.get(i) == 'visiting':
+                raise ValueError('Pipeline dependencies must not contain cycles')
+            state[i] = 'visiting'
+            for dep in self.dependencies[i]:
+                visit(dep)
+            state[i] = 'done'
+            order.append(i)
+
+        for i in range(len(self.annotators)):
+            visit(i)
+        return order
+
+    def _any_preconditions(self, attribute):
+        annotator_preconditions = [getattr(annotator, attribute) for annotator in self.annotators]
+        if any(not container_preconditions for container_preconditions in annotator_preconditions):
+            return ()
+
+        def precondition(container_dict):
+            return any(preconditions.check_all(container_preconditions, container_dict)
+                       for container_preconditions in annotator_preconditions)
+        return (precondition,)
+
+    def _union_fields(self, attribute):
+        fields = [getattr(annotator, attribute) for annotator in self.annotators]
+        if any(annotator_fields is None for annotator_fields in fields):
+            return None
+        return tuple(sorted(set().union(*fields)))
+
+    async def _run(self, run_step):
+        """Call `run_step(annotator)` for every annotator, respecting the dependencies"""
+        if all(self.dependencies[i] == [j] for i, j in zip(self.order[1:], self.order)) \
+                and not self.dependencies[self.order[0]]:
+            # a simple chain
+            for i in self.order:
+                await run_step(self.annotators[i])
+            return
+
+        tasks = {}
+
+        async def run(i):
+            await asyncio.gather(*(tasks[dep] for dep in self.dependencies[i]))
+            await run_step(self.annotators[i])
+
+        for i in self.order:
+            tasks[i] = asyncio.ensure_future(run(i))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            # let the cancelled steps finish up before passing on the error
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+    def get_cache_identity(self):
+        identities = [annotator.get_cache_identity() for annotator in self.annotators]
+        if any(identity is None for identity in identities):
+            return None
+        return repr((identities, self.dependencies))
+
+    def on_startup(self, app):
+        for annotator in self.annotators:
+            annotator.on_startup(app)
+
+    async def is_healthy(self, app):
+        for annotator in self.annotators:
+            if not await annotator.is_healthy(app):
+                return False
+        return True
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        await self._run(lambda annotator: annotator.annotate(unstructured_container, request))
+
+    async def annotate_structured(self, structured_container: StructuredContainer, request: Request):
+        await self._run(lambda annotator: annotator.annotate_structured(structured_container, request))
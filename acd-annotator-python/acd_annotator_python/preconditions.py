@@ -0,0 +1,55 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+Cheap checks that an annotator can declare (see ACDAnnotator.unstructured_preconditions/structured_preconditions)
+to skip containers it has nothing to do for. They are run against each raw container dict (with java offsets),
+before any container model objects get built. Containers that fail any of them are passed through untouched.
+
+A precondition is any function that takes a container dict and returns True if the annotator should see it.
+"""
+
+_MISSING = object()
+
+
+def get_path(container_dict, path: str, default=None):
+    """Look up a dotted path like 'data.attributeValues' in a (raw) container dict"""
+    value = container_dict
+    for name in path.split('.'):
+        if not isinstance(value, dict):
+            return default
+        value = value.get(name, _MISSING)
+        if value is _MISSING:
+            return default
+    return value
+
+
+def requires(path: str):
+    """
+    The container must have a non-empty value at the given dotted path,
+    e.g., requires('data.attributeValues') or, for structured containers, requires('data.heightInches').
+    """
+    def precondition(container_dict):
+        value = get_path(container_dict, path)
+        return value is not None and value != [] and value != {} and value != ''
+    precondition.__qualname__ = f'requires({path!r})'
+    return precondition
+
+
+def min_text_length(length: int):
+    """The container's text must be at least this many characters long (skips containers without text)"""
+    def precondition(container_dict):
+        text = container_dict.get('text')
+        return isinstance(text, str) and len(text) >= length
+    precondition.__qualname__ = f'min_text_length({length})'
+    return precondition
+
+
+def check_all(preconditions, container_dict):
+    """Does the container pass all of the preconditions?"""
+    return all(precondition(container_dict) for precondition in preconditions)
@@ -0,0 +1,100 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import logging
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+from acd_annotator_python import container_utils
+from acd_annotator_python import service_utils
+from acd_annotator_python.container_model.main import UnstructuredContainer, StructuredContainer
+
+logger = logging.getLogger(__name__)
+
+# the annotator and stand-in app object owned by the current worker process
+_worker_annotator = None
+_worker_app = None
+
+
+def get_default_max_workers(worker_processes: int = 1) -> int:
+    """
+    The number of pool processes to give each of worker_processes processes that run an AnnotatorProcessPool
+    side by side (e.g., the workers of server.py or batch.py): an even share of the usable cpus, but at least one.
+    """
+    return max(1, service_utils.get_usable_cpu_count() // max(1, worker_processes))
+
+
+class WorkerRequest:
+    """
+    Stands in for the fastapi Request passed to annotate() when the annotator runs in a worker process.
+    A real Request can't be sent to another process, so this carries over the parts annotators
+    use: the request headers, and an `app` holding whatever on_startup() loaded in this worker.
+    """
+
+    def __init__(self, app, headers):
+        self.app = app
+        self.headers = headers
+
+
+def _init_worker(annotator):
+    """Runs once in each worker process as it starts: let the annotator load its resources"""
+    global _worker_annotator, _worker_app
+    _worker_annotator = annotator
+    _worker_app = types.SimpleNamespace()
+    annotator.on_startup(_worker_app)
+
+
+def _annotate_in_worker(container_dict: dict, structured: bool, headers: dict, deadline):
+    """
+    Runs in a worker process: rebuild the container, run the annotator over it
+    and send back the (modified) container as a dict.
+    """
+    # don't start on work that nobody is waiting for anymore
+    service_utils.deadline_var.set(deadline)
+    service_utils.check_deadline()
+    container_cls = StructuredContainer if structured else UnstructuredContainer
+    # the parent process already validated its input; only what the annotator touches is checked below
+    container = container_utils.container_from_dict(container_cls, container_dict, validate=False)
+    if container.data is None:
+        container.data = container_utils.create_structured_container() if structured \
+            else container_utils.create_unstructured_container()
+    request = WorkerRequest(_worker_app, headers)
+    if structured:
+        asyncio.run(_worker_annotator.annotate_structured(container, request))
+    else:
+        asyncio.run(_worker_annotator.annotate(container, request))
+    container.data.validate_unchecked_fields()
+    return container.dict(exclude_none=True)
+
+
+class AnnotatorProcessPool:
+    """
+    Runs an annotator's annotate()/annotate_structured() methods in a pool of worker processes,
+    so CPU-bound annotators can use more than one core and don't block the server's event loop.
+    Each worker calls the annotator's on_startup() once when it starts.
+    Containers are sent to the workers as dicts and the modified containers are copied back.
+    Every process serving the app gets a pool of its own, so size them together (see get_default_max_workers()).
+    """
+
+    def __init__(self, annotator, max_workers: int):
+        self.annotator = annotator
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                            initargs=(annotator,))
+
+    async def annotate(self, container, request, structured: bool = False):
+        """Run the annotator over the container in a worker process, updating the container in-place"""
+        loop = asyncio.get_running_loop()
+        container_dict = container.dict(exclude_none=True)
+        result = await loop.run_in_executor(self.executor, _annotate_in_worker, container_dict, structured,
+                                            dict(request.headers), service_utils.deadline_var.get())
+        container_utils.replace_container_contents(container, result)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,313 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+A content-addressed cache of annotation results. Each container is looked up by a hash of
+what the annotator gets to see of it (its text and the data fields the annotator declares) plus
+the annotator's cache identity (see ACDAnnotator.get_cache_identity()). On a hit, the stored output
+container is put into the response as-is, without parsing the container or calling the annotator.
+
+There are two tiers: an in-memory LRU cache for each worker, and an optional sqlite file shared by the
+workers on a node, which survives restarts and deploys (results of older annotator versions simply
+stop being hit and age out).
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def compute_cache_key(identity: str, kind: str, container_dict: dict):
+    """
+    Hash a raw (java offset) container dict together with the annotator's identity.
+    :param identity: the annotator's cache identity (version/configuration)
+    :param kind: 'unstructured' or 'structured'
+    :param container_dict:
+    """
+    content = json.dumps(container_dict, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256()
+    for part in (identity, kind, content):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LRUResultCache:
+    """
+    An in-memory, least-recently-used cache of serialized output containers,
+    bounded by the total size (in bytes) of its keys and values.
+    """
+    # whether lookups do I/O (and so should be kept off the event loop)
+    blocking = False
+
+    def __init__(self, max_size_bytes: int):
+        self.max_size_bytes = max_size_bytes
+        self.entries = collections.OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the cache can be used from the annotator's threads as well as the event loop
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(key, value):
+        return len(key) + len(value)
+
+    def get(self, key: str):
+        """The serialized output stored for key, or None"""
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes):
+        entry_size = self._entry_size(key, value)
+        with self._lock:
+            if entry_size > self.max_size_bytes:
+                # would push everything else out
+                return
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size_bytes -= self._entry_size(key, old_value)
+            self.entries[key] = value
+            self.size_bytes += entry_size
+            while self.size_bytes > self.max_size_bytes:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.size_bytes -= self._entry_size(evicted_key, evicted_value)
+                self.evictions += 1
+
+    def get_stats(self):
+        """A summary of the cache, as reported by the /status endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "sizeBytes": self.size_bytes,
+                "maxSizeBytes": self.max_size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        pass
+
+
+class SqliteResultCache:
+    """
+    A persistent cache of serialized output containers in a sqlite database, which the workers (and pods
+    mounting the same local volume) share. Entries are evicted least recently used first once the
+    database grows past max_size_bytes, and the freed pages are returned to the file system.
+    """
+    blocking = True
+    # after a compaction, evict down to this fraction of the maximum size, so compactions aren't back to back
+    LOW_WATER_MARK = 0.9
+    # how much stale an entry's last used time may get before a hit refreshes it (saves writes for hot entries)
+    TOUCH_INTERVAL_SECONDS = 60
+
+    def __init__(self, path: str, max_size_bytes: int):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        # check the size (and compact) whenever this many bytes have been written
+        self.compact_interval_bytes = max(max_size_bytes // 20, 1)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compactions = 0
+        # as of the last compaction, plus what was written since
+        self.entries = 0
+        self.size_bytes = 0
+        self._bytes_since_compaction = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        self.compact()
+
+    def _connect(self):
+        # connections can't be shared with forked processes; each process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            # must be set before the table is created for incremental_vacuum to work
+            connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # lets the workers read while one of them writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                               'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                               'last_used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str):
+        """The serialized output stored for key, or None"""
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute('SELECT value, last_used FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value, last_used = row
+            now = time.time()
+            if now - last_used > self.TOUCH_INTERVAL_SECONDS:
+                connection.execute('UPDATE results SET last_used = ? WHERE key = ?', (now, key))
+            return bytes(value)
+
+    def put(self, key: str, value: bytes):
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_size_bytes:
+            return
+        with self._lock:
+            self._connect().execute('INSERT OR REPLACE INTO results (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                                    (key, value, entry_size, time.time()))
+            self.entries += 1
+            self.size_bytes += entry_size
+            self._bytes_since_compaction += entry_size
+            compact = self._bytes_since_compaction >= self.compact_interval_bytes
+        if compact:
+            self.compact()
+
+    def compact(self):
+        """Evict the least recently used entries if the cache is too big, and give the freed space back"""
+        with self._lock:
+            connection = self._connect()
+            self._bytes_since_compaction = 0
+            entries, size_bytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+            if size_bytes > self.max_size_bytes:
+                target = int(self.max_size_bytes * self.LOW_WATER_MARK)
+                # the most recently used entries that fit under the target stay
+                evicted, evicted_bytes = connection.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ('
+                    ' SELECT size, SUM(size) OVER (ORDER BY last_used DESC, key) AS total FROM results'
+                    ') WHERE total > ?', (target,)).fetchone()
+                connection.execute(
+                    'DELETE FROM results WHERE key IN ('
+                    ' SELECT key FROM ('
+                    '  SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total FROM results'
+                    ' ) WHERE total > ?)', (target,))
+                connection.execute('PRAGMA incremental_vacuum')
+                connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                entries -= evicted
+                size_bytes -= evicted_bytes
+                self.evictions += evicted
+                self.compactions += 1
+                logger.info(f'Compacted the result cache {self.path}: evicted {evicted} entries')
+            self.entries = entries
+            self.size_bytes = size_bytes
+
+    def get_stats(self):
+        """A summary of the cache, as reported by the /status endpoint (sizes are as of the last compaction)"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": self.entries,
+                "sizeBytes": self.size_bytes,
+                "maxSizeBytes": self.max_size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "compactions": self.compactions,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._connection_pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+class TieredResultCache:
+    """An in-memory cache in front of a persistent one. Hits from the persistent cache are kept in memory too."""
+    blocking = True
+
+    def __init__(self, memory_cache: LRUResultCache, persistent_cache: SqliteResultCache):
+        self.memory_cache = memory_cache
+        self.persistent_cache = persistent_cache
+
+    def get(self, key: str):
+        value = self.memory_cache.get(key)
+        if value is None:
+            value = self.persistent_cache.get(key)
+            if value is not None:
+                self.memory_cache.put(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        self.memory_cache.put(key, value)
+        self.persistent_cache.put(key, value)
+
+    def get_stats(self):
+        return {"memory": self.memory_cache.get_stats(), "persistent": self.persistent_cache.get_stats()}
+
+    def close(self):
+        self.persistent_cache.close()
+
+
+def split_cached_containers(container_group_dict: dict, cache, identity: str):
+    """
+    Look up each container of a (raw) container group dict in the cache. Containers with a stored result
+    are removed (in-place); put their results back with container_utils.merge_gated_containers().
+    :return: (the cached results and their positions, e.g., {'unstructured': [(2, {...}), ...]},
+              the cache keys of the remaining containers, e.g., {'unstructured': ['ab12...', ...]})
+    """
+    cached = {}
+    keys = {}
+    if not isinstance(container_group_dict, dict):
+        return cached, keys
+    for kind in ('unstructured', 'structured'):
+        containers = container_group_dict.get(kind)
+        if not isinstance(containers, list):
+            continue
+        kept = []
+        kept_keys = []
+        hits = []
+        for i, container in enumerate(containers):
+            if not isinstance(container, dict):
+                kept.append(container)
+                kept_keys.append(None)
+                continue
+            key = compute_cache_key(identity, kind, container)
+            value = cache.get(key)
+            if value is not None:
+                hits.append((i, json.loads(value)))
+            else:
+                kept.append(container)
+                kept_keys.append(key)
+        if hits:
+            container_group_dict[kind] = kept
+            cached[kind] = hits
+        keys[kind] = kept_keys
+    return cached, keys
+
+
+def store_results(result_body: dict, keys: dict, cache):
+    """Store the output containers of a (java offset) response in the cache, under the keys of their inputs"""
+    for kind, kind_keys in keys.items():
+        for key, container in zip(kind_keys, result_body.get(kind) or []):
+            if key is not None:
+                cache.put(key, json.dumps(container, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
@@ -0,0 +1,250 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+"""
+A multi-worker server for ACD annotator apps:
+
+    python -m acd_annotator_python serve example_apps.regex_annotator:app --workers 4
+
+Unlike `uvicorn --workers`, the app is built and the annotator's on_startup() resources are loaded
+once, in the parent process, before the workers are forked. Large models are then shared between
+the workers copy-on-write instead of being loaded by each of them.
+
+The parent process supervises the workers:
+    - workers that exit (e.g., after --max-requests requests, to contain memory growth) are replaced
+    - SIGHUP gracefully replaces all of the workers, one after another
+    - SIGTERM/SIGINT gracefully shuts down all of the workers
+Note that a reload re-forks workers from the preloaded parent, so code changes need a full restart.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import logging.config
+import multiprocessing
+import os
+import random
+import signal
+import time
+
+import uvicorn
+
+from acd_annotator_python import service_utils
+from acd_annotator_python.shared_stats import SharedStats
+
+logger = logging.getLogger(__name__)
+
+# how often (in seconds) the parent checks on its workers
+SUPERVISOR_INTERVAL = 0.5
+# signals the parent handles (and its workers must not inherit handlers for)
+HANDLED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+# how long (in seconds) a stopping worker waits for connections it has accepted to send their request
+DRAIN_TIMEOUT = 5
+
+
+def load_app(app_path):
+    """
+    Import an app given as "module:attribute". The attribute can be a FastAPI app,
+    or a factory function returning one (like the example apps' `app()`).
+    """
+    from fastapi import FastAPI
+    from uvicorn.importer import import_from_string
+    app = import_from_string(app_path)
+    if not isinstance(app, FastAPI) and callable(app):
+        app = app()
+    return app
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    A uvicorn server that drains before it shuts down (e.g., when recycled after max_requests). uvicorn on
+    its own closes every connection that has no request in progress, including ones it accepted moments ago
+    whose request is still on its way, and their clients get a connection error. This one first stops
+    accepting connections (they go to the other workers), then waits for the connections it has already
+    accepted to send their request, and then lets uvicorn finish the in-flight requests and exit.
+    """
+
+    async def shutdown(self, sockets=None):
+        for server in self.servers:
+            server.close()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline and any(getattr(connection, 'cycle', None) is None
+                                                  for connection in self.server_state.connections):
+            await asyncio.sleep(0.05)
+        await super().shutdown(sockets)
+
+
+def run_worker(config, sockets, max_requests, shared_stats, worker_slot):
+    """Entry point of a forked worker process: serve requests on the (inherited) sockets"""
+    # don't inherit the parent's signal handlers. uvicorn installs its own once it is up.
+    # (signals are blocked while forking, so none can get handled by the parent's handlers in here)
+    for sig in HANDLED_SIGNALS:
+        signal.signal(sig, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+    config.limit_max_requests = max_requests
+    if shared_stats is not None:
+        shared_stats.attach(worker_slot)
+    DrainingServer(config).run(sockets=sockets)
+
+
+class WorkerSupervisor:
+    """Forks worker processes that serve the app and keeps the right number of them running"""
+
+    def __init__(self, config, sockets, num_workers, max_requests=None, max_requests_jitter=0,
+                 graceful_timeout=30, shared_stats: SharedStats = None):
+        self.config = config
+        self.sockets = sockets
+        self.num_workers = num_workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.workers = []
+        # the stats block the workers report to (one slot per worker, plus one for the extra worker
+        # that runs during a reload). The slot of a replaced worker goes to its replacement.
+        self.shared_stats = shared_stats
+        self.worker_slots = {}
+        self.free_slots = list(range(num_workers + 1))
+        self.should_exit = False
+        self.should_reload = False
+        # fork (rather than spawn) so workers inherit the preloaded app
+        self.context = multiprocessing.get_context('fork')
+
+    def start_worker(self):
+        # stagger the recycling of workers so they don't all restart at the same time
+        max_requests = None
+        if self.max_requests:
+            max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        worker_slot = self.free_slots.pop(0)
+        worker = self.context.Process(target=run_worker, args=(self.config, self.sockets, max_requests,
+                                                               self.shared_stats, worker_slot))
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        try:
+            worker.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+        logger.info(f'Started worker process {worker.pid}')
+        self.workers.append(worker)
+        self.worker_slots[worker] = worker_slot
+        return worker
+
+    def remove_worker(self, worker):
+        """Forget about a worker that has exited"""
+        self.workers.remove(worker)
+        worker_slot = self.worker_slots.pop(worker)
+        if self.shared_stats is not None:
+            self.shared_stats.detach(worker_slot)
+        self.free_slots.append(worker_slot)
+
+    def stop_workers(self, workers):
+        """Ask workers to finish their in-flight requests and exit, killing any that take too long"""
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()  # SIGTERM: uvicorn shuts down gracefully
+        deadline = time.time() + self.graceful_timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.time()))
+            if worker.is_alive():
+                logger.warning(f'Worker process {worker.pid} did not stop in time. Killing it.')
+                worker.kill()
+                worker.join()
+            if worker in self.workers:
+                self.remove_worker(worker)
+
+    def reload(self):
+        """Replace the workers one after another, so there is always one available"""
+        logger.info('Reloading workers')
+        for old_worker in list(self.workers):
+            self.start_worker()
+            self.stop_workers([old_worker])
+
+    def handle_exit(self, sig, frame):
+        self.should_exit = True
+
+    def handle_reload(self, sig, frame):
+        self.should_reload = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        logger.info(f'Started parent process {os.getpid()}')
+        # keep everything loaded so far out of the way of the garbage collector, which would
+        # otherwise touch (and so copy) the shared memory pages in each worker
+        gc.freeze()
+        for _ in range(self.num_workers):
+            self.start_worker()
+        try:
+            while not self.should_exit:
+                time.sleep(SUPERVISOR_INTERVAL)
+                if self.should_reload:
+                    self.should_reload = False
+                    self.reload()
+                # replace workers that exited (e.g., recycled after max_requests, or crashed)
+                for worker in list(self.workers):
+                    if not worker.is_alive() and not self.should_exit:
+                        logger.info(f'Worker process {worker.pid} exited with code {worker.exitcode}. Replacing it.')
+                        worker.join()
+                        self.remove_worker(worker)
+                        self.start_worker()
+        finally:
+            logger.info('Shutting down workers')
+            self.stop_workers(list(self.workers))
+            for sock in self.sockets:
+                sock.close()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('app', help='the app to serve, as "module:attribute". '
+                                    'The attribute can be a FastAPI app or a function returning one.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=service_utils.get_usable_cpu_count(),
+                        help='number of worker processes. Defaults to the number of cpus this process may use '
+                             '(e.g., a container\'s cpu limit). Each worker of an annotator that runs in a process '
+                             'pool gets an even share of the cpus for its pool.')
+    parser.add_argument('--max-requests', type=int, default=None,
+                        help='replace a worker after it has served this many requests')
+    parser.add_argument('--max-requests-jitter', type=int, default=0,
+                        help='add a random number of requests up to this to each worker\'s --max-requests')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds a worker gets to finish its in-flight requests when stopped')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--log-config', default=None,
+                        help='json logging config. Defaults to the framework\'s defaultLogSettings.json')
+    parser.add_argument('--ssl-keyfile', default=None)
+    parser.add_argument('--ssl-certfile', default=None)
+    parser.add_argument('--ssl-ciphers', default='TLSv1')
+
+
+def serve(args):
+    """Load the app in this process, then fork and supervise the workers"""
+    log_config = service_utils.DEFAULT_LOG_SETTINGS
+    if args.log_config is not None:
+        with open(args.log_config) as f:
+            log_config = json.load(f)
+    logging.config.dictConfig(log_config)
+
+    app = load_app(args.app)
+    # load the annotator's resources here, before forking, so all of the workers share them
+    shared_stats = None
+    if hasattr(app, 'acd_preload'):
+        app.acd_preload()
+        # let every worker's /status report the stats of all of the workers
+        shared_stats = SharedStats(args.workers + 1)
+        app.acd_shared_stats = shared_stats
+        # and split the cpus between the workers' process pools, if any
+        app.acd_worker_processes = args.workers
+
+    config = uvicorn.Config(app, host=args.host, port=args.port, backlog=args.backlog, log_config=log_config,
+                            ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile,
+                            ssl_ciphers=args.ssl_ciphers)
+    sockets = [config.bind_socket()]
+    WorkerSupervisor(config, sockets, args.workers, args.max_requests, args.max_requests_jitter,
+                     args.graceful_timeout, shared_stats).run()
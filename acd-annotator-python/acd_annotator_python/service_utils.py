@@ -6,6 +6,9 @@
 #                                                                   #
 # ***************************************************************** #
 
+import asyncio
+import collections
+import contextlib
 import contextvars
 import json
 import os
@@ -20,6 +23,9 @@ import platform
 import psutil
 
 from fastapi import HTTPException, status, Request
+from fastapi.responses import JSONResponse
+
+from acd_annotator_python.shared_stats import SharedStats
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +44,42 @@ async def get_num_processors():
     return multiprocessing.cpu_count()
 
 
+def get_usable_cpu_count():
+    """
+    Get the number of cpus this process can actually use: the ones it is allowed to run on, capped by its cgroup's
+    cpu quota (e.g., a container's cpu limit). In a container, multiprocessing.cpu_count() counts the host's cpus.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on every platform (e.g., macOS)
+        cpus = multiprocessing.cpu_count()
+    quota = _get_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def _get_cgroup_cpu_quota():
+    """The cpu quota (in cpus) of this process' cgroup, or None if it has none"""
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" for no quota
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 means none
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
 def set_max_threads(max_workers):
     """
     Set the maximum number of threads this server can use
@@ -58,11 +100,43 @@ def set_max_threads(max_workers):
         pass
 
 
+async def gather_bounded(limit, coroutine_functions):
+    """
+    Run the given coroutine functions (each called with no arguments), at most `limit` at a time,
+    and return their results in order. If one of them raises, the others are cancelled and
+    the exception is passed on.
+    :param limit: max number to run at once. 1 (or less) runs them one after another.
+    :param coroutine_functions:
+    :return: list of results
+    """
+    if limit <= 1 or len(coroutine_functions) <= 1:
+        return [await coroutine_function() for coroutine_function in coroutine_functions]
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_bounded(coroutine_function):
+        async with semaphore:
+            return await coroutine_function()
+
+    tasks = [asyncio.ensure_future(run_bounded(coroutine_function)) for coroutine_function in coroutine_functions]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # let the cancelled tasks finish up before passing on the error
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 class ServiceInfo:
-    def __init__(self):
+    def __init__(self, shared_stats: SharedStats = None):
         self.startTime = time.time()
         self.hostname = socket.gethostname()
-        self.request_count = 0
+        # stats shared by all of the server's workers (or just this process' stats)
+        self.shared_stats = shared_stats if shared_stats is not None else SharedStats()
+        if self.shared_stats.worker_slot is None:
+            self.shared_stats.attach(0)
 
     def get_uptime(self):
         # compute uptime since the server started
@@ -72,10 +146,10 @@ class ServiceInfo:
         return "{:01}d {:02}:{:02}:{:02}".format(td.days, hours, minutes, seconds)
 
     async def increment_request_count(self):
-        self.request_count += 1
+        self.shared_stats.increment('requestCount')
 
     async def get_request_count(self):
-        return self.request_count
+        return self.shared_stats.get_stats()['requestCount']
 
 
 async def get_max_rss_mb():
@@ -138,14 +212,104 @@ class ACDException(HTTPException):
     """
 
     def __init__(self, status_code=500,
-                 description="Unknown error. See logs for details."):
+                 description="Unknown error. See logs for details.", headers=None):
         """ Create a normal HTTPException with a json body containin ACD expected fields."""
         HTTPException.__init__(self, status_code=status_code, detail={
             "code": status_code,
             "message": STATUS_CODE_MESSAGES.get(status_code, ServerState.error),
             "level": ServerState.error,
             "description": description,
-        })
+        }, headers=headers)
+
+    def __reduce__(self):
+        # make sure these survive being sent back from a worker process (see process_pool)
+        return type(self), (self.status_code, self.detail["description"], self.headers)
+
+    def to_response(self):
+        """The response fastapi would send for this exception (for use outside of the exception handlers)"""
+        return JSONResponse({"detail": self.detail}, status_code=self.status_code, headers=self.headers)
+
+
+class AdmissionController:
+    """
+    Caps the number of requests processed at once. Requests over the cap wait in a bounded (FIFO) queue,
+    and once the queue is full, new requests are turned away right away with a 503 and a Retry-After header,
+    so the server sheds load that the caller can retry instead of running out of memory.
+    """
+
+    def __init__(self, max_concurrent_requests, max_queued_requests, retry_after_seconds,
+                 shared_stats: SharedStats = None):
+        """
+        :param max_concurrent_requests: 0 (or less) means no limit
+        :param max_queued_requests: max number of requests waiting for a slot
+        :param retry_after_seconds: sent back to rejected requests
+        :param shared_stats: where to also count requests for the /status of a multi-worker server
+        """
+        self.shared_stats = shared_stats
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_queued_requests = max_queued_requests
+        self.retry_after_seconds = retry_after_seconds
+        self.concurrent_requests = 0
+        self.total_rejected_requests = 0
+        self.total_blocked_requests = 0
+        # futures of the requests waiting for a slot
+        self._waiters = collections.deque()
+
+    @property
+    def queued_requests(self):
+        return len(self._waiters)
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """
+        Hold one of the request slots for the duration of the with block,
+        waiting for one if necessary. Raises a 503 ACDException if the queue is full.
+        """
+        if 0 < self.max_concurrent_requests <= self.concurrent_requests:
+            if len(self._waiters) >= self.max_queued_requests:
+                self.total_rejected_requests += 1
+                self._count('totalRejectedRequests')
+                raise ACDException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                   description="The server is busy. Try again later.",
+                                   headers={"Retry-After": str(self.retry_after_seconds)})
+            self.total_blocked_requests += 1
+            self._count('totalBlockedRequests')
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._count('queuedRequests')
+            try:
+                # the slot is handed over directly by the request that releases it (see _release)
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # we were handed a slot just as we gave up waiting. Pass it on.
+                    self._release()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._count('queuedRequests', -1)
+                raise
+        else:
+            self.concurrent_requests += 1
+            self._count('concurrentRequests')
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        """Hand our slot to the next waiting request, if any"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            self._count('queuedRequests', -1)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.concurrent_requests -= 1
+        self._count('concurrentRequests', -1)
+
+    def _count(self, field, amount=1):
+        if self.shared_stats is not None:
+            self.shared_stats.increment(field, amount)
 
 
 async def is_annotator_healthy(custom_annotator, app):
@@ -240,6 +404,53 @@ class ACDDateFormatter(logging.Formatter):
 # correlation id for the current requests (acts like a thread local variable)
 correlation_id_var = contextvars.ContextVar("correlation_id")
 
+# the time (as in time.time()) by which the current request must be done, or None if it has no deadline
+deadline_var = contextvars.ContextVar("deadline", default=None)
+
+# request header that sets the number of seconds the caller is willing to wait for a response
+REQUEST_TIMEOUT_HEADER = 'x-request-timeout'
+
+
+def get_request_deadline(request: Request, default_timeout, start_time):
+    """
+    Work out the deadline for a request from its timeout header, falling back to the configured default.
+    :param request:
+    :param default_timeout: in seconds. 0 (or less) means no deadline.
+    :param start_time: when the request arrived (as in time.time())
+    :return: deadline (as in time.time()), or None for no deadline
+    """
+    timeout = request.headers.get(REQUEST_TIMEOUT_HEADER)
+    if timeout is None:
+        timeout = default_timeout
+    else:
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise ACDException(status_code=status.HTTP_400_BAD_REQUEST,
+                               description=f"Invalid {REQUEST_TIMEOUT_HEADER} header. Expected a number of seconds.")
+    if timeout <= 0:
+        return None
+    return start_time + timeout
+
+
+def get_time_remaining():
+    """
+    Seconds left until the current request's deadline (possibly negative), or None if it has no deadline.
+    Annotators doing long-running work can check this (or call check_deadline()) to stop early.
+    """
+    deadline = deadline_var.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def check_deadline():
+    """Raise a 504 ACDException if the current request is past its deadline"""
+    time_remaining = get_time_remaining()
+    if time_remaining is not None and time_remaining <= 0:
+        raise ACDException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                           description="The request did not finish before its deadline.")
+
 
 class AppendACDMetadataLogFilter(logging.Filter):
     """
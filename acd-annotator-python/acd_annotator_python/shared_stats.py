@@ -0,0 +1,89 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import multiprocessing
+import os
+
+# upper bounds (in milliseconds) of the request latency histogram buckets. A final bucket catches the rest.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# counters kept for each worker
+COUNTER_FIELDS = ('requestCount', 'concurrentRequests', 'queuedRequests', 'totalRejectedRequests',
+                  'totalBlockedRequests', 'totalLatencyMs')
+# counters of what is going on right now, rather than totals, which don't outlive the worker
+GAUGE_FIELDS = ('concurrentRequests', 'queuedRequests')
+# the layout of one worker's slot: its pid, its counters and its latency histogram
+SLOT_FIELDS = ('pid',) + COUNTER_FIELDS + tuple(f'latency{i}' for i in range(len(LATENCY_BUCKETS_MS) + 1))
+
+
+class SharedStats:
+    """
+    Service stats kept in shared memory, so that /status can report them for all of the workers of a server
+    no matter which worker answers. Each worker updates its own slot (so no locking is needed);
+    readers add up the slots. The block has to be created before the workers are forked (see server.py).
+    In a single-process server this is just a block of ordinary counters.
+    """
+
+    def __init__(self, num_slots: int = 1):
+        self.num_slots = num_slots
+        # shared anonymous memory that forked processes inherit
+        self.values = multiprocessing.RawArray('q', num_slots * len(SLOT_FIELDS))
+        # the slot of the current process (set in each worker after forking)
+        self.worker_slot = None
+
+    def _index(self, slot, field):
+        return slot * len(SLOT_FIELDS) + SLOT_FIELDS.index(field)
+
+    def attach(self, worker_slot: int):
+        """Claim a slot for the current process. Counters carry over from previous owners of the slot."""
+        self.worker_slot = worker_slot
+        self.values[self._index(worker_slot, 'pid')] = os.getpid()
+        for field in GAUGE_FIELDS:
+            self.values[self._index(worker_slot, field)] = 0
+
+    def detach(self, worker_slot: int):
+        """Release a slot whose worker exited (e.g., called by the parent process)"""
+        self.values[self._index(worker_slot, 'pid')] = 0
+        # a worker that died mid-request leaves nothing in flight or waiting
+        for field in GAUGE_FIELDS:
+            self.values[self._index(worker_slot, field)] = 0
+
+    def increment(self, field, amount=1):
+        """Add to one of the current process' counters"""
+        self.values[self._index(self.worker_slot, field)] += amount
+
+    def record_latency(self, seconds):
+        """Add a request's latency to the current process' latency histogram"""
+        latency_ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if latency_ms <= bound),
+                      len(LATENCY_BUCKETS_MS))
+        self.increment(f'latency{bucket}')
+        self.increment('totalLatencyMs', round(latency_ms))
+
+    def _get_slot_stats(self, slots):
+        stats = {field: sum(self.values[self._index(slot, field)] for slot in slots) for field in COUNTER_FIELDS}
+        bucket_names = [str(bound) for bound in LATENCY_BUCKETS_MS] + ['+Inf']
+        stats['latencyHistogramMs'] = {
+            name: sum(self.values[self._index(slot, f'latency{i}')] for slot in slots)
+            for i, name in enumerate(bucket_names)}
+        return stats
+
+    def get_worker_stats(self):
+        """The stats of each live worker"""
+        worker_stats = []
+        for slot in range(self.num_slots):
+            pid = self.values[self._index(slot, 'pid')]
+            if pid:
+                worker_stats.append({'pid': pid, **self._get_slot_stats([slot])})
+        return worker_stats
+
+    def get_stats(self):
+        """The stats of all of the workers (past and present) added up"""
+        stats = self._get_slot_stats(range(self.num_slots))
+        stats['workers'] = sum(1 for slot in range(self.num_slots) if self.values[self._index(slot, 'pid')])
+        return stats
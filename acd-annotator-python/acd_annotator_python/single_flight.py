@@ -0,0 +1,72 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def compute_request_key(body: bytes):
+    """The key of a request body: identical bodies get the same key"""
+    return hashlib.sha256(body).hexdigest()
+
+
+class Flight:
+    """Work in flight for one key, and how many callers are waiting for it"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs identical work only once while it is in flight: callers that ask for the result of a key that
+    is already being worked on wait for that work instead of starting their own, e.g., when a client
+    retries a request that is still being processed. Nothing is kept once the work is done (this is not a cache).
+    """
+
+    def __init__(self):
+        # key -> Flight doing the work
+        self.in_flight = {}
+        self.total_deduplicated = 0
+
+    async def run(self, key, func, timeout=None):
+        """
+        Await func() (an async function), or the call to it that is already in flight for the same key.
+        Every caller gets the same result, or the same exception.
+        :param timeout: seconds this caller waits (None for no limit) before it gets an asyncio.TimeoutError.
+        The work itself goes on for as long as anyone is waiting for it.
+        """
+        flight = self.in_flight.get(key)
+        if flight is None:
+            # the work runs in a task of its own (with a copy of the first caller's context), so callers that
+            # give up (e.g., are cancelled or time out) don't cancel it for the others
+            flight = Flight(asyncio.ensure_future(func()))
+            self.in_flight[key] = flight
+            flight.task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.total_deduplicated += 1
+            logger.info('Joining an identical request that is already in flight')
+        flight.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), timeout)
+        finally:
+            flight.waiters -= 1
+            # nobody is left to get the result
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def get_stats(self):
+        """A summary of the in-flight work, as reported by the /status endpoint"""
+        return {
+            "inFlight": len(self.in_flight),
+            "totalDeduplicated": self.total_deduplicated,
+        }
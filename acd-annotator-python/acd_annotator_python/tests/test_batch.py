@@ -0,0 +1,56 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import io
+import json
+import pytest
+from fastapi import Request
+
+from acd_annotator_python import batch
+from acd_annotator_python import fastapi_app_factory
+from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.container_model.main import UnstructuredContainer
+
+
+class WordAnnotator(ACDAnnotator):
+    """A simple annotator that marks the first word of each container"""
+    def on_startup(self, app):
+        pass
+
+    async def is_healthy(self, app):
+        return True
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        end = (unstructured_container.text + ' ').index(' ')
+        unstructured_container.data.concepts = [{"cui": "C1", "begin": 0, "end": end,
+                                                 "coveredText": unstructured_container.text[:end]}]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_batch(workers):
+    documents = [
+        {"unstructured": [{"text": f"😀{i} note"}]} for i in range(50)
+    ]
+    lines = [json.dumps(document) for document in documents]
+    # an invalid document and a blank line in the middle
+    lines[10:10] = ['{"unstructured": [{"data": {}}]}', '']
+    in_file = io.StringIO('\n'.join(lines) + '\n')
+    out_file = io.StringIO()
+    app = fastapi_app_factory.build(WordAnnotator())
+    stats = batch.run_batch(app, in_file, out_file, workers, chunk_size=4)
+    assert stats['documents'] == 51 and stats['errors'] == 1
+    # the worker processes split the cpus between any process pools they run
+    assert app.acd_worker_processes == max(workers, 1)
+    results = [json.loads(line) for line in out_file.getvalue().splitlines()]
+    assert results[10]['detail']['code'] == 400
+    del results[10]
+    # in order, with java (utf-16) offsets like the http service
+    for i, result in enumerate(results):
+        concept = result['unstructured'][0]['data']['concepts'][0]
+        assert concept['coveredText'] == f'😀{i}'
+        assert concept['end'] == 2 + len(str(i))
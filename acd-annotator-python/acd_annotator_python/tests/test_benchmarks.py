@@ -0,0 +1,93 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import json
+
+import pytest
+
+from acd_annotator_python import container_utils
+from acd_annotator_python.benchmarks import runner
+from acd_annotator_python.benchmarks.generator import generate_container_group
+from acd_annotator_python.container_model.main import ContainerGroup
+
+
+def test_generate_container_group():
+    parameters = dict(unstructured=2, structured=3, text_size=2000, surrogate_pair_density=0.1, concepts=20,
+                      attribute_values=10, insight_model_data_depth=4)
+    body = generate_container_group(7, **parameters)
+    # the same seed and parameters give the same request
+    assert body == generate_container_group(7, **parameters)
+    assert body != generate_container_group(8, **parameters)
+
+    assert len(body["unstructured"]) == 2
+    assert len(body["structured"]) == 3
+    # the offsets are java offsets: they only match the text once translated
+    container_group = ContainerGroup(**container_utils.java2python(json.loads(json.dumps(body))))
+    for unstructured_container in container_group.unstructured:
+        text = unstructured_container.text
+        assert len(text) == 2000
+        assert container_utils.OffsetMap(text).has_surrogate_pairs
+        data = unstructured_container.data
+        assert len(data.concepts) == 20
+        assert len(data.attributeValues) == 10
+        for annotation in data.concepts + data.attributeValues:
+            assert text[annotation.begin:annotation.end] == annotation.coveredText
+            evidence = annotation.insightModelData.normality.evidence
+            assert all(text[span.begin:span.end] == span.coveredText for span in evidence)
+            assert annotation.insightModelData.medication.adverseEvent is not None
+    assert container_group.structured[0].data.heightInches > 0
+
+    # no insight model data, no surrogate pairs
+    body = generate_container_group(text_size=100, surrogate_pair_density=0, insight_model_data_depth=0)
+    concept = body["unstructured"][0]["data"]["concepts"][0]
+    assert "insightModelData" not in concept
+    assert body["unstructured"][0]["text"][concept["begin"]:concept["end"]] == concept["coveredText"]
+
+
+def test_run_benchmarks():
+    report = runner.run_benchmarks(['example_apps.regex_annotator:app'], repeat=2, warmup=0, text_size=500,
+                                   concepts=5, attribute_values=5)
+    assert report["parameters"]["text_size"] == 500
+    assert report["parameters"]["structured"] == runner.DEFAULT_PARAMETERS["structured"]
+    assert set(report["results"]) == {"java2python", "validate", "from_dict.full", "from_dict.shallow",
+                                      "from_dict.trusted", "dict", "python2java",
+                                      "regex_annotator.annotate", "regex_annotator.process"}
+    for result in report["results"].values():
+        assert result["repeat"] == 2
+        assert 0 < result["minMs"] <= result["medianMs"] <= result["maxMs"]
+
+
+def test_compare():
+    def make_report(**medians):
+        return {"seed": 0, "parameters": {}, "environment": {},
+                "results": {stage: {"medianMs": median} for stage, median in medians.items()}}
+
+    baseline = make_report(validate=10.0, dict=4.0, removed=1.0)
+    comparison = runner.compare(make_report(validate=11.0, dict=6.0, added=1.0), baseline, max_regression=0.2)
+    # only the stages in both are compared
+    assert set(comparison) == {"validate", "dict"}
+    assert comparison["validate"] == {"baselineMedianMs": 10.0, "medianMs": 11.0, "ratio": 1.1,
+                                      "regression": False}
+    assert comparison["dict"]["ratio"] == 1.5
+    assert comparison["dict"]["regression"]
+
+
+@pytest.mark.parametrize('max_regression,status', [(1000.0, 0), (-1.0, 1)])
+def test_main(tmp_path, max_regression, status):
+    args = ['--app', 'example_apps.bmi_annotator:app', '--repeat', '1', '--warmup', '0', '--text-size', '200']
+    out_path = tmp_path / 'baseline.json'
+    with pytest.raises(SystemExit) as e:
+        runner.main(args + ['--out', str(out_path)])
+    assert e.value.code == 0
+    baseline = json.loads(out_path.read_text())
+    assert "bmi_annotator.process" in baseline["results"]
+
+    # a regression (any at all with a negative allowance) fails the run
+    with pytest.raises(SystemExit) as e:
+        runner.main(args + ['--baseline', str(out_path), '--max-regression', str(max_regression)])
+    assert e.value.code == status
@@ -0,0 +1,119 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import json
+import re
+
+import pytest
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+from acd_annotator_python import chunking
+from acd_annotator_python import fastapi_app_factory
+from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.container_model.main import UnstructuredContainer
+from acd_annotator_python.fastapi_app_factory import DEFAULT_BASE_URL as BASE_URL
+
+TEXT = ' '.join(f'Sentence {i} mentions a 😀 patient.' for i in range(30))
+
+
+class WordAnnotator(ACDAnnotator):
+    """A simple annotator that annotates every "patient" and records how much text it saw at once"""
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = 40
+        self.text_lengths = []
+
+    def on_startup(self, app):
+        pass
+
+    async def is_healthy(self, app):
+        return True
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        text = unstructured_container.text
+        self.text_lengths.append(len(text))
+        unstructured_container.data.concepts = (unstructured_container.data.concepts or []) + [
+            {"cui": "C1", "begin": match.start(), "end": match.end(), "coveredText": match.group()}
+            for match in re.finditer('patient', text)]
+        unstructured_container.data.chunked = True
+
+
+def test_find_chunk_spans():
+    spans = chunking.find_chunk_spans(TEXT, 100, 30)
+    assert spans[0][0] == 0 and spans[-1][1] == len(TEXT)
+    for (begin, end), (next_begin, next_end) in zip(spans, spans[1:]):
+        assert end - begin <= 100
+        # overlapping, and ending after a sentence
+        assert begin < next_begin < end
+        assert TEXT[end - 2] == '.'
+    # short text is one chunk
+    assert chunking.find_chunk_spans('short', 100, 30) == [(0, 5)]
+
+
+def test_merge_chunks_cut_annotation():
+    text = ' '.join(['word'] * 60)
+    plan = chunking.ChunkPlan(chunking.find_chunk_spans(text, 100, 20))
+    assert plan.spans[:2] == [(0, 100), (85, 185)]
+    chunk_dicts = [{'text': text[begin:end], 'data': {'concepts': []}} for begin, end in plan.spans]
+    # an annotation crossing the first chunk's cut: the first chunk only sees a fragment of it, the second all of it
+    chunk_dicts[0]['data']['concepts'].append({'cui': 'C1', 'begin': 87, 'end': 100})
+    chunk_dicts[1]['data']['concepts'].append({'cui': 'C1', 'begin': 87 - 85, 'end': 110 - 85})
+    # one that ends the text is whole
+    chunk_dicts[-1]['data']['concepts'].append({'cui': 'C2', 'begin': 295 - 255, 'end': 299 - 255})
+    merged = chunking.merge_chunks({'text': text, 'data': {}}, plan, chunk_dicts, {})
+    assert merged['data']['concepts'] == [{'cui': 'C1', 'begin': 87, 'end': 110},
+                                          {'cui': 'C2', 'begin': 295, 'end': 299}]
+
+
+def test_process_in_chunks():
+    headers = {'content-type': 'application/json'}
+    input_concepts = [
+        # spans the whole text, so it fits in no chunk
+        {"cui": "C0", "begin": 0, "end": len(TEXT), "coveredText": TEXT},
+        {"cui": "C2", "begin": 400, "end": 410, "coveredText": TEXT[400:410]},
+    ]
+    request = json.dumps({"unstructured": [{"text": TEXT, "data": {"concepts": input_concepts}}]})
+    responses = []
+    for annotator in (WordAnnotator(), WordAnnotator(chunk_size=200)):
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+            responses.append(response.json()['unstructured'][0])
+    unchunked, chunked = responses
+    assert max(annotator.text_lengths) <= 200 and len(annotator.text_lengths) > 1
+    assert chunked['text'] == TEXT and chunked['data']['chunked']
+
+    # the same annotations (with java offsets), each once
+    def key(concept):
+        return concept['begin'], concept['end'], concept['cui']
+    assert len(chunked['data']['concepts']) == 32
+    assert sorted(chunked['data']['concepts'], key=key) == sorted(unchunked['data']['concepts'], key=key)
+
+
+class InvalidSpanAnnotator(WordAnnotator):
+    """Reads the concepts and adds one with an invalid span to them in-place (so it isn't validated right away)"""
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        unstructured_container.data.concepts.append({"cui": "C9", "begin": "not a number", "end": 3})
+
+
+@pytest.mark.parametrize('validation_level,input_begin,status_code', [
+    # invalid output is caught on the way out, for chunks like for whole containers
+    ('trusted', 400, 500),
+    # invalid input is caught when the annotator reads it, from chunks like from whole containers
+    ('shallow', 'not a number', 400),
+])
+def test_process_in_chunks_validation(monkeypatch, validation_level, input_begin, status_code):
+    monkeypatch.setenv('com_ibm_watson_health_common_python_validation_level', validation_level)
+    headers = {'content-type': 'application/json'}
+    input_concepts = [{"cui": "C2", "begin": input_begin, "end": 410, "coveredText": TEXT[400:410]}]
+    request = json.dumps({"unstructured": [{"text": TEXT, "data": {"concepts": input_concepts}}]})
+    for annotator in (InvalidSpanAnnotator(), InvalidSpanAnnotator(chunk_size=200)):
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == status_code
@@ -11,6 +11,7 @@ import os
 import importlib
 import pytest
 from pydantic import ValidationError
+from typing import Optional
 
 from acd_annotator_python import container_utils
 from acd_annotator_python import container_model
@@ -403,6 +404,71 @@ def test_edit_concepts():
         concept.cui = 1  # should be string
 
 
+def test_bulk_edit():
+    set_strict_validation()
+
+    container_group = main.ContainerGroup(**{'unstructured': [{'text': 'the cow jumped over the moon', 'data': {
+        'concepts': [{'begin': 4, 'end': 7, 'coveredText': 'cow'}, {'begin': 8, 'end': 14}],
+        'relations': [{'score': 1, 'nodes': []}],
+    }}]})
+    data = container_group.unstructured[0].data
+    # shifting a span to the right temporarily makes begin >= end, which is fine inside a bulk edit
+    with data.bulk_edit():
+        for concept in data.concepts:
+            concept.begin += 20
+            concept.end += 20
+        data.relations[0].score = 0
+    assert [(c.begin, c.end) for c in data.concepts] == [(24, 27), (28, 34)]
+    # validation conversions still apply
+    assert isinstance(data.relations[0].score, float)
+
+    # invalid edits are reported when the block ends
+    with pytest.raises(ValidationError):
+        with data.bulk_edit():
+            data.concepts[0].begin = 'b'
+    with pytest.raises(ValidationError):
+        with data.bulk_edit():
+            data.concepts[1].end = 0
+            with data.bulk_edit():
+                data.concepts[1].begin = 1
+    # and leave no trace: every edit of a failed block is undone, valid ones included
+    with pytest.raises(ValidationError):
+        with data.bulk_edit():
+            data.relations[0].score = 2
+            data.concepts[0].type = 'edited'
+            data.concepts[0].begin = 'b'
+    assert [(c.begin, c.end) for c in data.concepts] == [(24, 27), (28, 34)]
+    assert data.relations[0].score == 0 and data.concepts[0].type is None
+    assert 'type' not in data.concepts[0].dict(exclude_unset=True)
+    with pytest.raises(RuntimeError):
+        with data.bulk_edit():
+            data.concepts[0].begin = 'b'
+            raise RuntimeError
+    assert data.concepts[0].begin == 24
+
+    # only the fields edited in the block are validated (plus the root validators), like single assignments
+    data.concepts[1].__dict__['cui'] = 1  # invalid, but already there
+    with data.bulk_edit():
+        data.concepts[1].type = 'edited'
+    assert data.concepts[1].type == 'edited'
+    with pytest.raises(ValidationError):
+        with data.bulk_edit():
+            data.concepts[1].begin = 40  # past end
+    assert data.concepts[1].begin == 28
+    data.concepts[1].__dict__['cui'] = None
+
+    # lazily parsed fields come back raw
+    lazy_data = main.UnstructuredContainerData.lazy({'concepts': [{'begin': 0, 'end': 3}]})
+    with pytest.raises(ValidationError):
+        with lazy_data.bulk_edit():
+            lazy_data.concepts = 'not a list'
+    assert lazy_data.dict(exclude_none=True) == {'concepts': [{'begin': 0, 'end': 3}]}
+
+    # outside of a bulk edit, assignments are validated right away again
+    with pytest.raises(ValidationError):
+        data.concepts[0].begin = -1
+
+
 def test_edit_unstructured_container():
     """
     We need validation to happen at runtime each time the container model is edited,
@@ -494,6 +560,31 @@ def test_obvious_misspelling():
     with pytest.raises(ValidationError):
         clinical_insights.InsightModelAlcoholUsage(use_score=.5, discussed_score=.2)
 
+    # repeated key shapes are remembered, and still caught when misspelled
+    for _ in range(3):
+        annotations.MedicationInd(begin=0, end=8, coveredText='anteater', type='bogus')
+        with pytest.raises(ValidationError):
+            annotations.MedicationInd(begin=0, end=8, coveredText='anteater', Type='bogus')
+
+
+def test_misspelling_index_add_fields():
+    set_strict_validation()
+
+    class Pet(common.BaseModelACD):
+        name: Optional[str]
+
+    class Dog(Pet):
+        pass
+
+    Pet(name='rex', favoriteToy='ball', favorite_toy='stick')
+    Dog(name='rex', favoriteToy='ball', favorite_toy='stick')
+    # once favoriteToy is a real field, favorite_toy looks like a misspelling of it
+    Pet.add_fields(favoriteToy=Optional[str])
+    with pytest.raises(ValidationError):
+        Pet(name='rex', favoriteToy='ball', favorite_toy='stick')
+    # subclasses keep their own fields
+    Dog(name='rex', favoriteToy='ball', favorite_toy='stick')
+
 
 def test_attribute_value_ref():
     set_strict_validation()
@@ -599,6 +690,33 @@ def test_permissive_mode():
     set_permissive_validation()
     main.ContainerGroup(**example_container_dic)
 
+
+def test_lazy_container_data():
+    set_strict_validation()
+
+    data = main.UnstructuredContainerData.lazy({
+        'concepts': [{'begin': 0, 'end': 1}],
+        'sections': [{'begin': 0, 'end': 1}],
+        'relations': [{'nodes': []}],
+        'bogus': 1,
+    })
+    # nothing has been materialized yet, so raw values are passed through
+    assert data.dict(exclude_none=True)['concepts'] == [{'begin': 0, 'end': 1}]
+    # accessing a field builds the pydantic objects
+    assert isinstance(data.concepts[0], annotations.Concept)
+    assert data.bogus == 1
+    # assigning or deleting a field replaces the raw value
+    data.sections = []
+    del data.relations
+    assert data.dict(exclude_none=True) == {'concepts': [{'begin': 0, 'end': 1}], 'sections': [], 'bogus': 1}
+    with pytest.raises(AttributeError):
+        data.relations
+    with pytest.raises(ValidationError):
+        data.concepts[0].begin = 'b'
+    # misspelled keys are caught up front
+    with pytest.raises(ValidationError):
+        main.UnstructuredContainerData.lazy({'Concepts': []})
+
 # # enable to debug
 # if __name__ == '__main__':
 #     # test_validate_annotation()
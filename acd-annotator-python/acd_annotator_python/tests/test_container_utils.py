@@ -6,7 +6,15 @@
 #                                                                   #
 # ***************************************************************** #
 
+import pytest
+from pydantic import ValidationError
+from typing import Dict, List, Optional, Union
+
 from acd_annotator_python import container_utils
+from acd_annotator_python import preconditions
+from acd_annotator_python.container_model import main as acd_datamodel
+from acd_annotator_python.container_model import common
+from acd_annotator_python.container_model.common import DeferredValidationError
 
 
 def test_compute_java_to_python_character_alignment():
@@ -53,6 +61,73 @@ def test_compute_java_to_python_character_alignment():
     assert align[8] == 2  # a
 
 
+def test_sparse_alignment():
+    # a long doc with a single surrogate pair only stores that one position
+    text = 'a' * 100000 + chr(0x10000) + 'a' * 100000
+    align = container_utils.compute_java_to_python_character_alignment(text)
+    assert len(align) == 200002
+    assert align.offset_map.second_half_java_offsets == [100001]
+    assert align[0] == 0
+    assert align[100000] == 0
+    assert align[100001] == 1
+    assert align[200001] == 1
+    assert align[-1] == 1
+    with pytest.raises(IndexError):
+        align[200002]
+
+    align = container_utils.compute_java_to_python_character_alignment(
+        '{}{}a{}'.format(chr(0x10000), chr(0x10ffff), chr(0x10000)))
+    assert list(align) == [0, 1, 1, 2, 2, 2, 3]
+
+
+def test_offset_map():
+    offset_map = container_utils.OffsetMap('the_cow_{}_jumped'.format(chr(0x10000)))
+    assert offset_map.has_surrogate_pairs
+    assert offset_map.java_length == 17
+    assert offset_map.java_to_python(11) == 10
+    assert offset_map.python_to_java(10) == 11
+    assert not container_utils.OffsetMap('the_cow').has_surrogate_pairs
+
+    # many surrogate pairs in a row. conversions must round trip in both directions.
+    text = 'a{}{}{}b{}{}c'.format(*[chr(0x1F600)] * 5)
+    offset_map = container_utils.OffsetMap(text)
+    java_text = text.encode('utf-16-le')
+    for python_offset in range(len(text) + 1):
+        java_offset = offset_map.python_to_java(python_offset)
+        assert len(text[:python_offset].encode('utf-16-le')) // 2 == java_offset
+        assert offset_map.java_to_python(java_offset) == python_offset
+    assert offset_map.java_length == len(java_text) // 2
+
+
+def test_java2python_python2java_round_trip():
+    text = 'hi {}{}{} there {}{} friend'.format(*[chr(0x1F600)] * 5)
+    container = {'unstructured': [{'text': text, 'data': {'concepts': [
+        {'begin': 10, 'end': 15, 'coveredText': 'there'},
+        {'begin': 21, 'end': 27, 'coveredText': 'friend'},
+    ]}}]}
+    offset_maps = container_utils.compute_offset_maps(container)
+    result = container_utils.java2python(container, offset_maps)
+    concepts = result['unstructured'][0]['data']['concepts']
+    assert [text[c['begin']:c['end']] for c in concepts] == ['there', 'friend']
+    result = container_utils.python2java(result, offset_maps)
+    concepts = result['unstructured'][0]['data']['concepts']
+    assert [(c['begin'], c['end']) for c in concepts] == [(10, 15), (21, 27)]
+
+
+def test_attach_offset_maps():
+    container = {'unstructured': [{'text': 'the_cow_{}_jumped'.format(chr(0x10000))}]}
+    offset_maps = container_utils.compute_offset_maps(container)
+    container_group = container_utils.from_dict(container)
+    container_utils.attach_offset_maps(container_group, offset_maps)
+    unstructured_container = container_group.unstructured[0]
+    assert unstructured_container.offset_map is offset_maps[0]
+    # a stale map is rebuilt if the text changes
+    unstructured_container.text = 'the_cow'
+    assert not unstructured_container.offset_map.has_surrogate_pairs
+    assert unstructured_container.dict() == {'text': 'the_cow', 'data': None, 'id': None, 'type': None,
+                                             'metadata': None, 'uid': None}
+
+
 def test_java2python():
     test_container = {}
     result = container_utils.java2python(test_container)
@@ -114,6 +189,81 @@ def test_java2python():
     assert result['unstructured'][0]['data']['concepts'][1]['end'] == 23
 
 
+def test_span_walk_plan():
+    plan = container_utils.get_span_walk_plan(acd_datamodel.UnstructuredContainerData)
+    concept_plan = plan.children['concepts']
+    assert concept_plan.has_span
+    # insight model scores can't hold spans, but modifiers can
+    insight_plan = concept_plan.children['insightModelData']
+    assert 'usage' not in insight_plan.children['diagnosis'].children
+    assert insight_plan.children['diagnosis'].children['modifiers'].children['sites'].has_span
+    assert 'disambiguationData' not in concept_plan.children
+
+    text = 'the_cow_{}_jumped'.format(chr(0x10000))
+    span = {'begin': 11, 'end': 17}
+    test_container = {'unstructured': [{'text': text, 'data': {"concepts": [{
+        **span,
+        'temporal': [dict(span)],
+        'insightModelData': {'diagnosis': {
+            'usage': {'explicitScore': 1.0},
+            'modifiers': {'sites': [dict(span)]},
+        }},
+        # known fields that can't hold spans are skipped
+        'disambiguationData': {'validity': 'VALID', 'bogus': dict(span)},
+        # unknown fields are searched
+        'bogus': {'bogus': [dict(span)]},
+    }]}}]}
+    result = container_utils.java2python(test_container)
+    concept = result['unstructured'][0]['data']['concepts'][0]
+    converted = {'begin': 10, 'end': 16}
+    assert {'begin': concept['begin'], 'end': concept['end']} == converted
+    assert concept['temporal'][0] == converted
+    assert concept['insightModelData']['diagnosis']['modifiers']['sites'][0] == converted
+    assert concept['disambiguationData']['bogus'] == span
+    assert concept['bogus']['bogus'][0] == converted
+
+    # fields added to the model are picked up
+    class Sentence(common.BaseAnnotation):
+        pass
+
+    class Paragraph(common.BaseModelACD):
+        sentences: Optional[List[Sentence]]
+        score: Optional[float]
+
+    class TestData(common.BaseModelACD):
+        pass
+
+    assert container_utils.get_span_walk_plan(TestData) is None
+    TestData.add_fields(paragraphs=Optional[List[Paragraph]])
+    # to the class itself, even though it had no annotations of its own
+    assert TestData.__annotations__ == {'paragraphs': Optional[List[Paragraph]]}
+    assert 'paragraphs' not in common.BaseModelACD.__dict__.get('__annotations__', {})
+
+    # fields the plan can't follow the structure of are searched
+    class RawData(common.BaseModelACD):
+        pass
+
+    RawData.add_fields(raw=Optional[List[dict]], by_id=Optional[Dict[str, Sentence]],
+                       either=Optional[Union[Sentence, Paragraph]], scores=Optional[Dict[str, float]])
+    plan = container_utils.get_span_walk_plan(RawData)
+    assert plan.children == {'raw': None, 'by_id': None, 'either': None}
+    raw_data = {'raw': [dict(span)], 'by_id': {'a': dict(span)}, 'either': dict(span), 'scores': {'a': 1.0}}
+    container_utils.update_spans(raw_data, container_utils.OffsetMap(text), False, RawData)
+    assert raw_data == {'raw': [converted], 'by_id': {'a': converted}, 'either': converted, 'scores': {'a': 1.0}}
+    assert container_utils.get_span_walk_plan(TestData).children['paragraphs'].children['sentences'].has_span
+
+
+def test_update_spans_deeply_nested():
+    offset_map = container_utils.OffsetMap('the_cow_{}_jumped'.format(chr(0x10000)))
+    deep = innermost = {}
+    for _ in range(10000):
+        innermost['child'] = {}
+        innermost = innermost['child']
+    innermost.update({'begin': 11, 'end': 17})
+    container_utils.update_spans(deep, offset_map, additive_adjustments=False)
+    assert innermost == {'begin': 10, 'end': 16}
+
+
 def test_python2java():
     test_container = {}
     result = container_utils.python2java(test_container)
@@ -174,3 +324,127 @@ def test_python2java():
     assert result['unstructured'][0]['data']['concepts'][1]['begin'] == 21
     assert result['unstructured'][0]['data']['concepts'][1]['end'] == 25
 
+
+
+def test_from_dict_validation_levels():
+    container_group_dict = {'unstructured': [{
+        'text': 'the cow jumped',
+        'data': {
+            'concepts': [{'cui': 'abc', 'coveredText': 'cow', 'begin': 4, 'end': 7}],
+            'bogus': [{'a': 1}],
+        }
+    }]}
+    for validation_level in container_utils.ValidationLevel.all:
+        container_group = container_utils.from_dict(container_group_dict, validation_level)
+        data = container_group.unstructured[0].data
+        assert data.concepts[0].begin == 4
+        assert data.concepts[0].coveredText == 'cow'
+        assert data.bogus == [{'a': 1}]
+        # round trip is lossless regardless of what was accessed
+        assert container_utils.to_dict(container_group) == container_group_dict
+
+    # untouched fields pass through as-is
+    for validation_level in (container_utils.ValidationLevel.shallow, container_utils.ValidationLevel.trusted):
+        container_group = container_utils.from_dict(container_group_dict, validation_level)
+        assert container_utils.to_dict(container_group) == container_group_dict
+
+    with pytest.raises(ValueError):
+        container_utils.from_dict(container_group_dict, 'bogus')
+
+
+def test_from_dict_shallow_validation():
+    # containers are still validated up front
+    with pytest.raises(ValidationError):
+        container_utils.from_dict({'unstructured': [{'data': {}}]}, container_utils.ValidationLevel.shallow)
+    with pytest.raises(ValidationError):
+        container_utils.from_dict({'bogus': {}}, container_utils.ValidationLevel.shallow)
+    with pytest.raises(ValidationError):
+        container_utils.from_dict({'unstructured': [{'text': 'abc', 'data': {'Concepts': []}}]},
+                                  container_utils.ValidationLevel.shallow)
+
+    # annotations are only validated once they are accessed
+    container_group_dict = {'unstructured': [{'text': 'abc', 'data': {
+        'concepts': [{'cui': 'C001', 'type': 'plant'}],  # no begin/end
+    }}]}
+    container_group = container_utils.from_dict(container_group_dict, container_utils.ValidationLevel.shallow)
+    with pytest.raises(DeferredValidationError):
+        container_group.unstructured[0].data.concepts
+
+
+def test_from_dict_trusted_validation():
+    container_group_dict = {'unstructured': [{'text': 'abc', 'data': {
+        'concepts': [{'cui': 'C001', 'begin': 2, 'end': 1}],  # invalid span
+        'sections': [{'begin': 'x', 'end': 1}],  # never accessed
+    }}]}
+    container_group = container_utils.from_dict(container_group_dict, container_utils.ValidationLevel.trusted)
+    # nothing is validated on input...
+    concept = container_group.unstructured[0].data.concepts[0]
+    assert isinstance(concept, acd_datamodel.Concept)
+    # ...but whatever was accessed is validated on output
+    with pytest.raises(ValidationError):
+        container_utils.validate_output(container_group)
+    concept.begin = 0
+    container_utils.validate_output(container_group)
+
+
+def test_get_container_group_schema_json():
+    schema = container_utils.get_container_group_schema_json()
+    assert 'ContainerGroup' in schema
+    assert container_utils.get_container_group_schema_json() is schema
+
+
+def test_preconditions():
+    container = {'text': 'abcdef', 'data': {'attributeValues': [{'name': 'a'}], 'concepts': []}}
+    assert preconditions.requires('data.attributeValues')(container)
+    assert not preconditions.requires('data.concepts')(container)
+    assert not preconditions.requires('data.heightInches')(container)
+    assert not preconditions.requires('text.length')(container)
+    assert preconditions.min_text_length(6)(container)
+    assert not preconditions.min_text_length(7)(container)
+    assert not preconditions.min_text_length(1)({'data': {}})
+
+
+def test_split_merge_gated_containers():
+    container_group_dict = {
+        'unstructured': [{'text': 'a'}, {'text': 'long enough'}, {'text': 'b'}, 'not a container'],
+        'structured': [{'data': {'heightInches': 70}}, {'data': {}}],
+    }
+    gated = container_utils.split_gated_containers(container_group_dict, [preconditions.min_text_length(5)],
+                                                   [preconditions.requires('data.heightInches')])
+    assert container_group_dict == {
+        'unstructured': [{'text': 'long enough'}, 'not a container'],
+        'structured': [{'data': {'heightInches': 70}}],
+    }
+    container_group_dict['unstructured'][0]['data'] = {'seen': True}
+    result = container_utils.merge_gated_containers(container_group_dict, gated)
+    assert result == {
+        'unstructured': [{'text': 'a'}, {'text': 'long enough', 'data': {'seen': True}}, {'text': 'b'},
+                         'not a container'],
+        'structured': [{'data': {'heightInches': 70}}, {'data': {}}],
+    }
+    # no preconditions, nothing gated
+    assert container_utils.split_gated_containers({'unstructured': [{'text': 'a'}]}) == {}
+
+
+def test_split_merge_passthrough_fields():
+    container_group_dict = {
+        'unstructured': [
+            {'text': 'abc', 'data': {'concepts': [{'begin': 0, 'end': 1}], 'attributeValues': []}},
+            {'text': 'abc'},
+        ],
+        'structured': [{'data': {'heightInches': 70, 'other': 1}}],
+    }
+    passthrough = container_utils.split_passthrough_fields(container_group_dict, ['attributeValues'], None)
+    assert passthrough == {'unstructured': [{'concepts': [{'begin': 0, 'end': 1}]}, {}]}
+    assert container_group_dict == {
+        'unstructured': [{'text': 'abc', 'data': {'attributeValues': []}}, {'text': 'abc'}],
+        'structured': [{'data': {'heightInches': 70, 'other': 1}}],
+    }
+    # pretend an annotator ran and removed data altogether
+    del container_group_dict['unstructured'][0]['data']
+    result = container_utils.merge_passthrough_fields(container_group_dict, passthrough)
+    assert result['unstructured'][0]['data'] == {'concepts': [{'begin': 0, 'end': 1}]}
+    assert result['unstructured'][1] == {'text': 'abc'}
+
+    # nothing is split out when all fields are wanted
+    assert container_utils.split_passthrough_fields({'unstructured': [{'text': 'a', 'data': {'a': 1}}]}) == {}
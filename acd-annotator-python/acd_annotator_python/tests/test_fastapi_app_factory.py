@@ -5,13 +5,30 @@
 # SPDX-License-Identifier: Apache-2.0                               #
 #                                                                   #
 # ***************************************************************** #
+import asyncio
+import functools
 import json
+import multiprocessing
+import os
+import pytest
+import socket
+import threading
+import urllib.error
+import urllib.request
 from fastapi import Request
 from fastapi.testclient import TestClient
 
 from acd_annotator_python.container_model.main import UnstructuredContainer
-from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.acd_annotator import ACDAnnotator, ExecutionMode
 from acd_annotator_python import fastapi_app_factory
+from acd_annotator_python import preconditions
+from acd_annotator_python import service_utils
+from acd_annotator_python.thread_pool import run_in_annotator_executor
+from acd_annotator_python.batching import MicroBatcher
+from acd_annotator_python.health import STALE_AFTER_TTLS, CachedHealthCheck, HealthCheckServer
+from acd_annotator_python.single_flight import SingleFlight
+from acd_annotator_python.service_utils import ACDException, AdmissionController
+from acd_annotator_python.shared_stats import SharedStats
 from acd_annotator_python.fastapi_app_factory import DEFAULT_BASE_URL as BASE_URL
 from acd_annotator_python.fastapi_app_factory import EXAMPLE_REQUEST
 
@@ -49,6 +66,173 @@ class InvalidContainerModelErrorAnnotator(ErrorAnnotator):
         unstructured_container.data.concepts[0].begin = 'b'
 
 
+class InvalidBulkEditErrorAnnotator(ErrorAnnotator):
+    """A simple annotator that makes an invalid edit inside of a bulk edit for testing purposes."""
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        with unstructured_container.data.bulk_edit():
+            for concept in unstructured_container.data.concepts:
+                concept.begin = 'b'
+
+
+class SlowAnnotator(NoopAnnotator):
+    """A simple annotator that waits on (simulated) io and keeps track of how many containers it saw at once"""
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        unstructured_container.data.seen = unstructured_container.text
+        self.active -= 1
+
+
+class CountingSlowAnnotator(NoopAnnotator):
+    """A simple annotator that takes a while and counts its calls"""
+    def __init__(self):
+        self.calls = 0
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        self.calls += 1
+        await asyncio.sleep(0.3)
+        unstructured_container.data.seen = unstructured_container.text
+
+
+class DelayAnnotator(NoopAnnotator):
+    """A simple annotator that waits for as many hundredths of a second as its text says"""
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        await asyncio.sleep(int(unstructured_container.text) / 100)
+        unstructured_container.data.seen = unstructured_container.text
+
+
+class ConceptsOnlyAnnotator(NoopAnnotator):
+    """A simple annotator that declares it only cares about concepts"""
+    unstructured_data_fields = ('concepts',)
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        assert unstructured_container.data.attributeValues is None
+        for concept in unstructured_container.data.concepts:
+            concept.type = 'seen'
+
+
+class ProcessPoolAnnotator(NoopAnnotator):
+    """A simple annotator that runs in worker processes and records which process it ran in"""
+    execution_mode = ExecutionMode.process_pool
+
+    def on_startup(self, app):
+        app.pid = os.getpid()
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        for concept in unstructured_container.data.concepts:
+            concept.type = f'pid{request.app.pid}'
+        unstructured_container.data.header = request.headers.get('x-test')
+
+
+class ProcessPoolErrorAnnotator(ErrorAnnotator):
+    """A simple annotator that throws errors from worker processes"""
+    execution_mode = ExecutionMode.process_pool
+
+
+class ThreadPoolAnnotator(NoopAnnotator):
+    """A simple annotator that does its (blocking) work in the annotator's thread pool"""
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        unstructured_container.data.thread = await run_in_annotator_executor(
+            request.app, lambda: threading.current_thread().name)
+
+
+class BatchAnnotator(NoopAnnotator):
+    """A simple annotator that processes containers in batches and keeps track of the batch sizes"""
+    def __init__(self):
+        self.batch_sizes = []
+
+    async def annotate_batch(self, unstructured_containers, app):
+        self.batch_sizes.append(len(unstructured_containers))
+        for unstructured_container in unstructured_containers:
+            unstructured_container.data.seen = unstructured_container.text
+
+
+class HangingAnnotator(NoopAnnotator):
+    """A simple annotator that takes far too long"""
+    def __init__(self):
+        self.cancelled = False
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class CountingHealthAnnotator(NoopAnnotator):
+    """A simple annotator that counts its health checks"""
+    def __init__(self):
+        self.health_checks = 0
+
+    async def is_healthy(self, app):
+        self.health_checks += 1
+        return True
+
+
+class GatedAnnotator(NoopAnnotator):
+    """A simple annotator that only wants containers with concepts"""
+    unstructured_preconditions = (preconditions.requires('data.concepts'),)
+
+    def __init__(self):
+        self.seen = []
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        self.seen.append(unstructured_container.text)
+        unstructured_container.data.seen = True
+
+
+class CachedAnnotator(NoopAnnotator):
+    """A simple annotator that counts its calls and lets its results be cached"""
+    def __init__(self):
+        self.calls = 0
+
+    def get_cache_identity(self):
+        return 'CachedAnnotator:1'
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        self.calls += 1
+        unstructured_container.data.length = len(unstructured_container.text)
+
+
+def run_in_new_loop(coroutine):
+    """
+    Like asyncio.run(), but leaves the current event loop alone, since the TestClient of older starlette versions
+    (e.g., 0.13) runs apps with asyncio.get_event_loop(), which fails once asyncio.run() has unset it.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def asgi_post(app, path, body: bytes, headers: dict):
+    """POST to an app through its ASGI interface. Returns the status code and the body."""
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'POST', 'scheme': 'http', 'path': path,
+             'root_path': '', 'query_string': b'', 'server': ('testserver', 80), 'client': ('testclient', 50000),
+             'headers': [(name.encode(), value.encode()) for name, value in headers.items()]}
+    requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    messages = []
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # the client never disconnects
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
 class TestMain:
     def test_status(self):
         with TestClient(fastapi_app_factory.build(NoopAnnotator())) as client:
@@ -88,6 +272,10 @@ class TestMain:
         with TestClient(fastapi_app_factory.build(InvalidContainerModelErrorAnnotator())) as client:
             response = client.post(BASE_URL + "/process", json.dumps(example_container), headers=headers)
             assert response.status_code == 500
+        with TestClient(fastapi_app_factory.build(InvalidBulkEditErrorAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", json.dumps(example_container), headers=headers)
+            assert response.status_code == 500
+            assert response.json()['detail']['description'] == 'This service produced an invalid container.'
 
     def test_process(self):
         headers = {'content-type': 'application/json'}
@@ -130,6 +318,520 @@ class TestMain:
             response = client.post(BASE_URL + "/process", request, headers=headers)
             assert response.status_code == 500
 
+    def test_process_validation_levels(self, monkeypatch):
+        headers = {'content-type': 'application/json'}
+        for validation_level in ('full', 'shallow', 'trusted'):
+            monkeypatch.setenv('com_ibm_watson_health_common_python_validation_level', validation_level)
+            with TestClient(fastapi_app_factory.build(NoopAnnotator())) as client:
+                request = json.dumps(EXAMPLE_REQUEST)
+                response = client.post(BASE_URL + "/process", request, headers=headers)
+                assert response.status_code == 200
+                assert response.json() == EXAMPLE_REQUEST
+
+            # invalid edits are caught at every level
+            with TestClient(fastapi_app_factory.build(InvalidContainerModelErrorAnnotator())) as client:
+                request = json.dumps(EXAMPLE_REQUEST)
+                response = client.post(BASE_URL + "/process", request, headers=headers)
+                assert response.status_code == 500
+
+    def test_process_shallow_validation(self, monkeypatch):
+        headers = {'content-type': 'application/json'}
+        monkeypatch.setenv('com_ibm_watson_health_common_python_validation_level', 'shallow')
+        # concepts are missing begin/end
+        request = json.dumps({"unstructured": [{"text": "abc", "data": {"concepts": [{"cui": "C001"}]}}]})
+        # invalid input that is never accessed passes through untouched
+        with TestClient(fastapi_app_factory.build(NoopAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+            assert response.json() == json.loads(request)
+        # but it is still reported as bad input once it is accessed
+        with TestClient(fastapi_app_factory.build(InvalidContainerModelErrorAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 400
+
+        monkeypatch.setenv('com_ibm_watson_health_common_python_validation_level', 'bogus')
+        with pytest.raises(ValueError):
+            fastapi_app_factory.build(NoopAnnotator())
+
+    def test_process_passthrough_fields(self):
+        headers = {'content-type': 'application/json'}
+        text = 'the_cow_{}_jumped'.format(chr(0x10000))
+        request = {"unstructured": [{"text": text, "data": {
+            "concepts": [{"begin": 11, "end": 17, "coveredText": "jumped"}],
+            # invalid, but never parsed since the annotator doesn't ask for it
+            "attributeValues": [{"begin": 11, "end": 11, "bogus": {"begin": 11}}],
+        }}]}
+        with TestClient(fastapi_app_factory.build(ConceptsOnlyAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", json.dumps(request), headers=headers)
+            assert response.status_code == 200
+            data = response.json()['unstructured'][0]['data']
+            assert data['concepts'] == [{"begin": 11, "end": 17, "coveredText": "jumped", "type": "seen"}]
+            assert data['attributeValues'] == request['unstructured'][0]['data']['attributeValues']
+
+    def test_process_container_concurrency(self, monkeypatch):
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": str(i)} for i in range(10)]})
+        for concurrency, expected_max_active in ((1, 1), (4, 4)):
+            monkeypatch.setenv('com_ibm_watson_health_common_python_container_concurrency', str(concurrency))
+            annotator = SlowAnnotator()
+            with TestClient(fastapi_app_factory.build(annotator)) as client:
+                response = client.post(BASE_URL + "/process", request, headers=headers)
+                assert response.status_code == 200
+                # output order is preserved
+                assert [c['data']['seen'] for c in response.json()['unstructured']] == [str(i) for i in range(10)]
+                assert annotator.max_active == expected_max_active
+
+            # errors are reported the same way
+            with TestClient(fastapi_app_factory.build(ErrorAnnotator())) as client:
+                response = client.post(BASE_URL + "/process", request, headers=headers)
+                assert response.status_code == 500
+
+    def test_process_pool(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_process_pool_workers', '2')
+        headers = {'content-type': 'application/json', 'x-test': 'abc'}
+        request = json.dumps({"unstructured": [{"text": "The 😀 patient", "data": {
+            "concepts": [{"cui": "C1", "begin": 7, "end": 14, "coveredText": "patient"}]}}]})
+        with TestClient(fastapi_app_factory.build(ProcessPoolAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+            data = response.json()['unstructured'][0]['data']
+            concept = data['concepts'][0]
+            assert concept['type'].startswith('pid') and concept['type'] != f'pid{os.getpid()}'
+            # offsets are still java offsets on the way out
+            assert (concept['begin'], concept['end']) == (7, 14)
+            assert data['header'] == 'abc'
+
+        # errors in the workers are reported the same way
+        with TestClient(fastapi_app_factory.build(ProcessPoolErrorAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 500
+
+    def test_process_pool_size(self, monkeypatch):
+        # by default, the processes serving the app (e.g., a server's workers) split the cpus between their pools
+        cpus = service_utils.get_usable_cpu_count()
+        for worker_processes, pool_size in ((1, cpus), (cpus, 1), (2 * cpus, 1)):
+            app = fastapi_app_factory.build(ProcessPoolAnnotator())
+            app.acd_worker_processes = worker_processes
+            with TestClient(app):
+                assert app.acd_process_pool.max_workers == pool_size
+        # unless told how big each pool should be
+        monkeypatch.setenv('com_ibm_watson_health_common_python_process_pool_workers', '3')
+        app = fastapi_app_factory.build(ProcessPoolAnnotator())
+        app.acd_worker_processes = 2
+        with TestClient(app):
+            assert app.acd_process_pool.max_workers == 3
+
+    def test_usable_cpu_count(self, monkeypatch):
+        assert 1 <= service_utils.get_usable_cpu_count() <= multiprocessing.cpu_count()
+        monkeypatch.setattr(service_utils, '_get_cgroup_cpu_quota', lambda: None)
+        cpus = service_utils.get_usable_cpu_count()
+        # a container's cpu limit caps it (rounded up)
+        monkeypatch.setattr(service_utils, '_get_cgroup_cpu_quota', lambda: cpus - 0.5)
+        assert service_utils.get_usable_cpu_count() == cpus
+        monkeypatch.setattr(service_utils, '_get_cgroup_cpu_quota', lambda: 0.5)
+        assert service_utils.get_usable_cpu_count() == 1
+
+    def test_annotator_executor(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_annotator_threads', '3')
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": "a"}, {"text": "b"}]})
+        with TestClient(fastapi_app_factory.build(ThreadPoolAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+            for container in response.json()['unstructured']:
+                assert container['data']['thread'].startswith('ThreadPoolAnnotator')
+
+            response = client.get(BASE_URL + "/status")
+            executor_stats = response.json()['annotatorExecutor']
+            assert executor_stats['name'] == 'ThreadPoolAnnotator'
+            assert executor_stats['maxThreads'] == 3
+            assert executor_stats['completedTasks'] == 2
+            assert executor_stats['activeThreads'] == 0
+            assert executor_stats['queueDepth'] == 0
+
+    def test_annotate_batch(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_batch_max_size', '2')
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": str(i)} for i in range(5)]})
+        annotator = BatchAnnotator()
+        assert annotator.supports_batching() and not NoopAnnotator().supports_batching()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+            assert [c['data']['seen'] for c in response.json()['unstructured']] == [str(i) for i in range(5)]
+            assert annotator.batch_sizes == [2, 2, 1]
+
+    def test_micro_batcher(self):
+        batches = []
+
+        async def batch_function(items):
+            batches.append(items)
+            if 'bad' in items:
+                raise RuntimeError("mock error")
+
+        async def run():
+            batcher = MicroBatcher(batch_function, max_batch_size=10, max_wait_time=0.01)
+            # concurrent submitters share a batch once the wait time is up
+            await asyncio.gather(*(batcher.submit(i) for i in range(3)))
+            assert batches == [[0, 1, 2]]
+            # errors go to everyone in the batch
+            results = await asyncio.gather(batcher.submit('ok'), batcher.submit('bad'), return_exceptions=True)
+            assert all(isinstance(result, RuntimeError) for result in results)
+
+        run_in_new_loop(run())
+
+    def test_single_flight(self):
+        calls = []
+
+        async def work(result):
+            calls.append(result)
+            await asyncio.sleep(0.01)
+            if result == 'bad':
+                raise RuntimeError("mock error")
+            return result
+
+        async def run():
+            flight = SingleFlight()
+            results = await asyncio.gather(*(flight.run('a', functools.partial(work, 'ok')) for _ in range(3)))
+            assert results == ['ok'] * 3 and calls == ['ok'] and not flight.in_flight
+            # errors go to everyone waiting
+            results = await asyncio.gather(*(flight.run('b', functools.partial(work, 'bad')) for _ in range(2)),
+                                           return_exceptions=True)
+            assert all(isinstance(result, RuntimeError) for result in results)
+            # a waiter that gives up doesn't cancel the work for the others
+            first = asyncio.ensure_future(flight.run('c', functools.partial(work, 'c')))
+            second = asyncio.ensure_future(flight.run('c', functools.partial(work, 'c')))
+            await asyncio.sleep(0)
+            first.cancel()
+            assert await second == 'c'
+            assert flight.get_stats() == {"inFlight": 0, "totalDeduplicated": 4}
+            # each waiter waits for as long as it wants to
+            results = await asyncio.gather(flight.run('d', functools.partial(work, 'd'), timeout=0.001),
+                                           flight.run('d', functools.partial(work, 'd'), timeout=1),
+                                           return_exceptions=True)
+            assert isinstance(results[0], asyncio.TimeoutError) and results[1] == 'd'
+            assert calls.count('d') == 1
+            # and once nobody is waiting anymore, the work stops
+            waiter = asyncio.ensure_future(flight.run('e', functools.partial(asyncio.sleep, 10)))
+            await asyncio.sleep(0)
+            task = flight.in_flight['e'].task
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            await asyncio.sleep(0)
+            assert task.cancelled() and not flight.in_flight
+
+        run_in_new_loop(run())
+
+    def test_admission_control(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_max_concurrent_requests', '1')
+        monkeypatch.setenv('com_ibm_watson_health_common_python_retry_after_seconds', '7')
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": "a"}]})
+        app = fastapi_app_factory.build(NoopAnnotator())
+        with TestClient(app) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+
+            # simulate a request in flight. With no room in the wait queue, the next one is turned away.
+            app.acd_admission_controller.concurrent_requests = 1
+            app.acd_shared_stats.increment('concurrentRequests')
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 503
+            assert response.headers['retry-after'] == '7'
+            assert response.json()['detail']['code'] == 503
+            # status calls aren't subject to admission control
+            status = client.get(BASE_URL + "/status").json()
+            assert status['concurrentRequests'] == 1
+            assert status['maxConcurrentRequests'] == 1
+            assert status['totalRejectedRequests'] == 1
+            assert status['totalBlockedRequests'] == 0
+            assert status['requestCount'] == 3
+            assert sum(status['latencyHistogramMs'].values()) == 2
+
+    def test_admission_controller(self):
+        async def run():
+            # two workers' stats, with another worker that has a request of its own waiting
+            shared_stats = SharedStats(2)
+            shared_stats.attach(1)
+            shared_stats.increment('queuedRequests')
+            shared_stats.attach(0)
+            admission_controller = AdmissionController(max_concurrent_requests=2, max_queued_requests=1,
+                                                       retry_after_seconds=1, shared_stats=shared_stats)
+            order = []
+            release = asyncio.Event()
+
+            async def handle(i):
+                async with admission_controller.admit():
+                    order.append(i)
+                    await release.wait()
+
+            tasks = [asyncio.ensure_future(handle(i)) for i in range(3)]
+            await asyncio.sleep(0)
+            # two are admitted, the third waits
+            assert order == [0, 1]
+            assert admission_controller.queued_requests == 1
+            # the queue depth is reported for all of the workers
+            assert shared_stats.get_stats()['queuedRequests'] == 2
+            assert [worker['queuedRequests'] for worker in shared_stats.get_worker_stats()] == [1, 1]
+            # the queue is full
+            with pytest.raises(ACDException):
+                async with admission_controller.admit():
+                    pass
+            release.set()
+            await asyncio.gather(*tasks)
+            assert order == [0, 1, 2]
+            assert admission_controller.concurrent_requests == 0
+            assert admission_controller.total_blocked_requests == 1
+            assert admission_controller.total_rejected_requests == 1
+            assert shared_stats.get_stats()['queuedRequests'] == 1
+
+            # a request that gives up waiting leaves the queue
+            release.clear()
+            tasks = [asyncio.ensure_future(handle(i)) for i in range(3)]
+            await asyncio.sleep(0)
+            assert shared_stats.get_stats()['queuedRequests'] == 2
+            tasks[2].cancel()
+            await asyncio.sleep(0)
+            assert shared_stats.get_stats()['queuedRequests'] == 1
+            assert admission_controller.queued_requests == 0
+            release.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        run_in_new_loop(run())
+
+    def test_request_deadline(self, monkeypatch):
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": "a"}]})
+        annotator = HangingAnnotator()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", request,
+                                   headers={**headers, 'x-request-timeout': '0.05'})
+            assert response.status_code == 504
+            assert response.json()['detail']['code'] == 504
+            assert annotator.cancelled
+
+            response = client.post(BASE_URL + "/process", request, headers={**headers, 'x-request-timeout': 'abc'})
+            assert response.status_code == 400
+
+        # a configured default applies to requests without the header
+        monkeypatch.setenv('com_ibm_watson_health_common_python_request_timeout_seconds', '0.05')
+        with TestClient(fastapi_app_factory.build(HangingAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 504
+        with TestClient(fastapi_app_factory.build(NoopAnnotator())) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.status_code == 200
+
+    def test_health_check_cache_and_port(self, monkeypatch):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        monkeypatch.setenv('com_ibm_watson_health_common_python_health_check_ttl_seconds', '60')
+        monkeypatch.setenv('com_ibm_watson_health_common_python_health_check_port', str(port))
+        annotator = CountingHealthAnnotator()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            for _ in range(3):
+                assert client.get(BASE_URL + "/status/health_check").status_code == 200
+            assert client.get(BASE_URL + "/status").status_code == 200
+            # the cached result was reused
+            assert annotator.health_checks == 1
+
+            # the separate health check port answers from its own thread
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}{BASE_URL}/status/health_check') as response:
+                assert response.status == 200
+                assert json.load(response) == {"serviceState": "OK"}
+            assert annotator.health_checks == 1
+
+    def test_health_check_port_stale_result(self):
+        async def run():
+            health_check = CachedHealthCheck(CountingHealthAnnotator(), None, ttl=0.05)
+            server = HealthCheckServer(health_check, 0, host='127.0.0.1')
+            server.start()
+            url = f'http://127.0.0.1:{server.port}{BASE_URL}/status/health_check'
+            try:
+                health_check.start()
+                await asyncio.sleep(0.01)
+                with urllib.request.urlopen(url) as response:
+                    assert response.status == 200
+                # once the result stops being refreshed, it can't keep the probe passing
+                health_check.stop()
+                await asyncio.sleep(STALE_AFTER_TTLS * 0.05 + 0.05)
+                with pytest.raises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen(url)
+                assert error.value.code == 503
+            finally:
+                server.stop()
+        run_in_new_loop(run())
+
+    def test_process_preconditions(self):
+        headers = {'content-type': 'application/json'}
+        # the second container would fail validation, but the annotator never sees it
+        skipped = {"text": "The 😀 patient", "data": {"attributeValues": [{"begin": "b"}]}}
+        request = {"unstructured": [
+            {"text": "one", "data": {"concepts": [{"cui": "C1", "begin": 0, "end": 3, "coveredText": "one"}]}},
+            skipped,
+            {"text": "three", "data": {"concepts": [{"cui": "C3", "begin": 0, "end": 5, "coveredText": "three"}]}},
+        ]}
+        annotator = GatedAnnotator()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", json.dumps(request), headers=headers)
+            assert response.status_code == 200
+            containers = response.json()['unstructured']
+            assert annotator.seen == ['one', 'three']
+            assert containers[0]['data']['seen'] and containers[2]['data']['seen']
+            # passed through untouched, in its original position
+            assert containers[1] == skipped
+
+    def test_deduplicate_requests(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_deduplicate_requests', 'true')
+        headers = {'content-type': 'application/json'}
+        annotator = CountingSlowAnnotator()
+        request = json.dumps({"unstructured": [{"text": "one"}]}).encode()
+        app = fastapi_app_factory.build(annotator)
+
+        async def run():
+            # concurrent requests have to share an event loop, which the TestClient doesn't let them do
+            await app.router.startup()
+            try:
+                results = await asyncio.gather(*(asgi_post(app, BASE_URL + "/process", request, headers)
+                                                 for _ in range(3)))
+                assert [status_code for status_code, _ in results] == [200] * 3
+                assert results[0][1] == results[1][1] == results[2][1]
+                assert annotator.calls == 1
+                assert app.acd_single_flight.get_stats() == {"inFlight": 0, "totalDeduplicated": 2}
+                # once the first requests are done, an identical one is processed again
+                assert (await asgi_post(app, BASE_URL + "/process", request, headers))[0] == 200
+                assert annotator.calls == 2
+                # a request joining one with a shorter deadline isn't cut short by it (nor the other way around)
+                results = await asyncio.gather(
+                    asgi_post(app, BASE_URL + "/process", request, {**headers, 'x-request-timeout': '0.1'}),
+                    asgi_post(app, BASE_URL + "/process", request, headers))
+                assert [status_code for status_code, _ in results] == [504, 200]
+                assert annotator.calls == 3
+            finally:
+                await app.router.shutdown()
+
+        run_in_new_loop(run())
+
+    def test_process_stream(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_stream_concurrency', '4')
+        delays = [5, 1, 3, 'bad', 0, 2]
+        lines = [json.dumps({"unstructured": [{"text": str(delay)}]}) for delay in delays]
+        lines[3] = 'not json'
+
+        def body():
+            # lines get split across chunks
+            content = '\n'.join(lines).encode()
+            for i in range(0, len(content), 7):
+                yield content[i:i + 7]
+        with TestClient(fastapi_app_factory.build(DelayAnnotator())) as client:
+            response = client.post(BASE_URL + "/process/stream", data=body(),
+                                   headers={'content-type': 'application/x-ndjson'})
+            assert response.status_code == 200
+            results = [json.loads(line) for line in response.text.splitlines()]
+            assert [r['unstructured'][0]['data']['seen'] for r in results if 'unstructured' in r] == \
+                ['5', '1', '3', '0', '2']
+            assert results[3]['detail']['code'] == 400
+
+            # unordered: tagged with their input line, in the order they're done
+            response = client.post(BASE_URL + "/process/stream?ordered=false", data=body(),
+                                   headers={'content-type': 'application/x-ndjson'})
+            results = [json.loads(line) for line in response.text.splitlines()]
+            assert sorted(r['index'] for r in results) == list(range(len(delays)))
+            assert results[0]['index'] == 3
+            assert [r['index'] for r in results][-1] == 0
+            assert next(r for r in results if r['index'] == 2)['result']['unstructured'][0]['data']['seen'] == '3'
+
+    def test_process_stream_request_handling(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_max_concurrent_requests', '1')
+        monkeypatch.setenv('com_ibm_watson_health_common_python_retry_after_seconds', '7')
+        headers = {'content-type': 'application/x-ndjson'}
+        body = '\n'.join(json.dumps({"unstructured": [{"text": "a"}]}) for _ in range(3))
+        app = fastapi_app_factory.build(NoopAnnotator())
+        with TestClient(app) as client:
+            response = client.post(BASE_URL + "/process/stream", body, headers=headers)
+            assert response.status_code == 200
+            assert len(response.text.splitlines()) == 3
+            # each ContainerGroup counts as a request in the latency stats, and the stream gave back its slot
+            status = client.get(BASE_URL + "/status").json()
+            assert sum(status['latencyHistogramMs'].values()) == 3
+            assert status['concurrentRequests'] == 0
+
+            # invalid query parameters and headers, and the wrong media type, are turned away up front
+            response = client.post(BASE_URL + "/process/stream?ordered=abc", body, headers=headers)
+            assert response.status_code == 400
+            assert response.json()['code'] == 400
+            response = client.post(BASE_URL + "/process/stream", body, headers={**headers, 'x-request-timeout': 'abc'})
+            assert response.status_code == 400
+            response = client.post(BASE_URL + "/process/stream", body, headers={'content-type': 'text/plain'})
+            assert response.status_code == 415
+            response = client.post(BASE_URL + "/process/stream?ordered=abc", body,
+                                   headers={'content-type': 'text/plain'})
+            assert response.status_code == 415
+
+            # streams are subject to admission control like /process requests
+            app.acd_admission_controller.concurrent_requests = 1
+            app.acd_shared_stats.increment('concurrentRequests')
+            response = client.post(BASE_URL + "/process/stream", body, headers=headers)
+            assert response.status_code == 503
+            assert response.headers['retry-after'] == '7'
+            assert response.json()['detail']['code'] == 503
+            assert client.get(BASE_URL + "/status").json()['totalRejectedRequests'] == 1
+
+    def test_process_stream_deadline(self):
+        annotator = HangingAnnotator()
+        body = '\n'.join(json.dumps({"unstructured": [{"text": "a"}]}) for _ in range(2))
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            # each ContainerGroup gets the timeout
+            response = client.post(BASE_URL + "/process/stream", body,
+                                   headers={'content-type': 'application/x-ndjson', 'x-request-timeout': '0.05'})
+            assert response.status_code == 200
+            assert [json.loads(line)['detail']['code'] for line in response.text.splitlines()] == [504, 504]
+            assert annotator.cancelled
+
+    def test_result_cache(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_result_cache_size_mb', '1')
+        headers = {'content-type': 'application/json'}
+        annotator = CachedAnnotator()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            request = json.dumps({"unstructured": [{"text": "The 😀 patient"}, {"text": "two"}]})
+            first = client.post(BASE_URL + "/process", request, headers=headers)
+            assert first.status_code == 200
+            assert annotator.calls == 2
+            # every container is a hit
+            second = client.post(BASE_URL + "/process", request, headers=headers)
+            assert second.json() == first.json()
+            assert annotator.calls == 2
+            # only the new container is annotated, and the hit keeps its position
+            request = json.dumps({"unstructured": [{"text": "new"}, {"text": "two"}]})
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert [c['data']['length'] for c in response.json()['unstructured']] == [3, 3]
+            assert annotator.calls == 3
+            cache_stats = client.get(BASE_URL + "/status").json()['resultCache']
+            assert cache_stats['hits'] == 3 and cache_stats['misses'] == 3 and cache_stats['entries'] == 3
+
+    def test_persistent_result_cache(self, monkeypatch, tmp_path):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_result_cache_size_mb', '1')
+        monkeypatch.setenv('com_ibm_watson_health_common_python_result_cache_path', str(tmp_path / 'results.sqlite'))
+        headers = {'content-type': 'application/json'}
+        request = json.dumps({"unstructured": [{"text": "one"}]})
+        annotator = CachedAnnotator()
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            first = client.post(BASE_URL + "/process", request, headers=headers)
+            assert annotator.calls == 1
+        # a restarted service still has the result
+        with TestClient(fastapi_app_factory.build(annotator)) as client:
+            response = client.post(BASE_URL + "/process", request, headers=headers)
+            assert response.json() == first.json()
+            assert annotator.calls == 1
+            cache_stats = client.get(BASE_URL + "/status").json()['resultCache']
+            assert cache_stats['persistent']['hits'] == 1 and cache_stats['memory']['misses'] == 1
+
+    def test_result_cache_opt_out(self, monkeypatch):
+        monkeypatch.setenv('com_ibm_watson_health_common_python_result_cache_size_mb', '1')
+        with TestClient(fastapi_app_factory.build(NoopAnnotator())) as client:
+            assert 'resultCache' not in client.get(BASE_URL + "/status").json()
+
 
 # enable to debug
 if __name__ == '__main__':
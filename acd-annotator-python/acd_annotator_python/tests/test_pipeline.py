@@ -0,0 +1,92 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import json
+import pytest
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+from acd_annotator_python import fastapi_app_factory
+from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.container_model.main import UnstructuredContainer
+from acd_annotator_python.fastapi_app_factory import DEFAULT_BASE_URL as BASE_URL
+from acd_annotator_python.pipeline import AnnotatorPipeline
+
+
+class StepAnnotator(ACDAnnotator):
+    """A simple annotator that records when it ran in a shared log"""
+    def __init__(self, name, log, fields=None, delay=0.0):
+        self.name = name
+        self.log = log
+        self.unstructured_data_fields = fields
+        self.delay = delay
+
+    def on_startup(self, app):
+        self.log.append(f'startup {self.name}')
+
+    async def is_healthy(self, app):
+        return True
+
+    async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
+        self.log.append(f'start {self.name}')
+        await asyncio.sleep(self.delay)
+        unstructured_container.data.steps = getattr(unstructured_container.data, 'steps', '') + self.name
+        self.log.append(f'end {self.name}')
+
+
+def test_chain():
+    log = []
+    annotators = [StepAnnotator(name, log, fields=(name,)) for name in 'abc']
+    headers = {'content-type': 'application/json'}
+    request = json.dumps({"unstructured": [{"text": "one"}, {"text": "two"}]})
+    with TestClient(fastapi_app_factory.build(annotators)) as client:
+        response = client.post(BASE_URL + "/process", request, headers=headers)
+        assert response.status_code == 200
+        assert [c['data']['steps'] for c in response.json()['unstructured']] == ['abc', 'abc']
+    assert log[:3] == ['startup a', 'startup b', 'startup c']
+    assert log[3:9] == ['start a', 'end a', 'start b', 'end b', 'start c', 'end c']
+
+
+def test_dag():
+    log = []
+    a, b, c, d = (StepAnnotator(name, log, delay=0.01) for name in 'abcd')
+    # b and c both depend on a and run concurrently; d needs both of them
+    pipeline = AnnotatorPipeline([a, b, c, d], dependencies={b: [a], c: [a], d: [b, c]})
+    container = UnstructuredContainer(text="one", data={})
+    # not asyncio.run(), which would leave no current event loop for the TestClient tests that follow
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(pipeline.annotate(container, None))
+    finally:
+        loop.close()
+    assert log[:2] == ['start a', 'end a']
+    assert set(log[2:4]) == {'start b', 'start c'}
+    assert log[-2:] == ['start d', 'end d']
+    assert container.data.steps[0] == 'a' and container.data.steps[-1] == 'd'
+
+
+def test_pipeline_fields():
+    log = []
+    pipeline = AnnotatorPipeline([StepAnnotator('a', log, fields=('concepts',)),
+                                  StepAnnotator('b', log, fields=('attributeValues',))])
+    assert pipeline.unstructured_data_fields == ('attributeValues', 'concepts')
+    # one annotator that sees everything means the pipeline sees everything
+    pipeline = AnnotatorPipeline([StepAnnotator('a', log, fields=('concepts',)), StepAnnotator('b', log)])
+    assert pipeline.unstructured_data_fields is None
+
+
+def test_bad_dependencies():
+    log = []
+    a, b = StepAnnotator('a', log), StepAnnotator('b', log)
+    with pytest.raises(ValueError):
+        AnnotatorPipeline([a, b], dependencies={a: [b], b: [a]})
+    with pytest.raises(ValueError):
+        AnnotatorPipeline([a], dependencies={a: [b]})
+    with pytest.raises(ValueError):
+        AnnotatorPipeline([])
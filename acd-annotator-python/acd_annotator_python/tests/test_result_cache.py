@@ -0,0 +1,82 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+from acd_annotator_python import result_cache
+from acd_annotator_python.result_cache import LRUResultCache, SqliteResultCache, TieredResultCache
+
+
+def test_cache_key():
+    key = result_cache.compute_cache_key('a:1', 'unstructured', {"text": "one", "data": {"x": 1, "y": 2}})
+    # independent of key order, but not of the content, the kind or the annotator identity
+    assert key == result_cache.compute_cache_key('a:1', 'unstructured', {"data": {"y": 2, "x": 1}, "text": "one"})
+    assert key != result_cache.compute_cache_key('a:1', 'unstructured', {"text": "one!", "data": {"x": 1, "y": 2}})
+    assert key != result_cache.compute_cache_key('a:1', 'structured', {"text": "one", "data": {"x": 1, "y": 2}})
+    assert key != result_cache.compute_cache_key('a:2', 'unstructured', {"text": "one", "data": {"x": 1, "y": 2}})
+
+
+def test_lru_eviction():
+    cache = LRUResultCache(max_size_bytes=30)
+    cache.put('a', b'x' * 9)
+    cache.put('b', b'x' * 9)
+    cache.put('c', b'x' * 9)
+    assert cache.get('a') is not None
+    # evicts b, the least recently used
+    cache.put('d', b'x' * 9)
+    assert cache.get('b') is None
+    assert cache.get('c') is not None and cache.get('d') is not None
+    # too big to cache at all
+    cache.put('e', b'x' * 30)
+    assert cache.get('e') is None
+    stats = cache.get_stats()
+    assert stats['entries'] == 3 and stats['sizeBytes'] == 30
+    assert stats['evictions'] == 1 and stats['hits'] == 3 and stats['misses'] == 2
+
+
+def test_split_and_store():
+    cache = LRUResultCache(max_size_bytes=10000)
+    body = {"unstructured": [{"text": "one"}, {"text": "two"}]}
+    cached, keys = result_cache.split_cached_containers(body, cache, 'a:1')
+    assert cached == {} and len(keys['unstructured']) == 2
+    result_cache.store_results({"unstructured": [{"text": "one", "data": {"n": 1}}, {"text": "two", "data": {"n": 2}}]},
+                               keys, cache)
+    body = {"unstructured": [{"text": "three"}, {"text": "two"}]}
+    cached, keys = result_cache.split_cached_containers(body, cache, 'a:1')
+    assert cached == {'unstructured': [(1, {"text": "two", "data": {"n": 2}})]}
+    assert body == {"unstructured": [{"text": "three"}]} and len(keys['unstructured']) == 1
+
+
+def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / 'cache' / 'results.sqlite')
+    cache = SqliteResultCache(path, max_size_bytes=1000)
+    cache.put('a', b'x' * 99)
+    assert cache.get('a') == b'x' * 99
+    assert cache.get('b') is None
+    cache.close()
+    # persists across restarts
+    cache = SqliteResultCache(path, max_size_bytes=1000)
+    assert cache.get('a') == b'x' * 99
+    assert cache.get_stats()['entries'] == 1
+    # writing past the maximum size evicts the least recently used entries
+    for i in range(20):
+        cache.put(f'k{i:02}', b'x' * 97)
+    stats = cache.get_stats()
+    assert stats['compactions'] >= 1 and stats['sizeBytes'] <= 1000
+    assert cache.get('k19') is not None and cache.get('a') is None
+    cache.close()
+
+
+def test_tiered_cache(tmp_path):
+    persistent_cache = SqliteResultCache(str(tmp_path / 'results.sqlite'), max_size_bytes=10000)
+    persistent_cache.put('a', b'one')
+    cache = TieredResultCache(LRUResultCache(max_size_bytes=10000), persistent_cache)
+    assert cache.get('a') == b'one'
+    # now also in memory
+    assert cache.memory_cache.get('a') == b'one'
+    cache.put('b', b'two')
+    assert persistent_cache.get('b') == b'two'
+    cache.close()
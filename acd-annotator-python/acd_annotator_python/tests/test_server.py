@@ -0,0 +1,141 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI
+
+from acd_annotator_python import server
+from acd_annotator_python.shared_stats import SharedStats
+from acd_annotator_python.fastapi_app_factory import DEFAULT_BASE_URL as BASE_URL
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def post_process(port, text):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{BASE_URL}/process',
+                                     data=json.dumps({"unstructured": [{"text": text}]}).encode(),
+                                     headers={'content-type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status, json.load(response)
+
+
+def wait_for_server(port, timeout=20):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return post_process(port, 'the patient')
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def get_status(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{BASE_URL}/status?perWorker=true', timeout=5) as response:
+        return json.load(response)
+
+
+def record_requests(shared_stats, worker_slot):
+    shared_stats.attach(worker_slot)
+    for latency in (0.001, 0.2, 30):
+        shared_stats.increment('requestCount')
+        shared_stats.record_latency(latency)
+
+
+def test_shared_stats():
+    shared_stats = SharedStats(3)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=record_requests, args=(shared_stats, slot)) for slot in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # the parent sees what the forked workers recorded
+    stats = shared_stats.get_stats()
+    assert stats['workers'] == 2
+    assert stats['requestCount'] == 6
+    assert stats['latencyHistogramMs']['5'] == 2
+    assert stats['latencyHistogramMs']['250'] == 2
+    assert stats['latencyHistogramMs']['+Inf'] == 2
+    assert [worker_stats['requestCount'] for worker_stats in shared_stats.get_worker_stats()] == [3, 3]
+    # counts outlive the workers
+    shared_stats.detach(0)
+    assert shared_stats.get_stats()['requestCount'] == 6
+    assert len(shared_stats.get_worker_stats()) == 1
+
+
+def test_load_app():
+    # factory functions get called
+    app = server.load_app('example_apps.regex_annotator:app')
+    assert isinstance(app, FastAPI)
+    assert not app.acd_preloaded
+    app.acd_preload()
+    assert app.acd_preloaded
+
+
+def test_serve():
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'acd_annotator_python', 'serve',
+                                'example_apps.regex_annotator:app', '--port', str(port), '--workers', '2',
+                                '--max-requests', '2'],
+                               cwd=PACKAGE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        status, body = wait_for_server(port)
+        assert status == 200
+        assert body['unstructured'][0]['data']['concepts'][0]['coveredText'] == 'patient'
+        # workers get recycled after --max-requests, and the server keeps serving
+        for _ in range(6):
+            status, _ = wait_for_server(port)
+            assert status == 200
+        # any worker reports the stats of all of them
+        status = get_status(port)
+        assert status['workers'] == 2
+        assert status['requestCount'] >= 7
+        assert sum(status['latencyHistogramMs'].values()) == 7
+        assert len(status['workerStats']) == 2
+        # graceful reload
+        process.send_signal(signal.SIGHUP)
+        for _ in range(4):
+            status, _ = wait_for_server(port)
+            assert status == 200
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+
+
+def test_recycled_workers_drain_their_connections():
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'acd_annotator_python', 'serve',
+                                'example_apps.regex_annotator:app', '--port', str(port), '--workers', '2',
+                                '--max-requests', '5'],
+                               cwd=PACKAGE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port)
+        # concurrent clients keep connecting while workers get recycled. None of their connections get dropped.
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(lambda _: post_process(port, 'the patient')[0], range(200)))
+        assert statuses == [200] * 200
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
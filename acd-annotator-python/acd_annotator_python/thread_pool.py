@@ -0,0 +1,97 @@
+# ***************************************************************** #
+#                                                                   #
+# (C) Copyright IBM Corp. 2021                                      #
+#                                                                   #
+# SPDX-License-Identifier: Apache-2.0                               #
+#                                                                   #
+# ***************************************************************** #
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A named ThreadPoolExecutor that keeps track of how busy it is:
+    how many tasks are waiting for a thread, how many threads are active
+    and how long tasks wait before they start running.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.max_workers = max_workers
+        self._stats_lock = threading.Lock()
+        self.queue_depth = 0
+        self.active_threads = 0
+        self.completed_tasks = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        submit_time = time.monotonic()
+        with self._stats_lock:
+            self.queue_depth += 1
+
+        def run():
+            wait_time = time.monotonic() - submit_time
+            with self._stats_lock:
+                self.queue_depth -= 1
+                self.active_threads += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.active_threads -= 1
+                    self.completed_tasks += 1
+
+        future = super().submit(run)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        # tasks cancelled before they got a thread never ran, so they never left the queue
+        if future.cancelled():
+            with self._stats_lock:
+                self.queue_depth -= 1
+
+    def get_stats(self):
+        """A summary of how busy this executor is, as reported by the /status endpoint"""
+        with self._stats_lock:
+            started_tasks = self.completed_tasks + self.active_threads
+            average_wait_time = self.total_wait_time / started_tasks if started_tasks else 0.0
+            return {
+                "name": self.name,
+                "maxThreads": self.max_workers,
+                "activeThreads": self.active_threads,
+                "queueDepth": self.queue_depth,
+                "completedTasks": self.completed_tasks,
+                "averageWaitMs": round(average_wait_time * 1000, 3),
+                "maxWaitMs": round(self.max_wait_time * 1000, 3),
+            }
+
+
+async def run_in_annotator_executor(app, func, *args, **kwargs):
+    """
+    Run a blocking function in the annotator's thread pool and wait for the result without
+    blocking the event loop, e.g., `await run_in_annotator_executor(request.app, nlp, text)`.
+    Libraries that release the GIL (numpy, tokenizers, ...) can then run in parallel.
+    If the app has no annotator executor (e.g., the annotator runs in a process pool worker),
+    the function is just called directly.
+    :param app: the fastapi app passed to on_startup() / available as request.app
+    :param func: a regular (non-async) function
+    :return: whatever func returns
+    """
+    executor = getattr(app, 'acd_annotator_executor', None)
+    if executor is None:
+        return func(*args, **kwargs)
+    # carry over context variables (e.g., the correlation id used in logging) to the worker thread
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
@@ -11,6 +11,7 @@ from fastapi import Request
 from acd_annotator_python.container_model.main import StructuredContainer, StructuredContainerData
 from acd_annotator_python import fastapi_app_factory
 from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python import preconditions
 
 from pydantic import StrictInt
 from typing import Optional
@@ -31,6 +32,11 @@ class BMIAnnotator(ACDAnnotator):
     """
     An annotator that computes a Body Mass Index (BMI) from a given height (in inches) and weight (in pounds).
     """
+    # this annotator only reads height/weight and writes bmi. Everything else is passed through untouched.
+    unstructured_data_fields = ()
+    structured_data_fields = ('heightInches', 'weightPounds', 'bmi')
+    # containers without a height and weight are passed through without being parsed.
+    structured_preconditions = (preconditions.requires('data.heightInches'), preconditions.requires('data.weightPounds'))
 
     def on_startup(self, fastapi_app):
         """Load any required resources when the server starts up. (Not async to allow io operations)"""
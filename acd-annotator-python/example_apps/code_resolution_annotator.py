@@ -16,6 +16,7 @@ from acd_annotator_python.container_model.main import Concept, UnstructuredConta
 from acd_annotator_python import service_utils
 from acd_annotator_python import fastapi_app_factory
 from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python import preconditions
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +77,11 @@ class CodeResolutionAnnotator(ACDAnnotator):
     ACD has identified several candidates across a document, but in order to simplify downstream consumption
     we want to remove all but the most specific codes.
     """
+    # this annotator only looks at attributes. Everything else is passed through untouched.
+    unstructured_data_fields = ('attributeValues',)
+    structured_data_fields = ()
+    # and has nothing to do for containers without attributeValues, which are passed through without being parsed.
+    unstructured_preconditions = (preconditions.requires('data.attributeValues'),)
 
     def __init__(self, snomed_code_hierarchy):
         """
@@ -95,6 +101,10 @@ class CodeResolutionAnnotator(ACDAnnotator):
         resources failed to load correctly, etc."""
         return True
 
+    def get_cache_identity(self):
+        """The results only depend on the code hierarchy, so they can be cached"""
+        return f'CodeResolutionAnnotator:{self.snomed_code_hierarchy}'
+
     async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
         """
         A very simple annotator that looks through attributes and removes all but the most
@@ -17,6 +17,7 @@ from acd_annotator_python.container_model.common import BaseAnnotation
 from acd_annotator_python import service_utils
 from acd_annotator_python import fastapi_app_factory
 from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.thread_pool import run_in_annotator_executor
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +43,12 @@ class SpacySentenceAnnotator(ACDAnnotator):
     """
     An annotator that creates Section annotations over sentences identified by spacy tokenization.
     """
+    # this annotator only adds sentences. Everything else is passed through untouched.
+    unstructured_data_fields = ('sentences',)
+    structured_data_fields = ()
+    # sentence splitting only needs local context, so long notes are split into chunks that run concurrently
+    chunk_size = 100000
+    chunk_overlap = 1000
 
     def on_startup(self, fastapi_app):
         """Load any required resources when the server starts up. (Not async to allow io operations)"""
@@ -52,6 +59,10 @@ class SpacySentenceAnnotator(ACDAnnotator):
         resources failed to load correctly, etc."""
         return True
 
+    def get_cache_identity(self):
+        """The results only depend on the spacy version and model, so they can be cached"""
+        return f'SpacySentenceAnnotator:{spacy.__version__}:en_core_web_sm'
+
     async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
         """
         An annotator that injects sentence annotations into a container.
@@ -59,34 +70,51 @@ class SpacySentenceAnnotator(ACDAnnotator):
         :param request: a fastapi.Request object for the current request
         :return: none
         """
-        data = unstructured_container.data
-        text = unstructured_container.text
-        if data is not None and text is not None:
-            # run spacy nlp and get sentences out
-            sentences = list(request.app.spacy_nlp(text).sents)
-            # log the character/sentence ratio
-            logger.debug("found %s sentences in %s chars", len(sentences), len(text))
-            if sentences is not None and len(sentences) > 0:
-                # spacy sentences are a list of tokens;
-                # each token has an idx entry which is their begin character offset
-                sentence_begins = [sent[0].idx for sent in sentences if sent is not None and len(sent) > 0]
-                # spacy doesn't give us sentence ends, but we'll assume one sentence ends when the next begins
-                sentence_ends = sentence_begins[1:] + [len(text)]
-                # now create annotations over each sentence
-                if data.sentences is None:
-                    data.sentences = []
-                for sent_begin, sent_end in zip(sentence_begins, sentence_ends):
-                    # useful to return the covered_text for debugging, but it would probably be too verbose in practice.
-                    sentence_text = text[sent_begin:sent_end]
-                    # sentence_text = None
-
-                    new_annotation = Sentence(
-                        begin=sent_begin,
-                        end=sent_end,
-                        coveredText=sentence_text,
-                        type=MATCH_TYPE
-                    )
-                    data.sentences.append(new_annotation)
+        await self.annotate_batch([unstructured_container], request.app)
+
+    async def annotate_batch(self, unstructured_containers: List[UnstructuredContainer], fastapi_app):
+        """
+        Inject sentence annotations into a batch of containers (possibly from several requests).
+        spacy's nlp.pipe() processes a batch of texts much faster than one text at a time.
+        :param unstructured_containers: UnstructuredContainers to be processed and modified in-place.
+        :param fastapi_app: the fastapi app
+        :return: none
+        """
+        containers = [container for container in unstructured_containers
+                      if container.data is not None and container.text is not None]
+        texts = [container.text for container in containers]
+        # run spacy nlp over all of the texts at once
+        # (in the annotator's thread pool, so other requests aren't blocked in the meantime)
+        docs = await run_in_annotator_executor(fastapi_app, lambda: list(fastapi_app.spacy_nlp.pipe(texts)))
+        for container, doc in zip(containers, docs):
+            self.add_sentences(container.data, container.text, list(doc.sents))
+
+    @staticmethod
+    def add_sentences(data, text, sentences):
+        """Create annotations over the spacy sentences found in text"""
+        # log the character/sentence ratio
+        logger.debug("found %s sentences in %s chars", len(sentences), len(text))
+        if sentences is not None and len(sentences) > 0:
+            # spacy sentences are a list of tokens;
+            # each token has an idx entry which is their begin character offset
+            sentence_begins = [sent[0].idx for sent in sentences if sent is not None and len(sent) > 0]
+            # spacy doesn't give us sentence ends, but we'll assume one sentence ends when the next begins
+            sentence_ends = sentence_begins[1:] + [len(text)]
+            # now create annotations over each sentence
+            if data.sentences is None:
+                data.sentences = []
+            for sent_begin, sent_end in zip(sentence_begins, sentence_ends):
+                # useful to return the covered_text for debugging, but it would probably be too verbose in practice.
+                sentence_text = text[sent_begin:sent_end]
+                # sentence_text = None
+
+                new_annotation = Sentence(
+                    begin=sent_begin,
+                    end=sent_end,
+                    coveredText=sentence_text,
+                    type=MATCH_TYPE
+                )
+                data.sentences.append(new_annotation)
 
 
 # This is our ASGI app, which can be run by any of a number of ASGI server implementations.
@@ -17,6 +17,7 @@ from acd_annotator_python.container_model.common import BaseAnnotation
 from acd_annotator_python import service_utils
 from acd_annotator_python import fastapi_app_factory
 from acd_annotator_python.acd_annotator import ACDAnnotator
+from acd_annotator_python.thread_pool import run_in_annotator_executor
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +61,12 @@ class StanzaSentenceAnnotator(ACDAnnotator):
     """
     An annotator that creates Section annotations over sentences identified by stanza tokenization.
     """
+    # this annotator only adds sentences. Everything else is passed through untouched.
+    unstructured_data_fields = ('sentences',)
+    structured_data_fields = ()
+    # sentence splitting only needs local context, so long notes are split into chunks that run concurrently
+    chunk_size = 100000
+    chunk_overlap = 1000
 
     def on_startup(self, fastapi_app):
         """Load any required resources when the server starts up. (Not async to allow io operations)"""
@@ -72,6 +79,10 @@ class StanzaSentenceAnnotator(ACDAnnotator):
         resources failed to load correctly, etc."""
         return True
 
+    def get_cache_identity(self):
+        """The results only depend on the stanza version and model, so they can be cached"""
+        return f'StanzaSentenceAnnotator:{stanza.__version__}:en:tokenize'
+
     async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
         """
         An annotator that injects sentence annotations into a container.
@@ -79,33 +90,50 @@ class StanzaSentenceAnnotator(ACDAnnotator):
         :param request: a fastapi.Request object for the current request
         :return: none
         """
-        data = unstructured_container.data
-        text = unstructured_container.text
-        if data is not None and text is not None:
-            # run stanza nlp and get sentences out
-            sentences = request.app.stanza_nlp(text).sentences
-            # log the character/sentence ratio
-            logger.debug("found %s sentences in %s chars", len(sentences), len(text))
-            if sentences is not None and len(sentences) > 0:
-                # stanza sentences are a list of tokens; each token has start_char/end_char info
-                sentence_begins = [get_sentence_begin(sent) for sent in sentences if sent is not None]
-                sentence_ends = [get_sentence_end(sent) for sent in sentences if sent is not None]
-
-                # now create annotations over each sentence
-                if data.sentences is None:
-                    data.sentences = []
-                for sent_begin, sent_end in zip(sentence_begins, sentence_ends):
-                    # useful to return the covered_text for debugging, but it would probably be too verbose in practice.
-                    sentence_text = text[sent_begin:sent_end]
-                    # sentence_text = None
-
-                    new_annotation = Sentence(
-                        begin=sent_begin,
-                        end=sent_end,
-                        coveredText=sentence_text,
-                        type=MATCH_TYPE
-                    )
-                    data.sentences.append(new_annotation)
+        await self.annotate_batch([unstructured_container], request.app)
+
+    async def annotate_batch(self, unstructured_containers: List[UnstructuredContainer], fastapi_app):
+        """
+        Inject sentence annotations into a batch of containers (possibly from several requests).
+        A stanza pipeline processes a list of documents much faster than one document at a time.
+        :param unstructured_containers: UnstructuredContainers to be processed and modified in-place.
+        :param fastapi_app: the fastapi app
+        :return: none
+        """
+        containers = [container for container in unstructured_containers
+                      if container.data is not None and container.text is not None]
+        in_docs = [stanza.Document([], text=container.text) for container in containers]
+        # run stanza nlp over all of the documents at once
+        # (in the annotator's thread pool, so other requests aren't blocked in the meantime)
+        out_docs = await run_in_annotator_executor(fastapi_app, fastapi_app.stanza_nlp, in_docs)
+        for container, doc in zip(containers, out_docs):
+            self.add_sentences(container.data, container.text, doc.sentences)
+
+    @staticmethod
+    def add_sentences(data, text, sentences):
+        """Create annotations over the stanza sentences found in text"""
+        # log the character/sentence ratio
+        logger.debug("found %s sentences in %s chars", len(sentences), len(text))
+        if sentences is not None and len(sentences) > 0:
+            # stanza sentences are a list of tokens; each token has start_char/end_char info
+            sentence_begins = [get_sentence_begin(sent) for sent in sentences if sent is not None]
+            sentence_ends = [get_sentence_end(sent) for sent in sentences if sent is not None]
+
+            # now create annotations over each sentence
+            if data.sentences is None:
+                data.sentences = []
+            for sent_begin, sent_end in zip(sentence_begins, sentence_ends):
+                # useful to return the covered_text for debugging, but it would probably be too verbose in practice.
+                sentence_text = text[sent_begin:sent_end]
+                # sentence_text = None
+
+                new_annotation = Sentence(
+                    begin=sent_begin,
+                    end=sent_end,
+                    coveredText=sentence_text,
+                    type=MATCH_TYPE
+                )
+                data.sentences.append(new_annotation)
 
 
 # This is our ASGI app, which can be run by any of a number of ASGI server implementations.
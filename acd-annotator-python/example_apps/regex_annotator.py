@@ -28,6 +28,9 @@ class RegexAnnotator(ACDAnnotator):
     An annotator that creates Concepts and adds them to the container whenever
     one of the regex patterns is matched.
     """
+    # this annotator only adds concepts. Everything else is passed through untouched.
+    unstructured_data_fields = ('concepts',)
+    structured_data_fields = ()
 
     def __init__(self, search_patterns):
         """
@@ -47,6 +50,10 @@ class RegexAnnotator(ACDAnnotator):
         resources failed to load correctly, etc."""
         return True
 
+    def get_cache_identity(self):
+        """The results only depend on the patterns, so they can be cached"""
+        return f'RegexAnnotator:{self.search_patterns}'
+
     async def annotate(self, unstructured_container: UnstructuredContainer, request: Request):
         """
         A very simple annotator that creates concepts that match the given regex, assigning them the